@@ -0,0 +1,9 @@
+"""ASGI entry point: the messaging endpoints on an event loop, the rest via Flask.
+
+    uvicorn asgi:app
+
+Requires aiosqlite and asgiref. See chat_async.py.
+"""
+from chat_async import create_asgi_app
+
+app = create_asgi_app()
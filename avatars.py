@@ -0,0 +1,158 @@
+"""Avatar upload processing and storage.
+
+Uploads are streamed to a temporary file (capped at MAX_UPLOAD_BYTES),
+decoded with Pillow, center-cropped and re-encoded as small JPEG thumbnails
+in AVATAR_SIZES. Files are named after the SHA-256 of the upload, so a file
+name never changes content and can be cached forever. users.avatar stores
+that key; rendering a profile only formats URLs. Uploads from before the
+pipeline (<username>.jpg) are converted when a deploy migrates the
+database (migrations.migrate_once); files that failed then can be retried
+with
+
+    python avatars.py --import-legacy [db_path]
+
+Pillow (requirements.txt) is imported on first use. Without it uploads are
+refused and the rest of the app keeps working.
+"""
+import hashlib
+import os
+import sys
+import tempfile
+
+from db import DB_NAME, connect, transaction
+
+AVATAR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'avatars')
+AVATAR_SIZES = (64, 128, 256)
+MAX_UPLOAD_BYTES = 5 * 1024 * 1024
+MAX_PIXELS = 40_000_000
+ACCEPTED_FORMATS = {'JPEG', 'PNG', 'GIF', 'WEBP'}
+# File name extensions of uploads passed on to the pipeline
+ACCEPTED_EXTENSIONS = {'jpg', 'jpeg', 'png', 'gif', 'webp'}
+JPEG_QUALITY = 85
+CHUNK_SIZE = 64 * 1024
+
+
+class AvatarError(ValueError):
+    """The upload was rejected; the message is safe to show to the user."""
+
+
+def avatar_filename(key, size):
+    return f"{key}-{size}.jpg"
+
+
+def accepted_extension(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ACCEPTED_EXTENSIONS
+
+
+def legacy_avatar_filename(username):
+    """The pre-pipeline upload of a user without an avatar key, if there is one."""
+    filename = f"{username}.jpg"
+    return filename if os.path.isfile(os.path.join(AVATAR_DIR, filename)) else None
+
+
+def _spool(stream):
+    """Copy an upload stream to a temp file in AVATAR_DIR; returns (path, sha256 hex)."""
+    digest = hashlib.sha256()
+    size = 0
+    fd, path = tempfile.mkstemp(dir=AVATAR_DIR, suffix='.upload')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_UPLOAD_BYTES:
+                    raise AvatarError(f"Profile pictures must be smaller than {MAX_UPLOAD_BYTES // (1024 * 1024)} MB")
+                digest.update(chunk)
+                out.write(chunk)
+    except BaseException:
+        os.unlink(path)
+        raise
+    if not size:
+        os.unlink(path)
+        raise AvatarError("The uploaded file is empty")
+    return path, digest.hexdigest()
+
+
+def _write_thumbnails(src_path, key):
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        raise AvatarError("Profile picture uploads are not available right now")
+
+    Image.MAX_IMAGE_PIXELS = MAX_PIXELS
+    try:
+        with Image.open(src_path) as img:
+            if img.format not in ACCEPTED_FORMATS:
+                raise AvatarError("Profile pictures must be JPEG, PNG, GIF or WebP images")
+            img = ImageOps.exif_transpose(img)
+            # Flatten transparency onto white; JPEG has no alpha channel
+            rgba = img.convert('RGBA')
+            flat = Image.new('RGB', rgba.size, (255, 255, 255))
+            flat.paste(rgba, mask=rgba.getchannel('A'))
+
+            for size in AVATAR_SIZES:
+                thumb = ImageOps.fit(flat, (size, size), Image.LANCZOS)
+                final = os.path.join(AVATAR_DIR, avatar_filename(key, size))
+                # Write then rename, so a half-written file is never served
+                tmp = final + '.tmp'
+                thumb.save(tmp, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+                os.replace(tmp, final)
+    except (OSError, Image.DecompressionBombError, SyntaxError):
+        raise AvatarError("The uploaded file is not a valid image")
+
+
+def save_avatar(stream):
+    """Validate and store an uploaded avatar; returns its key. Raises AvatarError."""
+    os.makedirs(AVATAR_DIR, exist_ok=True)
+    path, digest = _spool(stream)
+    key = digest[:32]
+    try:
+        # Same content, same key: an identical upload is already processed
+        if not all(os.path.exists(os.path.join(AVATAR_DIR, avatar_filename(key, size)))
+                   for size in AVATAR_SIZES):
+            _write_thumbnails(path, key)
+    finally:
+        os.unlink(path)
+    return key
+
+
+def import_legacy_avatars(conn):
+    """Process old <username>.jpg uploads into keyed thumbnails and record them.
+
+    Each file is processed outside of any transaction and recorded in its
+    own short one. Files that cannot be processed are left in place and
+    are returned as (username, reason) pairs.
+    """
+    imported, failed = 0, []
+    users = conn.execute("SELECT id, username FROM users WHERE avatar IS NULL").fetchall()
+    for user_id, username in users:
+        legacy = legacy_avatar_filename(username)
+        if legacy is None:
+            continue
+        try:
+            with open(os.path.join(AVATAR_DIR, legacy), 'rb') as f:
+                key = save_avatar(f)
+        except AvatarError as e:
+            failed.append((username, str(e)))
+            continue
+        with transaction(conn):
+            conn.execute("UPDATE users SET avatar = ? WHERE id = ? AND avatar IS NULL", (key, user_id))
+        imported += 1
+    return imported, failed
+
+
+if __name__ == '__main__':
+    # python avatars.py --import-legacy [db_path]
+    if '--import-legacy' not in sys.argv:
+        print("usage: python avatars.py --import-legacy [db_path]")
+        sys.exit(2)
+    args = [arg for arg in sys.argv[1:] if arg != '--import-legacy']
+    conn = connect(args[0] if args else DB_NAME)
+    imported, failed = import_legacy_avatars(conn)
+    for username, reason in failed:
+        print(f"Skipped {username}: {reason}")
+    print(f"Imported {imported} avatar(s)")
+    conn.close()
+    sys.exit(1 if failed else 0)
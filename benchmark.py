@@ -0,0 +1,283 @@
+"""Route benchmarks through the Flask test client.
+
+Each data scale is seeded into a scratch database (seed_data.py) and
+benchmarked in its own subprocess, so module-level caches and background
+threads never carry over between scales. Every route is driven by N
+concurrent logged-in clients; latency percentiles, SQL statements per
+request and throughput are compared against benchmark_baseline.json and
+the run fails if any of them regressed or any request failed.
+
+    python benchmark.py                          # small scale, 1 and 8 clients
+    python benchmark.py --scales small medium --concurrency 1 4 16
+    python benchmark.py --update-baseline        # accept the current numbers
+"""
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from seed_data import SCALES, seed
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE = os.path.join(HERE, 'benchmark_baseline.json')
+
+REQUESTS_PER_CLIENT = 50
+WARMUP_REQUESTS = 5
+
+# A metric regresses when it is worse than the baseline by both the relative
+# tolerance and the absolute slack; the slack keeps sub-millisecond noise on
+# fast routes from failing the run
+LATENCY_TOLERANCE = 0.25
+LATENCY_SLACK_MS = 2.0
+THROUGHPUT_TOLERANCE = 0.25
+QUERY_SLACK = 0.5
+
+
+# --- Scenarios: one request for a given client, drawn from the seeded data ---
+
+def _home(data, user, rng):
+    return 'GET', '/home', None
+
+def _calendar(data, user, rng):
+    return 'GET', '/calendar', None
+
+def _load_messages(data, user, rng):
+    partners = data['partners'].get(user['id']) or [rng.choice(data['users'])['id']]
+    return 'GET', f"/messages/load/{rng.choice(partners)}", None
+
+def _rate_topic(data, user, rng):
+    topic_id = rng.choice(data['rateable'])
+    return 'POST', f"/rate_topic/{topic_id}", {'rating': str(rng.choice([3, 3.5, 4, 4.5, 5])), 'feedback': ''}
+
+def _willing_to_join(data, user, rng):
+    topic_id = rng.choice(data['topics'])
+    while data['owners'][topic_id] == user['id']:
+        topic_id = rng.choice(data['topics'])
+    return 'POST', f"/willing_to_join/{topic_id}", None
+
+def _profile(data, user, rng):
+    return 'GET', f"/profile/{rng.choice(data['users'])['username']}", None
+
+# GET /messages is left out: templates/messages.html is not in the tree, so
+# that page fails on every request and would only measure the error path
+SCENARIOS = {
+    'home': _home,
+    'calendar': _calendar,
+    'messages_load': _load_messages,
+    'rate_topic': _rate_topic,
+    'willing_to_join': _willing_to_join,
+    'profile': _profile,
+}
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def load_fixture(conn):
+    """What the scenarios pick from: users (activity-weighted), topics, message partners."""
+    users = [{'id': row[0], 'username': row[1]}
+             for row in conn.execute("SELECT id, username FROM users ORDER BY id")]
+    owners = dict(conn.execute("SELECT id, created_by FROM topics"))
+    rateable = [row[0] for row in conn.execute(
+        "SELECT id FROM topics WHERE scheduled_datetime IS NULL OR scheduled_datetime <= datetime('now', 'localtime')")]
+    partners = {}
+    for low, high in conn.execute("SELECT user_low, user_high FROM conversations"):
+        partners.setdefault(low, []).append(high)
+        partners.setdefault(high, []).append(low)
+    # Clients are the most active users, as in a real traffic mix
+    active = [row[0] for row in conn.execute("""
+        SELECT user_id FROM user_stats
+        ORDER BY topics_created + topics_joined + ratings_given + messages_sent DESC
+    """)]
+    by_id = {user['id']: user for user in users}
+    return {'users': users, 'clients': [by_id[i] for i in active if i in by_id] or users,
+            'topics': sorted(owners), 'owners': owners, 'rateable': rateable or sorted(owners),
+            'partners': partners}
+
+
+# --- Worker: runs inside the scratch directory, one process per scale ---
+
+def run_scale(concurrency_levels, requests_per_client, routes, seed_value):
+    import main
+    from db import connect, get_db, get_read_db
+
+    app = main.create_app({'DATABASE': os.path.abspath('studymate.db'), 'MIGRATE_ON_START': False})
+    counter = threading.local()
+
+    def count_statement(sql):
+        if not sql.startswith('--'):  # trigger bodies are traced as comments
+            counter.queries += 1
+
+    @app.before_request
+    def trace_queries():
+        get_db().set_trace_callback(count_statement)
+        get_read_db().set_trace_callback(count_statement)
+
+    conn = connect()
+    data = load_fixture(conn)
+    conn.close()
+
+    results = {}
+    for concurrency in concurrency_levels:
+        for route in routes:
+            scenario = SCENARIOS[route]
+            latencies, queries, errors = [], [], []
+            lock = threading.Lock()
+            start_gate = threading.Barrier(concurrency + 1, timeout=60)
+
+            def client_loop(index):
+                rng = random.Random(seed_value * 1000 + index)
+                user = data['clients'][index % len(data['clients'])]
+                client = app.test_client()
+                counter.queries = 0
+                with client.session_transaction() as sess:
+                    sess['user_id'] = user['id']
+                for _ in range(WARMUP_REQUESTS):
+                    method, url, form = scenario(data, user, rng)
+                    client.open(url, method=method, data=form)
+                start_gate.wait()
+                mine = []
+                for _ in range(requests_per_client):
+                    method, url, form = scenario(data, user, rng)
+                    counter.queries = 0
+                    started = time.perf_counter()
+                    response = client.open(url, method=method, data=form)
+                    response.get_data()
+                    elapsed = time.perf_counter() - started
+                    mine.append((elapsed, counter.queries, response.status_code >= 400))
+                with lock:
+                    for elapsed, n, failed in mine:
+                        latencies.append(elapsed * 1000)
+                        queries.append(n)
+                        errors.append(failed)
+
+            threads = [threading.Thread(target=client_loop, args=(i,)) for i in range(concurrency)]
+            for thread in threads:
+                thread.start()
+            start_gate.wait()
+            wall_started = time.perf_counter()
+            for thread in threads:
+                thread.join()
+            wall = time.perf_counter() - wall_started
+
+            latencies.sort()
+            results[f"c{concurrency}/{route}"] = {
+                'requests': len(latencies),
+                'p50_ms': round(percentile(latencies, 50), 3),
+                'p95_ms': round(percentile(latencies, 95), 3),
+                'p99_ms': round(percentile(latencies, 99), 3),
+                'queries_per_request': round(sum(queries) / len(queries), 2) if queries else 0.0,
+                'throughput_rps': round(len(latencies) / wall, 1) if wall else 0.0,
+                'errors': sum(errors),
+            }
+    main.notifier.stop()
+    main.writer.stop()
+    return results
+
+
+# --- Orchestration ---
+
+def benchmark_scale(scale, counts, args):
+    """Seed a scratch database for scale and benchmark it in a subprocess."""
+    scratch = tempfile.mkdtemp(prefix=f"studymate-bench-{scale}-")
+    try:
+        seed(os.path.join(scratch, 'studymate.db'), seed=args.seed, **counts)
+        output = os.path.join(scratch, 'results.json')
+        command = [sys.executable, os.path.abspath(__file__), '--worker', output,
+                   '--seed', str(args.seed), '--requests', str(args.requests),
+                   '--concurrency', *map(str, args.concurrency), '--routes', *args.routes]
+        # The script's own directory is on sys.path, so the app still imports from the repo
+        subprocess.run(command, cwd=scratch, check=True)
+        with open(output) as f:
+            return json.load(f)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def compare(results, baseline):
+    """Lines describing every metric that regressed against the baseline."""
+    regressions = []
+    for key, now in sorted(results.items()):
+        then = baseline.get(key)
+        if then is None:
+            continue
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms'):
+            if now[metric] > then[metric] * (1 + LATENCY_TOLERANCE) and now[metric] - then[metric] > LATENCY_SLACK_MS:
+                regressions.append(f"{key}: {metric} {then[metric]} -> {now[metric]}")
+        if now['queries_per_request'] > then['queries_per_request'] + QUERY_SLACK:
+            regressions.append(f"{key}: queries/request {then['queries_per_request']} -> {now['queries_per_request']}")
+        if now['throughput_rps'] < then['throughput_rps'] * (1 - THROUGHPUT_TOLERANCE):
+            regressions.append(f"{key}: throughput {then['throughput_rps']} -> {now['throughput_rps']} req/s")
+    return regressions
+
+
+def print_table(results):
+    print(f"{'benchmark':<36} {'p50':>8} {'p95':>8} {'p99':>8} {'q/req':>6} {'req/s':>8} {'err':>4}")
+    for key, r in sorted(results.items()):
+        print(f"{key:<36} {r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} {r['p99_ms']:>8.2f} "
+              f"{r['queries_per_request']:>6.1f} {r['throughput_rps']:>8.1f} {r['errors']:>4}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scales', nargs='+', choices=SCALES, default=['small'])
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 8])
+    parser.add_argument('--routes', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--requests', type=int, default=REQUESTS_PER_CLIENT, help='timed requests per client')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--worker', metavar='OUTPUT', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        results = run_scale(args.concurrency, args.requests, args.routes, args.seed)
+        with open(args.worker, 'w') as f:
+            json.dump(results, f)
+        return 0
+
+    results = {}
+    for scale in args.scales:
+        for key, value in benchmark_scale(scale, SCALES[scale], args).items():
+            results[f"{scale}/{key}"] = value
+    print_table(results)
+
+    # A failing route is measuring its error path, never a usable number
+    failed = {key: r['errors'] for key, r in sorted(results.items()) if r['errors']}
+    for key, errors in failed.items():
+        print(f"FAILED {key}: {errors} requests returned an error status")
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    if args.update_baseline:
+        if failed:
+            print("Baseline not updated: fix the failing routes first")
+            return 1
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"Baseline updated: {args.baseline}")
+        return 0
+
+    regressions = compare(results, baseline)
+    for line in regressions:
+        print(f"REGRESSION {line}")
+    if not baseline:
+        print("No baseline yet; run with --update-baseline to record one")
+    return 1 if regressions or failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,329 @@
+"""Async (ASGI) serving mode for the messaging endpoints.
+
+    uvicorn asgi:app
+
+ChatApp answers /messages/load/<id>, /messages/send and
+/messages/stream/<id> on the event loop and hands every other request to
+the Flask app through asgiref's WSGI adapter. A chat waiting for new
+messages (the SSE stream, or a load with since_id and wait=<seconds>) is a
+suspended coroutine rather than a blocked thread, so idle chats no longer
+count against the worker's thread pool. The user comes from the Flask app's
+own session store (same cookie, same sessions table) and the SQL is shared
+with main.py.
+
+aiosqlite and asgiref are only needed for this mode; they are imported when
+the app is built.
+"""
+import asyncio
+import json
+import re
+import time
+from contextlib import asynccontextmanager
+from urllib.parse import parse_qs
+
+from werkzeug.http import parse_cookie, parse_etags
+
+import main
+import profiling
+from db import PRAGMAS
+from etags import make_etag
+from message_events import broker
+from notifications import MESSAGE
+from timeutils import now_ts
+
+POOL_SIZE = 4
+MAX_WAIT_SECONDS = 60
+MAX_BODY_BYTES = 64 * 1024
+
+ROUTES = [
+    ('GET', re.compile(r'/messages/load/(\d+)'), 'load_messages'),
+    ('POST', re.compile(r'/messages/send'), 'send_message'),
+    ('GET', re.compile(r'/messages/stream/(\d+)'), 'stream_messages'),
+]
+
+
+class ConnectionPool:
+    """A few aiosqlite connections shared by every coroutine on the loop."""
+
+    def __init__(self, path, size=POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._idle = None
+        self._all = []
+
+    async def _open(self):
+        import aiosqlite
+        conn = await aiosqlite.connect(self.path, timeout=5)
+        for pragma in PRAGMAS:
+            await conn.execute(pragma)
+        return conn
+
+    @asynccontextmanager
+    async def connection(self):
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+        if self._idle.empty() and len(self._all) < self.size:
+            self._all.append(None)  # reserve the slot while connecting
+            try:
+                conn = await self._open()
+            except BaseException:
+                self._all.remove(None)
+                raise
+            self._all[self._all.index(None)] = conn
+        else:
+            conn = await self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put_nowait(conn)
+
+    async def close(self):
+        for conn in self._all:
+            if conn is not None:
+                await conn.close()
+        self._all, self._idle = [], None
+
+
+@asynccontextmanager
+async def transaction(conn):
+    """db.transaction() for an aiosqlite connection."""
+    await conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        await conn.rollback()
+        raise
+    else:
+        await conn.commit()
+
+
+async def fetch_all(conn, sql, params=()):
+    async with conn.execute(sql, params) as cursor:
+        return await cursor.fetchall()
+
+
+async def fetch_thread(conn, user_id, other_user_id, before_id=None, since_id=None, limit=main.MESSAGE_PAGE_SIZE):
+    """main.fetch_thread() on an aiosqlite connection."""
+    rows = await fetch_all(conn, *main.thread_query(user_id, other_user_id, before_id, since_id, limit))
+    return main.thread_page(rows, since_id, limit)
+
+
+async def mark_conversation_read(conn, user_id, other_user_id):
+    """main.mark_conversation_read() on an aiosqlite connection."""
+    check, params, updates = main.mark_read_statements(user_id, other_user_id)
+    rows = await fetch_all(conn, check, params)
+    if rows and rows[0][0]:
+        async with transaction(conn):
+            for sql, update_params in updates:
+                await conn.execute(sql, update_params)
+
+
+def _int_arg(query, name, default=None):
+    try:
+        return int(query[name][0])
+    except (KeyError, ValueError):
+        return default
+
+
+async def _read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body += message.get('body', b'')
+        if len(body) > MAX_BODY_BYTES:
+            return None
+        if not message.get('more_body'):
+            return body
+
+
+async def _wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def _respond(send, status, payload, headers=()):
+    body = json.dumps(payload).encode() if payload is not None else b''
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json')] + list(headers)})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _etag_headers(etag):
+    # Same validators and caching rules as etags.with_etag()
+    return [(b'etag', f'W/"{etag}"'.encode()), (b'cache-control', b'private, no-cache'), (b'vary', b'Cookie')]
+
+
+class ChatApp:
+    def __init__(self, flask_app, pool_size=POOL_SIZE):
+        from asgiref.wsgi import WsgiToAsgi
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.store = flask_app.session_interface.store
+        self.cookie_name = flask_app.config['SESSION_COOKIE_NAME']
+        self.pool = ConnectionPool(flask_app.config['DATABASE'], pool_size)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] == 'http':
+            for method, pattern, handler in ROUTES:
+                match = pattern.fullmatch(scope['path'])
+                if match and scope['method'] == method:
+                    return await getattr(self, handler)(scope, receive, send, *map(int, match.groups()))
+        await self.wsgi(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.pool.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _user(self, scope):
+        """The logged-in user, as sessions.current_user() would load it, or None."""
+        headers = dict(scope['headers'])
+        sid = parse_cookie(headers.get(b'cookie', b'').decode('latin-1')).get(self.cookie_name)
+        if not sid:
+            return None
+        # The store's LRU is shared with the Flask side; a miss reads the sessions table
+        found = await asyncio.to_thread(self.store.get, sid)
+        user_id = found[0].get('user_id') if found else None
+        if user_id is None:
+            return None
+        async with self.pool.connection() as conn:
+            rows = await fetch_all(conn, "SELECT id, username, name, suspended_at FROM users WHERE id = ?", (user_id,))
+        if not rows or rows[0][3]:
+            return None
+        return {'id': rows[0][0], 'username': rows[0][1], 'name': rows[0][2]}
+
+    async def load_messages(self, scope, receive, send, other_user_id):
+        """main.load_messages(); with since_id, wait=<seconds> long-polls for new messages."""
+        started = time.perf_counter()
+        user = await self._user(scope)
+        if user is None:
+            return await _respond(send, 401, {'error': 'Not logged in'})
+
+        user_id = user['id']
+        query = parse_qs(scope['query_string'].decode('latin-1'))
+        before_id = _int_arg(query, 'before_id')
+        since_id = _int_arg(query, 'since_id')
+        limit = min(max(_int_arg(query, 'limit', main.MESSAGE_PAGE_SIZE), 1), 200)
+        wait = min(max(_int_arg(query, 'wait', 0), 0), MAX_WAIT_SECONDS) if since_id is not None else 0
+        key = main.conversation_key(user_id, other_user_id)
+
+        async with self.pool.connection() as conn:
+            rows = await fetch_all(conn, "SELECT last_message_id FROM conversations WHERE user_low = ? AND user_high = ?",
+                                   key)
+            last_message_id = rows[0][0] if rows else None
+            etag = make_etag('thread', user_id, other_user_id, last_message_id, before_id, since_id, limit)
+            if_none_match = parse_etags(dict(scope['headers']).get(b'if-none-match', b'').decode('latin-1'))
+            if not wait and if_none_match.contains_weak(etag):
+                return await _respond(send, 304, None, _etag_headers(etag))
+            messages, has_more = await fetch_thread(conn, user_id, other_user_id, before_id, since_id, limit)
+
+        if not messages and wait:
+            # No connection is held while waiting
+            if await broker.wait_async(key, since_id, wait):
+                async with self.pool.connection() as conn:
+                    messages, has_more = await fetch_thread(conn, user_id, other_user_id, since_id=since_id, limit=limit)
+
+        async with self.pool.connection() as conn:
+            await mark_conversation_read(conn, user_id, other_user_id)
+        headers = [] if wait else _etag_headers(etag)
+        await _respond(send, 200, {'messages': messages, 'has_more': has_more}, headers)
+        profiling.request_seconds.observe(time.perf_counter() - started, 'load_messages')
+
+    async def send_message(self, scope, receive, send):
+        started = time.perf_counter()
+        user = await self._user(scope)
+        if user is None:
+            return await _respond(send, 401, {'error': 'Not logged in'})
+
+        body = await _read_body(receive)
+        try:
+            data = json.loads(body) if body else None
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            return await _respond(send, 400, {'error': 'Invalid JSON'})
+        recipient_id = data.get('recipient_id')
+        message_text = data.get('message')
+        if not recipient_id or not message_text:
+            return await _respond(send, 400, {'error': 'Missing fields'})
+        recipient_id = main.parse_user_id(recipient_id)
+        if recipient_id is None:
+            return await _respond(send, 400, {'error': 'Invalid recipient'})
+
+        user_id = user['id']
+        try:
+            async with self.pool.connection() as conn:
+                async with transaction(conn):
+                    msg_id = None
+                    if await fetch_all(conn, main.RECIPIENT_EXISTS_SQL, (recipient_id,)):
+                        cursor = await conn.execute(main.INSERT_MESSAGE_SQL,
+                                                    (user_id, recipient_id, message_text, now_ts()))
+                        msg_id = cursor.lastrowid
+            if msg_id is None:
+                return await _respond(send, 400, {'error': 'Unknown recipient'})
+            # Wakes streams on this loop and threads of the Flask side alike
+            broker.publish(main.conversation_key(user_id, recipient_id), msg_id)
+            main.notifier.notify(MESSAGE, recipient_id, user_id, user_id, user['name'] or user['username'])
+        except Exception as e:
+            return await _respond(send, 500, {'error': str(e)})
+        await _respond(send, 200, {'ok': True, 'id': msg_id})
+        profiling.request_seconds.observe(time.perf_counter() - started, 'send_message')
+
+    async def stream_messages(self, scope, receive, send, other_user_id):
+        """main.stream_messages() as a coroutine; ends early when the client goes away."""
+        user = await self._user(scope)
+        if user is None:
+            return await _respond(send, 401, {'error': 'Not logged in'})
+
+        user_id = user['id']
+        headers = dict(scope['headers'])
+        query = parse_qs(scope['query_string'].decode('latin-1'))
+        try:
+            last_id = int(headers.get(b'last-event-id', b'') or 0) or _int_arg(query, 'since_id', 0)
+        except ValueError:
+            last_id = _int_arg(query, 'since_id', 0)
+        key = main.conversation_key(user_id, other_user_id)
+
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ]})
+        disconnected = asyncio.ensure_future(_wait_disconnect(receive))
+        try:
+            deadline = time.monotonic() + main.STREAM_MAX_SECONDS
+            while time.monotonic() < deadline and not disconnected.done():
+                async with self.pool.connection() as conn:
+                    messages, _ = await fetch_thread(conn, user_id, other_user_id, since_id=last_id)
+                    if messages:
+                        await mark_conversation_read(conn, user_id, other_user_id)
+                if messages:
+                    chunk = ''.join(f"id: {m['id']}\nevent: message\ndata: {json.dumps(m)}\n\n" for m in messages)
+                    await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+                    last_id = messages[-1]['id']
+                    continue
+                waiting = asyncio.ensure_future(broker.wait_async(key, last_id, main.STREAM_POLL_SECONDS))
+                await asyncio.wait({waiting, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+                if not waiting.done():
+                    waiting.cancel()
+                    break
+                if not waiting.result():
+                    await send({'type': 'http.response.body', 'body': b': keepalive\n\n', 'more_body': True})
+            if not disconnected.done():
+                await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnected.cancel()
+
+
+def create_asgi_app(config=None):
+    """create_app() with the messaging endpoints served asynchronously."""
+    return ChatApp(main.create_app(config))
@@ -0,0 +1,205 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import quote
+from flask import current_app, g
+
+DB_NAME = "studymate.db"
+
+# Applied to every connection when it is opened. WAL lets readers proceed
+# while a single writer commits; busy_timeout makes writers wait for the
+# lock instead of failing straight away with "database is locked".
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 134217728",
+)
+
+# Reader connections cannot change the journal mode; query_only makes any
+# write attempt fail even if one slips into a read route
+READ_PRAGMAS = (
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 134217728",
+    "PRAGMA query_only = 1",
+)
+
+
+def connect(path=DB_NAME, factory=sqlite3.Connection):
+    """Open a new configured connection (outside of a request)."""
+    conn = sqlite3.connect(path, timeout=5, factory=factory)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+class ReaderPool:
+    """Read-only connections (mode=ro, query_only) shared by the read routes.
+
+    Under WAL, readers never wait for the writer, so read routes served from
+    here keep their latency while writes commit on the request and
+    group-commit connections. A checkout that finds every connection busy
+    waits up to timeout seconds, then gets a temporary overflow connection
+    rather than an error. Connections are opened on first use and the pool
+    starts empty again in a forked child.
+    """
+
+    def __init__(self, path, size=8, timeout=0.5):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._owned = set()
+        self._checked_out = set()
+        self.opened = 0
+        self.in_use = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.overflows = 0
+
+    def connect(self, factory=sqlite3.Connection):
+        """Open a read-only connection that is not part of the pool."""
+        uri = f"file:{quote(os.path.abspath(self.path))}?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, timeout=5, check_same_thread=False, factory=factory)
+        for pragma in READ_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def checkout(self):
+        conn = self._checkout()
+        with self._lock:
+            self._checked_out.add(id(conn))
+        return conn
+
+    def _checkout(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            self.checkouts += 1
+            self.in_use += 1
+            grow = self._idle.empty() and self.opened < self.size
+            if grow:
+                self.opened += 1
+        try:
+            if grow:
+                conn = self.connect()
+                with self._lock:
+                    self._owned.add(id(conn))
+                return conn
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+            started = time.perf_counter()
+            try:
+                conn = self._idle.get(timeout=self.timeout)
+            except queue.Empty:
+                conn = None
+            with self._lock:
+                self.waits += 1
+                self.wait_seconds += time.perf_counter() - started
+                if conn is None:
+                    self.overflows += 1
+            return conn if conn is not None else self.connect()
+        except BaseException:
+            with self._lock:
+                self.in_use -= 1
+                if grow:
+                    self.opened -= 1
+            raise
+
+    def checkin(self, conn):
+        """Return a checked-out connection; any other connection is closed."""
+        with self._lock:
+            if id(conn) in self._checked_out:
+                self._checked_out.remove(id(conn))
+                self.in_use -= 1
+            owned = id(conn) in self._owned and self._pid == os.getpid()
+        if not owned:
+            conn.close()
+            return
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    def stats(self):
+        with self._lock:
+            return {'size': self.size, 'open': self.opened, 'in_use': self.in_use,
+                    'checkouts': self.checkouts, 'waits': self.waits,
+                    'wait_seconds': round(self.wait_seconds, 6), 'overflows': self.overflows}
+
+
+def get_db():
+    """Return the read-write connection for the current request, opening it on first use."""
+    if 'db' not in g:
+        g.db = connect(current_app.config['DATABASE'])
+    return g.db
+
+
+def get_read_db():
+    """Return a read-only connection for the current request, from the reader pool.
+
+    Use it in routes (and the read part of routes) that never write; writes
+    go through get_db() / transaction().
+    """
+    if 'read_db' not in g:
+        g.read_db = current_app.extensions['reader_pool'].checkout()
+    return g.read_db
+
+
+def close_db(exc=None):
+    conn = g.pop('db', None)
+    if conn is not None:
+        conn.close()
+    conn = g.pop('read_db', None)
+    if conn is not None:
+        current_app.extensions['reader_pool'].checkin(conn)
+
+
+@contextmanager
+def transaction(conn=None):
+    """Run a block of writes in one transaction on the request connection.
+
+    BEGIN IMMEDIATE takes the write lock up front so two writers never
+    deadlock upgrading from a read. Commits on success, rolls back on error.
+    Nested use joins the outer transaction. Pass conn to use a connection
+    other than the request's one.
+    """
+    if conn is None:
+        conn = get_db()
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except Exception:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+
+def data_version(conn, name):
+    """Current value of a data_versions counter (0 if it was never bumped)."""
+    row = conn.execute("SELECT version FROM data_versions WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else 0
+
+
+def bump_data_version(conn, name):
+    """Increment a data_versions counter; call inside the write's transaction."""
+    conn.execute("""
+        INSERT INTO data_versions (name, version) VALUES (?, 1)
+        ON CONFLICT (name) DO UPDATE SET version = version + 1
+    """, (name,))
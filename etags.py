@@ -0,0 +1,52 @@
+"""Conditional GET for pages and JSON endpoints.
+
+A route builds its validator from cheap data_versions lookups before doing
+any real work; if the client's If-None-Match matches, it answers 304 and
+skips the heavy queries and the template render entirely:
+
+    etag, not_modified = check_etag('home', user['id'], data_version(c, 'feed'))
+    if not_modified:
+        return not_modified
+    ...
+    return with_etag(make_response(render_template(...)), etag)
+"""
+import hashlib
+import os
+
+from flask import Response, request
+
+_APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _code_version():
+    # Any change to the code or templates must change every ETag
+    latest = 0.0
+    for folder in (_APP_DIR, os.path.join(_APP_DIR, 'routes'), os.path.join(_APP_DIR, 'templates')):
+        if os.path.isdir(folder):
+            for entry in os.scandir(folder):
+                if entry.is_file() and entry.name.endswith(('.py', '.html')):
+                    latest = max(latest, entry.stat().st_mtime)
+    return int(latest)
+
+
+CODE_VERSION = _code_version()
+
+
+def make_etag(*parts):
+    return hashlib.blake2b(repr((CODE_VERSION,) + parts).encode(), digest_size=12).hexdigest()
+
+
+def check_etag(*parts):
+    """Return (etag, response); response is a ready 304 if the client is current, else None."""
+    etag = make_etag(*parts)
+    if request.if_none_match.contains_weak(etag):
+        return etag, with_etag(Response(status=304), etag)
+    return etag, None
+
+
+def with_etag(response, etag):
+    response.set_etag(etag, weak=True)
+    # Per-user content: browsers may keep it, but must revalidate every time
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response
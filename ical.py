@@ -0,0 +1,75 @@
+"""Minimal iCalendar (RFC 5545) writer for the per-user session feed.
+
+Session times are stored as local wall-clock time without a zone, so events
+are written as floating times and calendar clients show them as-is.
+"""
+import re
+from datetime import datetime, timedelta, timezone
+
+DEFAULT_DURATION = timedelta(hours=1)
+
+_DURATION_PART = re.compile(r'(\d+(?:\.\d+)?)\s*(h|hr|hrs|hour|hours|m|min|mins|minute|minutes)\b', re.I)
+
+
+def parse_duration(text):
+    """Best-effort parse of a free-text duration such as '1h 30m' or '45 mins'."""
+    total = timedelta()
+    for amount, unit in _DURATION_PART.findall(text or ''):
+        if unit.lower().startswith('h'):
+            total += timedelta(hours=float(amount))
+        else:
+            total += timedelta(minutes=float(amount))
+    return total or DEFAULT_DURATION
+
+
+def _escape(value):
+    return (str(value or '').replace('\\', '\\\\').replace(';', '\\;')
+            .replace(',', '\\,').replace('\r\n', '\\n').replace('\n', '\\n'))
+
+
+def _fold(line):
+    """Split a content line into 75-octet chunks joined by CRLF + space."""
+    raw = line.encode('utf-8')
+    if len(raw) <= 75:
+        return line
+    parts, start = [], 0
+    while start < len(raw):
+        end = min(start + (75 if not parts else 74), len(raw))
+        # Never cut a multi-byte character in half
+        while end < len(raw) and (raw[end] & 0xC0) == 0x80:
+            end -= 1
+        parts.append(raw[start:end].decode('utf-8'))
+        start = end
+    return '\r\n '.join(parts)
+
+
+def _local(dt):
+    return dt.strftime('%Y%m%dT%H%M%S')
+
+
+def build_calendar(name, events, host):
+    """Render events (dicts with id, start, duration, summary, description) as an .ics body."""
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    lines = [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//StudyMate//Sessions//EN',
+        'CALSCALE:GREGORIAN',
+        'METHOD:PUBLISH',
+        f'X-WR-CALNAME:{_escape(name)}',
+    ]
+    for event in events:
+        lines += [
+            'BEGIN:VEVENT',
+            f"UID:topic-{event['id']}@{host}",
+            f'DTSTAMP:{stamp}',
+            f"DTSTART:{_local(event['start'])}",
+            f"DTEND:{_local(event['start'] + event['duration'])}",
+            f"SUMMARY:{_escape(event['summary'])}",
+            f"DESCRIPTION:{_escape(event['description'])}",
+        ]
+        if event.get('category'):
+            lines.append(f"CATEGORIES:{_escape(event['category'])}")
+        lines.append('END:VEVENT')
+    lines.append('END:VCALENDAR')
+    return '\r\n'.join(_fold(line) for line in lines) + '\r\n'
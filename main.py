@@ -1,218 +1,571 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash, send_from_directory
+from flask import Flask, current_app, render_template, request, redirect, url_for, session, jsonify, flash, send_from_directory, Response, stream_with_context, make_response
+from werkzeug.http import is_resource_modified
 from werkzeug.utils import secure_filename
 import sqlite3
 import os
-from datetime import datetime
+import json
+import base64
+import binascii
+import re
+import time
+from datetime import datetime, timedelta, timezone
+from itsdangerous import URLSafeSerializer, BadSignature
+from markupsafe import Markup, escape
 
-app = Flask(__name__)
-app.secret_key = 'supersecretkey'
+from db import DB_NAME, ReaderPool, connect, get_db, get_read_db, close_db, transaction, data_version, bump_data_version
+from migrations import migrate_once
+from timeutils import now_ts, parse_ts, normalize_ts, format_ts
+from message_events import broker
+from ical import build_calendar, parse_duration
+from cache import LRUCache
+from etags import check_etag, with_etag
+from moderation import MAX_BATCH, delete_topics, delete_users, set_suspended
+from notifications import NotificationWorker, JOIN, RATING, MESSAGE, SESSION
+from writer import GroupCommitWriter, WINDOW_SECONDS, MAX_BATCH_WRITES
+import profiling
+from sessions import SessionInterface, SqliteStore, current_user
+from recommendations import Recommender
 
-from routes.profile import profile_bp
-app.register_blueprint(profile_bp)
+# Defaults; STUDYMATE_<KEY> environment variables and create_app(config) override them
+DEFAULT_CONFIG = {
+    'DATABASE': DB_NAME,
+    'SECRET_KEY': 'supersecretkey',
+    # Largest accepted request body (avatar uploads are capped lower in avatars.py)
+    'MAX_CONTENT_LENGTH': 8 * 1024 * 1024,
+    # Apply pending migrations when the app is created (one process at a time)
+    'MIGRATE_ON_START': True,
+    # Route hot writes through the group-commit writer thread (writer.py)
+    'GROUP_COMMIT': False,
+    'GROUP_COMMIT_WINDOW': WINDOW_SECONDS,
+    'GROUP_COMMIT_MAX_BATCH': MAX_BATCH_WRITES,
+    # Fraction of requests that get SQL tracing (profiling.py)
+    'PROFILE_SAMPLE': 0.0,
+    'SESSION_CACHE_SIZE': 10000,
+    # Read-only connections shared by the read routes (db.ReaderPool)
+    'READ_POOL_SIZE': 8,
+    'READ_POOL_TIMEOUT': 0.5,
+    # Per-user recommendation lists kept in memory (recommendations.py)
+    'RECOMMENDATION_CACHE_SIZE': 10000,
+}
 
-DB_NAME = "studymate.db"
-UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'avatars')
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+# Routes are collected here and added to each app by create_app(), keeping
+# their plain endpoint names (url_for('home'))
+_routes = []
 
-# --- Initialize Database ---
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
+def route(rule, **options):
+    def decorator(view):
+        _routes.append((rule, view, options))
+        return view
+    return decorator
 
-    # Drop tables if needed (optional during development)
-    # c.execute("DROP TABLE IF EXISTS willingness")
-    # c.execute("DROP TABLE IF EXISTS topics")
-    # c.execute("DROP TABLE IF EXISTS users")
+# Background workers, built by create_app(). Their threads and connections
+# start on first use, so under a prefork server each worker opens its own.
+notifier = None
+writer = None
+recommender = None
 
-    # Create users table
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL,
-            profession TEXT NOT NULL,
-            name TEXT NOT NULL
-        )
-    """)
+def create_app(config=None):
+    """Build the app: config, schema migration, sessions, routes."""
+    global notifier, writer, recommender
+    app = Flask(__name__)
+    app.config.from_mapping(DEFAULT_CONFIG)
+    app.config.from_prefixed_env('STUDYMATE')
+    app.config.update(config or {})
+    db_path = app.config['DATABASE']
 
-    # Create topics table
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS topics (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            title TEXT NOT NULL,
-            description TEXT NOT NULL,
-            duration TEXT NOT NULL,
-            created_by INTEGER NOT NULL,
-            created_at TIMESTAMP,
-            scheduled_datetime TEXT,
-            FOREIGN KEY (created_by) REFERENCES users(id)
-        )
-    """)
+    if app.config['MIGRATE_ON_START']:
+        migrate_once(db_path)
+
+    app.teardown_appcontext(close_db)
+    # Read routes use get_read_db(); writes keep their own connections (get_db(), transaction())
+    app.extensions['reader_pool'] = ReaderPool(db_path, app.config['READ_POOL_SIZE'], app.config['READ_POOL_TIMEOUT'])
+    # The cookie carries only a session id; session data lives in the sessions table
+    app.session_interface = SessionInterface(SqliteStore(db_path, app.config['SESSION_CACHE_SIZE']))
+    # Wall time per endpoint; SQL tracing on a sampled fraction of requests
+    profiling.init_app(app)
+    app.add_template_filter(format_ts, 'timestamp')
+
+    # Notification fan-out runs on a background thread; endpoints only enqueue
+    notifier = NotificationWorker(db_path)
+    writer = GroupCommitWriter(db_path, app.config['GROUP_COMMIT_WINDOW'], app.config['GROUP_COMMIT_MAX_BATCH'])
+    # Built on the first /api/recommendations request, then kept current from the change log
+    recommender = Recommender(db_path, app.config['RECOMMENDATION_CACHE_SIZE'])
+
+    for rule, view, options in _routes:
+        app.add_url_rule(rule, view_func=view, **options)
+    from routes.profile import profile_bp
+    app.register_blueprint(profile_bp)
+    return app
+
+def _read_pool_stat(key):
+    return lambda: current_app.extensions['reader_pool'].stats()[key]
 
-    # Ensure optional category column exists on topics
+for _key, _help in [('size', 'Reader pool capacity.'),
+                    ('open', 'Pooled read-only connections opened.'),
+                    ('in_use', 'Read connections checked out right now.'),
+                    ('checkouts', 'Read connection checkouts since start.'),
+                    ('waits', 'Checkouts that found every pooled connection busy.'),
+                    ('wait_seconds', 'Total time checkouts spent waiting.'),
+                    ('overflows', 'Checkouts that timed out and got a temporary connection.')]:
+    profiling.register_gauge(f'studymate_read_pool_{_key}', _help, _read_pool_stat(_key))
+
+# --- Dashboard data loaders ---
+WILLING_USERS_SQL = """
+    SELECT w.topic_id, u.name, u.username
+    FROM willingness w
+    JOIN users u ON w.user_id = u.id
+    WHERE w.topic_id IN (SELECT value FROM json_each(?))
+"""
+
+TOPIC_RATINGS_SQL = """
+    SELECT r.topic_id, u.name, r.rating, IFNULL(r.feedback, ''), r.created_at
+    FROM ratings r
+    JOIN users u ON r.user_id = u.id
+    WHERE r.topic_id IN (SELECT value FROM json_each(?))
+    ORDER BY r.topic_id, r.created_at DESC
+"""
+
+# my_topics structure: [id, title, description, duration, created_by, created_at, scheduled_datetime, willingness_count, category, avg_rating, ratings_count]
+MY_TOPICS_SQL = """
+    SELECT t.id, t.title, t.description, t.duration, t.created_by, t.created_at, t.scheduled_datetime,
+           IFNULL(s.willingness_count, 0) as willingness_count,
+           IFNULL(t.category, ''),
+           s.avg_rating,
+           IFNULL(s.rating_count, 0) as ratings_count
+    FROM topics t
+    LEFT JOIN topic_stats s ON t.id = s.topic_id
+    WHERE t.created_by = ?
+    ORDER BY t.created_at DESC
+"""
+
+# joined_topics structure: [id, title, description, duration, created_by, created_at, scheduled_datetime, willingness_count, author name, category, avg_rating, ratings_count]
+JOINED_TOPICS_SQL = """
+    SELECT t.id, t.title, t.description, t.duration, t.created_by, t.created_at, t.scheduled_datetime,
+           IFNULL(s.willingness_count, 0) as willingness_count,
+           u.name,
+           IFNULL(t.category, ''),
+           s.avg_rating,
+           IFNULL(s.rating_count, 0) as ratings_count
+    FROM topics t
+    LEFT JOIN users u ON t.created_by = u.id
+    LEFT JOIN topic_stats s ON t.id = s.topic_id
+    WHERE t.id IN (
+        SELECT topic_id FROM willingness WHERE user_id = ?
+    )
+    ORDER BY t.created_at DESC
+"""
+
+def load_dashboard_details(c, my_topic_ids, joined_topic_ids):
+    """Load willing users and ratings for the dashboard topics.
+
+    Uses a fixed number of queries regardless of how many topics the user
+    owns or has joined; the topic ids are passed as a single JSON array and
+    the rows are grouped per topic in Python.
+    Returns (willing_users, topic_ratings, joined_topic_ratings).
+    """
+    willing_users = {topic_id: [] for topic_id in my_topic_ids}
+    ratings_by_topic = {topic_id: [] for topic_id in list(my_topic_ids) + list(joined_topic_ids)}
+
+    if willing_users:
+        c.execute(WILLING_USERS_SQL, (json.dumps(list(willing_users)),))
+        for topic_id, name, username in c.fetchall():
+            willing_users[topic_id].append({'name': name, 'email': username})
+
+    if ratings_by_topic:
+        c.execute(TOPIC_RATINGS_SQL, (json.dumps(list(ratings_by_topic)),))
+        for topic_id, name, rating, feedback, created_at in c.fetchall():
+            ratings_by_topic[topic_id].append({
+                'name': name,
+                'rating': rating,
+                'feedback': feedback,
+                'when': format_ts(created_at)
+            })
+
+    topic_ratings = {topic_id: ratings_by_topic[topic_id] for topic_id in my_topic_ids}
+    joined_topic_ratings = {topic_id: ratings_by_topic[topic_id] for topic_id in joined_topic_ids}
+    return willing_users, topic_ratings, joined_topic_ratings
+
+# --- Topic feed ---
+FEED_PAGE_SIZE = 20
+
+def encode_feed_cursor(created_at, topic_id):
+    raw = json.dumps([created_at, topic_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_feed_cursor(cursor):
+    """Decode an opaque feed cursor into (created_at, topic_id); raises ValueError."""
     try:
-        c.execute("PRAGMA table_info(topics)")
-        cols = [row[1] for row in c.fetchall()]
-        if 'category' not in cols:
-            c.execute("ALTER TABLE topics ADD COLUMN category TEXT")
-    except Exception:
-        pass
-
-    # Create willingness table to track users willing to join topics
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS willingness (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            topic_id INTEGER NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id),
-            FOREIGN KEY (topic_id) REFERENCES topics(id),
-            UNIQUE(user_id, topic_id)
-        )
-    """)
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, topic_id = json.loads(raw)
+    except (TypeError, ValueError, binascii.Error):
+        raise ValueError('Invalid cursor')
+    if not isinstance(topic_id, int) or not (created_at is None or isinstance(created_at, str)):
+        raise ValueError('Invalid cursor')
+    return created_at, topic_id
 
-    # Create ratings table (0..5, 0.5 steps allowed)
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS ratings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            topic_id INTEGER NOT NULL,
-            rating REAL NOT NULL CHECK (rating >= 0 AND rating <= 5),
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id),
-            FOREIGN KEY (topic_id) REFERENCES topics(id),
-            UNIQUE(user_id, topic_id)
-        )
-    """)
+def _format_feed_topic(topic, now):
+    """Format one raw feed row for display and append its can_feedback flag."""
+    topic_list = list(topic)
+    
+    if topic_list[5]:  # created_at exists
+        topic_list[5] = format_ts(topic_list[5])
+    
+    # Format scheduled_datetime and check if date has passed
+    can_feedback = True  # Default: can give feedback if no scheduled date
+    if topic_list[6]:  # scheduled_datetime exists
+        scheduled_dt = parse_ts(topic_list[6])
+        topic_list[6] = format_ts(topic_list[6], 'long')
+        if scheduled_dt:
+            can_feedback = now >= scheduled_dt
+    
+    # Normalize rating fields (avg may be None)
+    if topic_list[11] is None:
+        topic_list[11] = 0.0
+    
+    # Add can_feedback flag (append to topic_list)
+    topic_list.append(can_feedback)
+    return tuple(topic_list)
+
+def topic_filters(category=None, scheduled=None):
+    """WHERE fragments and params for the category/scheduled filters of the feed and search."""
+    filters, params = [], []
+    if category:
+        filters.append("t.category = ?")
+        params.append(category)
+    if scheduled is True:
+        filters.append("t.scheduled_datetime IS NOT NULL")
+    elif scheduled is False:
+        filters.append("t.scheduled_datetime IS NULL")
+    return filters, params
+
+def feed_range_query(position, position_params, category=None, scheduled=None, limit=FEED_PAGE_SIZE + 1):
+    """SQL and parameters reading up to limit feed rows from one created_at range (see fetch_feed_page)."""
+    # rows structure: [id, title, description, duration, created_by, created_at, scheduled_datetime, username, name, willingness_count, category, avg_rating, ratings_count, version]
+    filters, filter_params = topic_filters(category, scheduled)
+    sql = f"""
+        SELECT t.id, t.title, t.description, t.duration, t.created_by, t.created_at,
+               t.scheduled_datetime, u.username, u.name,
+               IFNULL(s.willingness_count, 0) as willingness_count,
+               IFNULL(t.category, ''),
+               s.avg_rating,
+               IFNULL(s.rating_count, 0) as ratings_count,
+               IFNULL(s.version, 0)
+        FROM topics t
+        LEFT JOIN users u ON t.created_by = u.id
+        LEFT JOIN topic_stats s ON t.id = s.topic_id
+        WHERE {" AND ".join([position] + filters)}
+        ORDER BY t.created_at DESC, t.id DESC
+        LIMIT ?
+    """
+    return sql, list(position_params) + filter_params + [limit]
+
+def fetch_feed_page(c, cursor=None, category=None, scheduled=None, limit=FEED_PAGE_SIZE):
+    """Fetch one page of the global topic feed, newest first.
+
+    Keyset pagination on (created_at, id): cursor is the decoded position of
+    the last row of the previous page, so every page costs one index range
+    read no matter how deep it is. scheduled=True/False restricts to topics
+    with/without a session date. Returns (topics, next_cursor, versions),
+    versions mapping topic id to its topic_stats version.
+    """
+    # Rows without a timestamp sort after every dated row, so they are read as
+    # a second range once the dated rows run out. Each range is an index seek.
+    ranges = []
+    if cursor is None:
+        ranges.append(("t.created_at IS NOT NULL", []))
+        ranges.append(("t.created_at IS NULL", []))
+    elif cursor[0] is not None:
+        ranges.append(("(t.created_at, t.id) < (?, ?)", list(cursor)))
+        ranges.append(("t.created_at IS NULL", []))
+    else:
+        ranges.append(("t.created_at IS NULL AND t.id < ?", [cursor[1]]))
+
+    rows = []
+    for position, position_params in ranges:
+        c.execute(*feed_range_query(position, position_params, category, scheduled, limit + 1 - len(rows)))
+        rows.extend(c.fetchall())
+        if len(rows) > limit:
+            break
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_feed_cursor(rows[-1][5], rows[-1][0])
+
+    now = datetime.now()
+    versions = {row[0]: row[13] for row in rows}
+    return [_format_feed_topic(row[:13], now) for row in rows], next_cursor, versions
+
+def feed_topic_json(topic, is_willing):
+    return {
+        'id': topic[0],
+        'title': topic[1],
+        'description': topic[2],
+        'duration': topic[3],
+        'created_by': topic[4],
+        'created_at': topic[5],
+        'scheduled_datetime': topic[6],
+        'author_username': topic[7],
+        'author_name': topic[8],
+        'willingness_count': topic[9],
+        'category': topic[10],
+        'avg_rating': topic[11],
+        'ratings_count': topic[12],
+        'can_feedback': topic[13],
+        'is_willing': is_willing
+    }
+
+# --- Feed cache ---
+# Feed pages and rendered cards are the same for every viewer. Keys carry the
+# 'feed' data version and each topic's version, so the write paths only bump
+# counters (bump_feed_version) and stale entries age out of the LRU.
+feed_page_cache = LRUCache(256)
+feed_card_cache = LRUCache(4096)
+profiling.register_gauge('studymate_feed_page_cache_hits', 'Feed page cache hits.', lambda: feed_page_cache.hits)
+profiling.register_gauge('studymate_feed_page_cache_misses', 'Feed page cache misses.', lambda: feed_page_cache.misses)
+profiling.register_gauge('studymate_feed_card_cache_hits', 'Feed card cache hits.', lambda: feed_card_cache.hits)
+profiling.register_gauge('studymate_feed_card_cache_misses', 'Feed card cache misses.', lambda: feed_card_cache.misses)
+
+def bump_feed_version(c, topic_id=None):
+    """Invalidate cached feed pages, and topic_id's cards if given. Call inside the write's transaction."""
+    if topic_id is not None:
+        c.execute("UPDATE topic_stats SET version = version + 1 WHERE topic_id = ?", (topic_id,))
+    bump_data_version(c, 'feed')
+
+def cached_feed_page(c, cursor=None, category=None, scheduled=None, limit=FEED_PAGE_SIZE):
+    """fetch_feed_page through feed_page_cache; a hit costs one version lookup."""
+    # can_feedback flips when a session's (minute-precision) start passes, so
+    # entries are also keyed by the current minute
+    minute = datetime.now().strftime('%Y-%m-%d %H:%M')
+    key = (data_version(c, 'feed'), minute, cursor, category, scheduled, limit)
+    page = feed_page_cache.get(key)
+    if page is None:
+        page = fetch_feed_page(c, cursor, category, scheduled, limit)
+        feed_page_cache.set(key, page)
+    return page
+
+def render_feed_cards(c, topics, versions, user, my_willingness):
+    """Assemble a feed page's card HTML from cached per-topic fragments.
+
+    Only the viewer's relation to a topic changes its card, so each card is
+    rendered at most once per topic version in one of three variants: 'owner'
+    (with the ratings feedback), 'willing' or 'open'.
+    """
+    cards, missing = {}, []
+    for topic in topics:
+        if topic[4] == user.get('id'):
+            variant = 'owner'
+        elif topic[0] in my_willingness:
+            variant = 'willing'
+        else:
+            variant = 'open'
+        # The row itself is part of the key, so counts shown on the card can never be stale
+        key = (topic, versions.get(topic[0], 0), variant)
+        html = feed_card_cache.get(key)
+        if html is None:
+            missing.append((topic, variant, key))
+        else:
+            cards[topic[0]] = html
+
+    if missing:
+        owner_ids = [topic[0] for topic, variant, _ in missing if variant == 'owner']
+        _, topic_ratings, _ = load_dashboard_details(c, owner_ids, [])
+        for topic, variant, key in missing:
+            html = Markup(render_template('_topic_cards.html',
+                                          user={'id': topic[4] if variant == 'owner' else None},
+                                          topics=[topic],
+                                          my_willingness=[topic[0]] if variant == 'willing' else [],
+                                          topic_ratings=topic_ratings))
+            feed_card_cache.set(key, html)
+            cards[topic[0]] = html
+
+    return Markup(''.join(cards[topic[0]] for topic in topics))
+
+# --- Topic search ---
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_OFFSET = 1000
+
+# Markers FTS5 puts around matched terms; swapped for <mark> after escaping
+MATCH_START, MATCH_END = '\x02', '\x03'
+
+def build_fts_query(text):
+    """Turn free text into an FTS5 query: every word must match, the last as a prefix.
+
+    Words are quoted, so user input can never form FTS5 syntax. Returns None
+    if the text contains no searchable words.
+    """
+    words = re.findall(r'\w+', text)
+    if not words:
+        return None
+    return ' '.join(f'"{word}"' for word in words) + '*'
+
+def _highlight(text):
+    escaped = str(escape(text or ''))
+    return Markup(escaped.replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>'))
+
+def search_query(query, category=None, scheduled=None, offset=0, limit=SEARCH_PAGE_SIZE + 1):
+    """SQL and parameters for up to limit search results from offset (see search_topics)."""
+    filters, filter_params = topic_filters(category, scheduled)
+    sql = f"""
+        SELECT t.id, t.title, t.description, t.duration, t.created_by, t.created_at,
+               t.scheduled_datetime, u.username, u.name,
+               IFNULL(s.willingness_count, 0) as willingness_count,
+               IFNULL(t.category, ''),
+               s.avg_rating,
+               IFNULL(s.rating_count, 0) as ratings_count,
+               highlight(topics_fts, 0, ?, ?),
+               snippet(topics_fts, 1, ?, ?, '…', 24)
+        FROM topics_fts f
+        JOIN topics t ON t.id = f.rowid
+        LEFT JOIN users u ON t.created_by = u.id
+        LEFT JOIN topic_stats s ON t.id = s.topic_id
+        WHERE {" AND ".join(["topics_fts MATCH ?"] + filters)}
+        ORDER BY f.rank
+        LIMIT ? OFFSET ?
+    """
+    return sql, [MATCH_START, MATCH_END, MATCH_START, MATCH_END, query] + filter_params + [limit, offset]
+
+def search_topics(c, query, category=None, scheduled=None, offset=0, limit=SEARCH_PAGE_SIZE):
+    """Full-text search over topics, best match first (BM25, title weighted highest).
+
+    Returns (topics, highlights, next_offset); topics have the same shape as
+    fetch_feed_page rows and highlights maps topic id to its marked-up title
+    and description snippet.
+    """
+    c.execute(*search_query(query, category, scheduled, offset, limit + 1))
+    rows = c.fetchall()
+
+    next_offset = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        if offset + limit <= SEARCH_MAX_OFFSET:
+            next_offset = offset + limit
+
+    now = datetime.now()
+    topics, highlights = [], {}
+    for row in rows:
+        topics.append(_format_feed_topic(row[:13], now))
+        highlights[row[0]] = {'title': _highlight(row[13]), 'snippet': _highlight(row[14])}
+    return topics, highlights, next_offset
+
+def _search_args():
+    """Parse the query string shared by /search and /api/search."""
+    q = request.args.get('q', '').strip()
+    category = request.args.get('category', '').strip() or None
+    scheduled = {'1': True, 'true': True, '0': False, 'false': False}.get(request.args.get('scheduled', '').lower())
+    offset = min(max(request.args.get('offset', 0, type=int), 0), SEARCH_MAX_OFFSET)
+    limit = min(max(request.args.get('limit', SEARCH_PAGE_SIZE, type=int), 1), 100)
+    return q, category, scheduled, offset, limit
+
+# --- Admin user directory ---
+DIRECTORY_PAGE_SIZE = 50
+MAX_DIRECTORY_PAGE_SIZE = 200
 
-    # Ensure feedback column exists on ratings
+# Sort key expression, id column and default direction for each directory
+# sort; every key has an index ending in the id (migration 15)
+DIRECTORY_SORTS = {
+    'posts': ('s.topics_created', 's.user_id', 'desc'),
+    'joins': ('s.topics_joined', 's.user_id', 'desc'),
+    'rating': ('IFNULL(s.ratings_received_sum / s.ratings_received_count, 0)', 's.user_id', 'desc'),
+    'name': ('u.name COLLATE NOCASE', 'u.id', 'asc'),
+}
+
+def encode_directory_cursor(key, user_id):
+    raw = json.dumps([key, user_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_directory_cursor(cursor):
+    """Decode an opaque directory cursor into (sort key, user id); raises ValueError."""
     try:
-        c.execute("PRAGMA table_info(ratings)")
-        rcols = [row[1] for row in c.fetchall()]
-        if 'feedback' not in rcols:
-            c.execute("ALTER TABLE ratings ADD COLUMN feedback TEXT")
-    except Exception:
-        pass
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        key, user_id = json.loads(raw)
+    except (TypeError, ValueError, binascii.Error):
+        raise ValueError('Invalid cursor')
+    if not isinstance(user_id, int) or isinstance(key, bool) or not isinstance(key, (int, float, str)):
+        raise ValueError('Invalid cursor')
+    return key, user_id
 
+def _like_prefix(prefix):
+    return prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
 
-    # Create messages table
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            sender_id INTEGER NOT NULL,
-            receiver_id INTEGER NOT NULL,
-            topic_id INTEGER,
-            subject TEXT,
-            message TEXT NOT NULL,
-            is_read BOOLEAN DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (sender_id) REFERENCES users(id),
-            FOREIGN KEY (receiver_id) REFERENCES users(id)
-        )
-    """)
+def directory_query(sort='posts', order=None, prefix=None, cursor=None, limit=DIRECTORY_PAGE_SIZE + 1):
+    """SQL and parameters for up to limit directory rows after cursor (see fetch_user_directory)."""
+    # rows structure: [id, username, profession, name, topics_created, suspended_at, topics_joined, avg_rating, ratings_count, sort key]
+    key, id_column, default_order = DIRECTORY_SORTS[sort]
+    descending = (order or default_order) == 'desc'
+    op = '<' if descending else '>'
+    direction = 'DESC' if descending else 'ASC'
+
+    filters, params = [], []
+    if prefix:
+        filters.append("(u.username LIKE ? ESCAPE '\\' OR u.name LIKE ? ESCAPE '\\')")
+        params += [_like_prefix(prefix)] * 2
+    if cursor is not None:
+        # Spelled out rather than as a row value so the index seek applies to the key
+        filters.append(f"{key} {op}= ? AND ({key} {op} ? OR {id_column} {op} ?)")
+        params += [cursor[0], cursor[0], cursor[1]]
+
+    sql = f"""
+        SELECT u.id, u.username, u.profession, u.name, s.topics_created, u.suspended_at,
+               s.topics_joined, ROUND({DIRECTORY_SORTS['rating'][0]}, 2), s.ratings_received_count,
+               {key}
+        FROM users u
+        JOIN user_stats s ON s.user_id = u.id
+        {"WHERE " + " AND ".join(filters) if filters else ""}
+        ORDER BY {key} {direction}, {id_column} {direction}
+        LIMIT ?
+    """
+    return sql, params + [limit]
+
+def fetch_user_directory(c, sort='posts', order=None, prefix=None, cursor=None, limit=DIRECTORY_PAGE_SIZE):
+    """One keyset page of the admin user directory; returns (users, next_cursor).
+
+    Counts come from user_stats, so a page reads limit + 1 rows along the
+    sort's index instead of aggregating every user's topics. prefix matches
+    the start of the username or name, case-insensitively.
+    """
+    # users structure: [id, username, profession, name, topics_created, suspended_at, topics_joined, avg_rating, ratings_count]
+    c.execute(*directory_query(sort, order, prefix, cursor, limit + 1))
+    rows = c.fetchall()
 
-    conn.commit()
-    conn.close()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_directory_cursor(rows[-1][9], rows[-1][0])
+    return [row[:9] for row in rows], next_cursor
 
 # --- Routes ---
 
-@app.route('/')
+@route('/')
 def landing():
     return render_template('landing.html')
 
-@app.route('/home')
+@route('/home')
 def home():
-    if 'user' not in session:
+    user = current_user()
+    if user is None:
         return redirect(url_for('landing'))
-
-    user = session['user']
     
     # Check if admin user
     if user.get('is_admin'):
         return redirect(url_for('admin_home'))
     
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_read_db()
     c = conn.cursor()
     
-    # Get all topics with willingness, rating aggregates and scheduled date
-    # topics structure: [id, title, description, duration, created_by, created_at, scheduled_datetime, username, name, willingness_count, category, avg_rating, ratings_count]
-    c.execute("""
-        SELECT t.id, t.title, t.description, t.duration, t.created_by, t.created_at,
-               t.scheduled_datetime, u.username, u.name,
-               COUNT(DISTINCT w.id) as willingness_count,
-               IFNULL(t.category, ''),
-               ROUND(AVG(r.rating), 2) as avg_rating,
-               COUNT(r.id) as ratings_count
-        FROM topics t
-        LEFT JOIN users u ON t.created_by = u.id
-        LEFT JOIN willingness w ON t.id = w.topic_id
-        LEFT JOIN ratings r ON t.id = r.topic_id
-        GROUP BY t.id
-        ORDER BY t.created_at DESC
-    """)
-    raw_topics = c.fetchall()
-    
-    # Format created_at and scheduled_datetime to 12-hour format
-    topics = []
-    now = datetime.now()
-    for topic in raw_topics:
-        topic_list = list(topic)
-        original_scheduled = topic_list[6]  # Keep original for date check
-        
-        if topic_list[5]:  # created_at exists
-            try:
-                # Try different formats
-                for fmt in ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d']:
-                    try:
-                        dt = datetime.strptime(str(topic_list[5]), fmt)
-                        topic_list[5] = dt.strftime('%b %d at %I:%M %p')
-                        break
-                    except ValueError:
-                        continue
-            except:
-                topic_list[5] = str(topic_list[5])
-        
-        # Format scheduled_datetime and check if date has passed
-        can_feedback = True  # Default: can give feedback if no scheduled date
-        if topic_list[6]:  # scheduled_datetime exists
-            try:
-                # Try different formats
-                for fmt in ['%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M']:
-                    try:
-                        dt = datetime.strptime(str(topic_list[6]), fmt)
-                        topic_list[6] = dt.strftime('%b %d, %Y at %I:%M %p')
-                        # Check if scheduled date has passed
-                        can_feedback = now >= dt
-                        break
-                    except ValueError:
-                        continue
-            except:
-                topic_list[6] = str(topic_list[6])
-        
-        # Normalize rating fields (avg may be None)
-        if topic_list[11] is None:
-            topic_list[11] = 0.0
-        
-        # Add can_feedback flag (append to topic_list)
-        topic_list.append(can_feedback)
-        topics.append(tuple(topic_list))
+    # Every topic, willingness and rating write bumps the 'feed' version; the
+    # only other input is which sessions have started (feedback opens then)
+    c.execute("SELECT MAX(scheduled_datetime) FROM topics WHERE scheduled_datetime <= ?", (now_ts(),))
+    last_started = c.fetchone()[0]
+    etag, not_modified = check_etag('home', user, data_version(c, 'feed'), last_started)
+    if not_modified:
+        return not_modified
+    
+    # First page of the global feed (shared cache); further pages come from /api/topics
+    topics, next_cursor, versions = cached_feed_page(c)
     
     # Get user's topics with willingness count and ratings
-    # my_topics structure: [id, title, description, duration, created_by, created_at, scheduled_datetime, willingness_count, category, avg_rating, ratings_count]
-    c.execute("""
-        SELECT t.id, t.title, t.description, t.duration, t.created_by, t.created_at, t.scheduled_datetime,
-               COUNT(DISTINCT w.id) as willingness_count,
-               IFNULL(t.category, ''),
-               ROUND(AVG(r.rating), 2) as avg_rating,
-               COUNT(r.id) as ratings_count
-        FROM topics t
-        LEFT JOIN willingness w ON t.id = w.topic_id
-        LEFT JOIN ratings r ON t.id = r.topic_id
-        WHERE t.created_by = ?
-        GROUP BY t.id
-        ORDER BY t.created_at DESC
-    """, (user['id'],))
+    c.execute(MY_TOPICS_SQL, (user['id'],))
     raw_my_topics = c.fetchall()
     
     # Format my_topics timestamps
@@ -220,29 +573,11 @@ def home():
     for topic in raw_my_topics:
         topic_list = list(topic)
         if topic_list[5]:  # created_at exists
-            try:
-                for fmt in ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d']:
-                    try:
-                        dt = datetime.strptime(str(topic_list[5]), fmt)
-                        topic_list[5] = dt.strftime('%b %d at %I:%M %p')
-                        break
-                    except ValueError:
-                        continue
-            except:
-                topic_list[5] = str(topic_list[5])
+            topic_list[5] = format_ts(topic_list[5])
         
         # Format scheduled_datetime
         if topic_list[6]:
-            try:
-                for fmt in ['%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M']:
-                    try:
-                        dt = datetime.strptime(str(topic_list[6]), fmt)
-                        topic_list[6] = dt.strftime('%b %d, %Y at %I:%M %p')
-                        break
-                    except ValueError:
-                        continue
-            except:
-                topic_list[6] = str(topic_list[6])
+            topic_list[6] = format_ts(topic_list[6], 'long')
         
         # Normalize rating fields
         if topic_list[9] is None:
@@ -253,66 +588,8 @@ def home():
     c.execute("SELECT topic_id FROM willingness WHERE user_id = ?", (user['id'],))
     my_willingness = [row[0] for row in c.fetchall()]
     
-    # Get list of willing users for each topic
-    willing_users = {}
-    # Get list of ratings + feedback for each topic
-    topic_ratings = {}
-    for topic in my_topics:
-        # Willing users
-        c.execute("""
-            SELECT u.name, u.username
-            FROM willingness w
-            JOIN users u ON w.user_id = u.id
-            WHERE w.topic_id = ?
-        """, (topic[0],))
-        willing_users[topic[0]] = [{'name': row[0], 'email': row[1]} for row in c.fetchall()]
-
-        # Ratings and feedback
-        c.execute("""
-            SELECT u.name, r.rating, IFNULL(r.feedback, ''), r.created_at
-            FROM ratings r
-            JOIN users u ON r.user_id = u.id
-            WHERE r.topic_id = ?
-            ORDER BY r.created_at DESC
-        """, (topic[0],))
-        rows = c.fetchall()
-        # Format created_at to readable 12-hour time
-        formatted = []
-        for name, rating, feedback, created_at in rows:
-            ts = str(created_at) if created_at is not None else ''
-            try:
-                dt = None
-                for fmt in ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d']:
-                    try:
-                        from datetime import datetime as _dt
-                        dt = _dt.strptime(ts, fmt)
-                        break
-                    except ValueError:
-                        continue
-                created_str = dt.strftime('%b %d at %I:%M %p') if dt else ts
-            except Exception:
-                created_str = ts
-            formatted.append({'name': name, 'rating': rating, 'feedback': feedback, 'when': created_str})
-        topic_ratings[topic[0]] = formatted
-    
     # Get user's joined classes (topics where user is willing)
-    c.execute("""
-        SELECT t.id, t.title, t.description, t.duration, t.created_by, t.created_at, t.scheduled_datetime,
-               COUNT(DISTINCT w.id) as willingness_count,
-               u.name,
-               IFNULL(t.category, ''),
-               ROUND(AVG(r.rating), 2) as avg_rating,
-               COUNT(r.id) as ratings_count
-        FROM topics t
-        LEFT JOIN users u ON t.created_by = u.id
-        LEFT JOIN willingness w ON t.id = w.topic_id
-        LEFT JOIN ratings r ON t.id = r.topic_id
-        WHERE t.id IN (
-            SELECT topic_id FROM willingness WHERE user_id = ?
-        )
-        GROUP BY t.id
-        ORDER BY t.created_at DESC
-    """, (user['id'],))
+    c.execute(JOINED_TOPICS_SQL, (user['id'],))
     raw_joined_topics = c.fetchall()
     
     # Format joined_topics timestamps
@@ -320,127 +597,283 @@ def home():
     for topic in raw_joined_topics:
         topic_list = list(topic)
         if topic_list[5]:  # created_at exists
-            try:
-                for fmt in ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d']:
-                    try:
-                        dt = datetime.strptime(str(topic_list[5]), fmt)
-                        topic_list[5] = dt.strftime('%b %d at %I:%M %p')
-                        break
-                    except ValueError:
-                        continue
-            except:
-                topic_list[5] = str(topic_list[5])
+            topic_list[5] = format_ts(topic_list[5])
         
         # Format scheduled_datetime
         if topic_list[6]:
-            try:
-                for fmt in ['%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M']:
-                    try:
-                        dt = datetime.strptime(str(topic_list[6]), fmt)
-                        topic_list[6] = dt.strftime('%b %d, %Y at %I:%M %p')
-                        break
-                    except ValueError:
-                        continue
-            except:
-                topic_list[6] = str(topic_list[6])
+            topic_list[6] = format_ts(topic_list[6], 'long')
         
         # Normalize rating fields
         if topic_list[10] is None:
             topic_list[10] = 0.0
         joined_topics.append(tuple(topic_list))
     
-    # Get ratings for joined topics
-    joined_topic_ratings = {}
-    for topic in joined_topics:
-        c.execute("""
-            SELECT u.name, r.rating, IFNULL(r.feedback, ''), r.created_at
-            FROM ratings r
-            JOIN users u ON r.user_id = u.id
-            WHERE r.topic_id = ?
-            ORDER BY r.created_at DESC
-        """, (topic[0],))
-        rows = c.fetchall()
-        formatted = []
-        for name, rating, feedback, created_at in rows:
-            ts = str(created_at) if created_at is not None else ''
-            try:
-                dt = None
-                for fmt in ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d']:
-                    try:
-                        from datetime import datetime as _dt
-                        dt = _dt.strptime(ts, fmt)
-                        break
-                    except ValueError:
-                        continue
-                created_str = dt.strftime('%b %d at %I:%M %p') if dt else ts
-            except Exception:
-                created_str = ts
-            formatted.append({'name': name, 'rating': rating, 'feedback': feedback, 'when': created_str})
-        joined_topic_ratings[topic[0]] = formatted
-    # Map of user ratings for quick lookup
-    c = None
-    conn.close()
-
-    return render_template('home.html',
+    # Willing users and ratings for owned + joined topics, fetched in batch
+    willing_users, topic_ratings, joined_topic_ratings = load_dashboard_details(
+        c, [t[0] for t in my_topics], [t[0] for t in joined_topics])
+
+    # Per-user willing/owner state is layered onto the shared cards here
+    feed_cards = render_feed_cards(c, topics, versions, user, set(my_willingness))
+
+    return with_etag(make_response(render_template('home.html',
                            user=user,
                            topics=topics,
+                           feed_cards=feed_cards,
                            my_topics=my_topics,
                            my_willingness=my_willingness,
                            willing_users=willing_users,
                            topic_ratings=topic_ratings,
                            joined_topics=joined_topics,
-                           joined_topic_ratings=joined_topic_ratings)
+                           joined_topic_ratings=joined_topic_ratings,
+                           next_cursor=next_cursor)), etag)
 
-@app.route('/admin_home')
-def admin_home():
-    if 'user' not in session or not session['user'].get('is_admin'):
+@route('/api/topics')
+def api_topics():
+    user = current_user()
+    if user is None:
+        return jsonify({'error': 'Not logged in'}), 401
+    cursor = request.args.get('cursor')
+    try:
+        cursor = decode_feed_cursor(cursor) if cursor else None
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+
+    category = request.args.get('category', '').strip() or None
+    scheduled = {'1': True, 'true': True, '0': False, 'false': False}.get(request.args.get('scheduled', '').lower())
+    limit = min(max(request.args.get('limit', FEED_PAGE_SIZE, type=int), 1), 100)
+
+    c = get_read_db().cursor()
+    topics, next_cursor, versions = cached_feed_page(c, cursor, category, scheduled, limit)
+
+    # Per-user state for just this page
+    topic_ids = [topic[0] for topic in topics]
+    c.execute("""
+        SELECT topic_id FROM willingness
+        WHERE user_id = ? AND topic_id IN (SELECT value FROM json_each(?))
+    """, (user.get('id'), json.dumps(topic_ids)))
+    my_willingness = {row[0] for row in c.fetchall()}
+
+    html = render_feed_cards(c, topics, versions, user, my_willingness)
+    return jsonify({
+        'topics': [feed_topic_json(topic, topic[0] in my_willingness) for topic in topics],
+        'next_cursor': next_cursor,
+        'html': html
+    })
+
+@route('/search')
+def search():
+    user = current_user()
+    if user is None:
         return redirect(url_for('landing'))
-    
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    
-    # Get all users with their post count
+
+    q, category, scheduled, offset, limit = _search_args()
+    topics, highlights, next_offset = [], {}, None
+    fts_query = build_fts_query(q)
+    if fts_query:
+        topics, highlights, next_offset = search_topics(get_read_db().cursor(), fts_query, category, scheduled, offset, limit)
+
+    return render_template('search.html',
+                           user=user,
+                           q=q,
+                           category=category or '',
+                           scheduled=request.args.get('scheduled', ''),
+                           topics=topics,
+                           highlights=highlights,
+                           prev_offset=max(offset - limit, 0) if offset else None,
+                           next_offset=next_offset)
+
+@route('/api/search')
+def api_search():
+    user = current_user()
+    if user is None:
+        return jsonify({'error': 'Not logged in'}), 401
+    q, category, scheduled, offset, limit = _search_args()
+    fts_query = build_fts_query(q)
+    if not fts_query:
+        return jsonify({'topics': [], 'next_offset': None, 'html': ''})
+
+    c = get_read_db().cursor()
+    topics, highlights, next_offset = search_topics(c, fts_query, category, scheduled, offset, limit)
+
+    topic_ids = [topic[0] for topic in topics]
     c.execute("""
-        SELECT u.id, u.username, u.profession, u.name, COUNT(t.id) as post_count
-        FROM users u
-        LEFT JOIN topics t ON u.id = t.created_by
-        GROUP BY u.id
-        ORDER BY post_count DESC
-    """)
-    users = c.fetchall()
+        SELECT topic_id FROM willingness
+        WHERE user_id = ? AND topic_id IN (SELECT value FROM json_each(?))
+    """, (user.get('id'), json.dumps(topic_ids)))
+    my_willingness = [row[0] for row in c.fetchall()]
+    own_ids = [topic[0] for topic in topics if topic[4] == user.get('id')]
+    _, topic_ratings, _ = load_dashboard_details(c, own_ids, [])
+
+    html = render_template('_topic_cards.html',
+                           user=user,
+                           topics=topics,
+                           my_willingness=my_willingness,
+                           topic_ratings=topic_ratings)
+    results = []
+    for topic in topics:
+        result = feed_topic_json(topic, topic[0] in my_willingness)
+        result['title_html'] = str(highlights[topic[0]]['title'])
+        result['snippet_html'] = str(highlights[topic[0]]['snippet'])
+        results.append(result)
+    return jsonify({'topics': results, 'next_offset': next_offset, 'html': html})
+
+# --- Recommendations ---
+
+RECOMMENDATION_PAGE_SIZE = 10
+
+# Candidate topics still on offer to the user, in feed row shape
+RECOMMENDED_TOPICS_SQL = """
+    SELECT t.id, t.title, t.description, t.duration, t.created_by, t.created_at,
+           t.scheduled_datetime, u.username, u.name,
+           IFNULL(s.willingness_count, 0), IFNULL(t.category, ''),
+           s.avg_rating, IFNULL(s.rating_count, 0)
+    FROM topics t
+    LEFT JOIN users u ON t.created_by = u.id
+    LEFT JOIN topic_stats s ON t.id = s.topic_id
+    WHERE t.id IN (SELECT value FROM json_each(?))
+      AND IFNULL(t.created_by, 0) != ?
+      AND (t.scheduled_datetime IS NULL OR t.scheduled_datetime >= ?)
+      AND NOT EXISTS (SELECT 1 FROM willingness w WHERE w.user_id = ? AND w.topic_id = t.id)
+"""
+
+profiling.register_gauge('studymate_recommendation_builds', 'Full builds of the recommendation model.',
+                         lambda: recommender.builds)
+profiling.register_gauge('studymate_recommendation_changes_applied', 'Willingness and rating changes applied incrementally.',
+                         lambda: recommender.changes_applied)
+profiling.register_gauge('studymate_recommendation_cache_hits', 'Recommendation cache hits.', lambda: recommender.cache.hits)
+profiling.register_gauge('studymate_recommendation_cache_misses', 'Recommendation cache misses.',
+                         lambda: recommender.cache.misses)
+
+@route('/api/recommendations')
+def api_recommendations():
+    """Topics recommended for the logged-in user, best first."""
+    user = current_user()
+    if user is None:
+        return jsonify({'error': 'Not logged in'}), 401
+    if user.get('is_admin'):
+        return jsonify({'topics': []})
+    limit = min(max(request.args.get('limit', RECOMMENDATION_PAGE_SIZE, type=int), 1), 20)
+
+    conn = get_read_db()
+    try:
+        scores = dict(recommender.recommend(conn, user['id']))
+    except ImportError:
+        return jsonify({'error': 'Recommendations are not available'}), 503
+
+    # The candidates are cached; drop topics that were deleted, have taken
+    # place or were joined since, and the user's own
+    c = conn.cursor()
+    c.execute(RECOMMENDED_TOPICS_SQL, (json.dumps(list(scores)), user['id'], now_ts(), user['id']))
+    now = datetime.now()
+    topics = sorted((_format_feed_topic(row, now) for row in c.fetchall()), key=lambda topic: -scores[topic[0]])
+    return jsonify({'topics': [dict(feed_topic_json(topic, False), score=scores[topic[0]])
+                               for topic in topics[:limit]]})
+
+@route('/admin_home')
+def admin_home():
+    user = current_user()
+    if user is None or not user.get('is_admin'):
+        return redirect(url_for('landing'))
     
-    conn.close()
+    # First directory page; search, sorting and paging go through /api/admin/users
+    users, next_cursor = fetch_user_directory(get_read_db().cursor())
     
-    return render_template('admin_home.html', users=users)
+    return render_template('admin_home.html', users=users, next_cursor=next_cursor,
+                           sorts=list(DIRECTORY_SORTS))
+
+@route('/api/admin/users')
+def api_admin_users():
+    """Admin user directory: ?q=<prefix>&sort=posts|joins|rating|name&order=asc|desc&cursor=&limit="""
+    user = current_user()
+    if user is None or not user.get('is_admin'):
+        return jsonify({'error': 'Forbidden'}), 403
 
-@app.route('/admin_delete_user/<int:user_id>', methods=['POST'])
+    sort = request.args.get('sort', 'posts')
+    order = request.args.get('order') or None
+    if sort not in DIRECTORY_SORTS or order not in (None, 'asc', 'desc'):
+        return jsonify({'error': 'Unknown sort'}), 400
+    try:
+        cursor = decode_directory_cursor(request.args['cursor']) if request.args.get('cursor') else None
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    limit = min(max(request.args.get('limit', DIRECTORY_PAGE_SIZE, type=int) or DIRECTORY_PAGE_SIZE, 1),
+                MAX_DIRECTORY_PAGE_SIZE)
+    prefix = request.args.get('q', '').strip()[:100] or None
+
+    users, next_cursor = fetch_user_directory(get_read_db().cursor(), sort, order, prefix, cursor, limit)
+    return jsonify({
+        'users': [{
+            'id': user[0],
+            'username': user[1],
+            'profession': user[2],
+            'name': user[3],
+            'topics_created': user[4],
+            'suspended': user[5] is not None,
+            'topics_joined': user[6],
+            'avg_rating': user[7],
+            'ratings_count': user[8]
+        } for user in users],
+        'next_cursor': next_cursor,
+        'html': render_template('_admin_user_rows.html', users=users)
+    })
+
+@route('/admin_delete_user/<int:user_id>', methods=['POST'])
 def admin_delete_user(user_id):
-    if 'user' not in session or not session['user'].get('is_admin'):
+    user = current_user()
+    if user is None or not user.get('is_admin'):
         return redirect(url_for('landing'))
     
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    
-    # Delete user's willingness entries
-    c.execute("DELETE FROM willingness WHERE user_id = ?", (user_id,))
-    # Delete user's topics and their willingness
-    c.execute("SELECT id FROM topics WHERE created_by = ?", (user_id,))
-    topic_ids = [row[0] for row in c.fetchall()]
-    
-    for topic_id in topic_ids:
-        c.execute("DELETE FROM willingness WHERE topic_id = ?", (topic_id,))
-    
-    # Delete user's topics
-    c.execute("DELETE FROM topics WHERE created_by = ?", (user_id,))
-    # Delete user
-    c.execute("DELETE FROM users WHERE id = ?", (user_id,))
-    
-    conn.commit()
-    conn.close()
+    # One set-based cascade: topics, willingness, ratings, messages and the rest
+    with transaction() as conn:
+        delete_users(conn, [user_id])
     
     return redirect(url_for('admin_home'))
 
-@app.route('/login', methods=['GET', 'POST'])
+BULK_ACTIONS = {
+    'users': ('delete', 'suspend', 'unsuspend'),
+    'topics': ('delete',),
+}
+
+@route('/admin/bulk', methods=['POST'])
+def admin_bulk():
+    """Delete or suspend a batch of users, or delete a batch of topics, in one transaction.
+
+    Body: {"target": "users" | "topics", "action": "delete" | "suspend" | "unsuspend", "ids": [...]}
+    """
+    user = current_user()
+    if user is None or not user.get('is_admin'):
+        return jsonify({'error': 'Forbidden'}), 403
+
+    data = request.get_json(silent=True) or {}
+    target, action, ids = data.get('target'), data.get('action'), data.get('ids')
+    if action not in BULK_ACTIONS.get(target, ()):
+        return jsonify({'error': 'Unknown target or action'}), 400
+    if not isinstance(ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+        return jsonify({'error': 'ids must be a list of integers'}), 400
+    if len(ids) > MAX_BATCH:
+        return jsonify({'error': f'At most {MAX_BATCH} ids per request'}), 400
+
+    ids = sorted(set(ids))
+    result = {'target': target, 'action': action}
+    with transaction() as conn:
+        if target == 'topics':
+            result['topics_deleted'] = delete_topics(conn, ids)
+        elif action == 'delete':
+            result['users_deleted'], result['topics_deleted'] = delete_users(conn, ids)
+        else:
+            result['users_changed'] = set_suspended(conn, ids, action == 'suspend')
+    return jsonify(result)
+
+@route('/admin/metrics')
+def admin_metrics():
+    """Request, SQL and cache metrics in Prometheus text format."""
+    user = current_user()
+    if user is None or not user.get('is_admin'):
+        return jsonify({'error': 'Forbidden'}), 403
+
+    return Response(profiling.render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         username = request.form['username']
@@ -448,33 +881,28 @@ def login():
 
         # Check for admin login
         if username == 'Admin' and password == 'Admin@123':
-            session['user'] = {
-                'is_admin': True,
-                'username': 'Admin'
-            }
+            session.rotate()
+            session['is_admin'] = True
             return redirect(url_for('admin_home'))
 
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        c.execute("SELECT * FROM users WHERE username=? AND password=?", (username, password))
+        c = get_read_db().cursor()
+        c.execute("SELECT id, suspended_at FROM users WHERE username=? AND password=?",
+                  (username, password))
         user = c.fetchone()
-        conn.close()
 
+        if user and user[1]:
+            return "❌ This account has been suspended"
         if user:
-            session['user'] = {
-                'id': user[0],
-                'username': user[1],
-                'password': user[2],
-                'profession': user[3],
-                'name': user[4]
-            }
+            # The session only holds the id; current_user() loads the rest
+            session.rotate()
+            session['user_id'] = user[0]
             return redirect(url_for('home'))
         else:
             return "❌ Invalid username or password"
 
     return render_template('login.html')
 
-@app.route('/register', methods=['GET', 'POST'])
+@route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
         username = request.form['username']
@@ -482,74 +910,124 @@ def register():
         profession = request.form['profession']
         name = request.form['name']
 
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
         try:
-            c.execute("INSERT INTO users (username, password, profession, name) VALUES (?, ?, ?, ?)", (username, password, profession, name))
-            conn.commit()
+            with transaction() as conn:
+                conn.execute("INSERT INTO users (username, password, profession, name) VALUES (?, ?, ?, ?)", (username, password, profession, name))
         except sqlite3.IntegrityError:
             return "⚠️ Username already exists"
-        finally:
-            conn.close()
 
         return redirect(url_for('login'))
 
     return render_template('register.html')
 
-@app.route('/post_topic', methods=['POST'])
+@route('/post_topic', methods=['POST'])
 def post_topic():
-    if 'user' not in session:
+    user = current_user()
+    if user is None:
         return redirect(url_for('landing'))
 
     title = request.form['title']
     description = request.form['description']
     duration = request.form['duration']
     category = request.form.get('category', '').strip()
-    user_id = session['user']['id']
+    user_id = user['id']
     
     # Get current local time
-    current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    current_time = now_ts()
 
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("INSERT INTO topics (title, description, duration, created_by, created_at, category) VALUES (?, ?, ?, ?, ?, ?)", 
-              (title, description, duration, user_id, current_time, category))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute("INSERT INTO topics (title, description, duration, created_by, created_at, category) VALUES (?, ?, ?, ?, ?, ?)", 
+                     (title, description, duration, user_id, current_time, category))
+        bump_feed_version(conn)
 
     return redirect(url_for('home'))
 
-@app.route('/schedule_session/<int:topic_id>', methods=['POST'])
+@route('/schedule_session/<int:topic_id>', methods=['POST'])
 def schedule_session(topic_id):
-    if 'user' not in session:
+    user = current_user()
+    if user is None:
         return jsonify({'error': 'Not logged in'}), 401
 
-    user_id = session['user']['id']
-    scheduled_datetime = request.form['scheduled_datetime']
+    user_id = user['id']
+    scheduled_datetime = normalize_ts(request.form['scheduled_datetime'])
+    if not scheduled_datetime:
+        return jsonify({'error': 'Invalid date'}), 400
 
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    
-    # Check if user owns the topic
-    c.execute("SELECT created_by FROM topics WHERE id = ?", (topic_id,))
-    topic = c.fetchone()
+    with transaction() as conn:
+        c = conn.cursor()
+        
+        # Check if user owns the topic
+        c.execute("SELECT created_by FROM topics WHERE id = ?", (topic_id,))
+        topic = c.fetchone()
+        
+        if topic and topic[0] == user_id:
+            c.execute("UPDATE topics SET scheduled_datetime = ? WHERE id = ?", (scheduled_datetime, topic_id))
+            bump_feed_version(c, topic_id)
+            scheduled = True
+        else:
+            scheduled = False
     
-    if topic and topic[0] == user_id:
-        c.execute("UPDATE topics SET scheduled_datetime = ? WHERE id = ?", (scheduled_datetime, topic_id))
-        conn.commit()
-        conn.close()
+    if scheduled:
+        notifier.notify(SESSION, None, topic_id, user_id, actor_name())
         return redirect(url_for('home'))
-    
-    conn.close()
     return jsonify({'error': 'Unauthorized'}), 403
 
 
-@app.route('/rate_topic/<int:topic_id>', methods=['POST'])
+# --- Hot writes ---
+# Joining and rating spike when a popular session opens. With the GROUP_COMMIT
+# setting these writes go through one writer thread that commits them in
+# batches (writer.py) instead of each request taking the write lock and
+# committing on its own.
+profiling.register_gauge('studymate_group_commit_batches', 'Group commits since start.', lambda: writer.batches)
+profiling.register_gauge('studymate_group_commit_writes', 'Writes committed through the group-commit writer.',
+                         lambda: writer.writes)
+
+def run_write(fn, *args):
+    """Run fn(conn, *args) in a transaction: group-committed when enabled, else on the request connection."""
+    if current_app.config['GROUP_COMMIT']:
+        return writer.run(fn, *args)
+    with transaction() as conn:
+        return fn(conn, *args)
+
+def toggle_willingness(conn, user_id, topic_id):
+    """Join or leave a topic; returns (action, willingness count)."""
+    removed = conn.execute("DELETE FROM willingness WHERE user_id = ? AND topic_id = ?",
+                           (user_id, topic_id)).rowcount
+    if not removed:
+        conn.execute("""
+            INSERT INTO willingness (user_id, topic_id, created_at) VALUES (?, ?, ?)
+            ON CONFLICT (user_id, topic_id) DO NOTHING
+        """, (user_id, topic_id, now_ts()))
+    bump_feed_version(conn, topic_id)
+    # Maintained by the topic_stats triggers
+    row = conn.execute("SELECT willingness_count FROM topic_stats WHERE topic_id = ?", (topic_id,)).fetchone()
+    return ('removed' if removed else 'added'), (row[0] if row else 0)
+
+def upsert_rating(conn, user_id, topic_id, rating, feedback, current_time):
+    """Insert or update the user's rating; returns the topic's (avg, count).
+
+    An empty feedback keeps the previously given one.
+    """
+    conn.execute("""
+        INSERT INTO ratings (user_id, topic_id, rating, feedback, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, topic_id) DO UPDATE SET
+            rating = excluded.rating,
+            feedback = COALESCE(NULLIF(excluded.feedback, ''), feedback),
+            updated_at = excluded.updated_at
+    """, (user_id, topic_id, rating, feedback, current_time, current_time))
+    bump_feed_version(conn, topic_id)
+    # Fresh aggregates, maintained by the topic_stats triggers
+    row = conn.execute("SELECT avg_rating, rating_count FROM topic_stats WHERE topic_id = ?", (topic_id,)).fetchone()
+    return (row[0] or 0.0, row[1]) if row else (0.0, 0)
+
+@route('/rate_topic/<int:topic_id>', methods=['POST'])
 def rate_topic(topic_id):
-    if 'user' not in session:
+    user = current_user()
+    if user is None:
         return jsonify({'error': 'Not logged in'}), 401
 
-    user_id = session['user']['id']
+    user_id = user['id']
     try:
         rating = float(request.form.get('rating', '0'))
     except ValueError:
@@ -561,11 +1039,9 @@ def rate_topic(topic_id):
     feedback = request.form.get('feedback', '').strip()
     
     # Get current local time with seconds for precise timestamping
-    now = datetime.now()
-    current_time = now.strftime('%Y-%m-%d %H:%M:%S')
-    friendly_time = now.strftime('%b %d, %Y at %I:%M:%S %p')  # More readable format
+    current_time = now_ts()
 
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_read_db()
     c = conn.cursor()
     
     # Check if topic has a scheduled date and if it has passed
@@ -574,87 +1050,50 @@ def rate_topic(topic_id):
     
     if topic and topic[0]:
         # Topic has a scheduled date, check if it has passed
-        try:
-            # Try different formats for scheduled_datetime
-            scheduled_str = str(topic[0])
-            scheduled_dt = None
-            for fmt in ['%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d']:
-                try:
-                    scheduled_dt = datetime.strptime(scheduled_str, fmt)
-                    break
-                except ValueError:
-                    continue
-            
-            if scheduled_dt:
-                now = datetime.now()
-                if now < scheduled_dt:
-                    conn.close()
-                    return jsonify({'error': 'Feedback can only be submitted after the scheduled session date'}), 400
-        except Exception:
-            # If parsing fails, allow rating (backward compatibility)
-            pass
+        # (if parsing fails, allow rating for backward compatibility)
+        scheduled_dt = parse_ts(topic[0])
+        if scheduled_dt and datetime.now() < scheduled_dt:
+            return jsonify({'error': 'Feedback can only be submitted after the scheduled session date'}), 400
     
     try:
-        # Check if rating already exists
-        c.execute("SELECT id FROM ratings WHERE user_id = ? AND topic_id = ?", (user_id, topic_id))
-        existing = c.fetchone()
-        
-        if existing:
-            # Update existing rating
-            if feedback:
-                c.execute("UPDATE ratings SET rating = ?, feedback = ?, updated_at = ? WHERE user_id = ? AND topic_id = ?",
-                          (rating, feedback, current_time, user_id, topic_id))
-            else:
-                c.execute("UPDATE ratings SET rating = ?, updated_at = ? WHERE user_id = ? AND topic_id = ?",
-                          (rating, current_time, user_id, topic_id))
-        else:
-            # Insert new rating with current local time
-            c.execute("INSERT INTO ratings (user_id, topic_id, rating, feedback, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
-                      (user_id, topic_id, rating, feedback, current_time, current_time))
-        
-        # Return fresh aggregates
-        c.execute("SELECT ROUND(AVG(rating), 2), COUNT(1) FROM ratings WHERE topic_id = ?", (topic_id,))
-        avg_rating, count = c.fetchone()
-        conn.commit()
-        conn.close()
-        return jsonify({'ok': True, 'avg': avg_rating or 0.0, 'count': count})
+        avg_rating, count = run_write(upsert_rating, user_id, topic_id, rating, feedback, current_time)
+        notifier.notify(RATING, None, topic_id, user_id, actor_name())
     except Exception as e:
-        conn.rollback()
-        conn.close()
         return jsonify({'error': str(e)}), 500
+    # The model reads the change log on the next /api/recommendations, not here
+    recommender.mark_stale()
+    return jsonify({'ok': True, 'avg': avg_rating or 0.0, 'count': count})
 
-@app.route('/delete_topic/<int:topic_id>', methods=['GET'])
+@route('/delete_topic/<int:topic_id>', methods=['GET'])
 def delete_topic(topic_id):
-    if 'user' not in session:
+    user = current_user()
+    if user is None:
         return redirect(url_for('landing'))
 
-    user_id = session['user']['id']
+    user_id = user['id']
 
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    
-    # Check if user owns the topic
-    c.execute("SELECT created_by FROM topics WHERE id = ?", (topic_id,))
-    topic = c.fetchone()
-    
-    if topic and topic[0] == user_id:
-        # Delete willingness entries first
-        c.execute("DELETE FROM willingness WHERE topic_id = ?", (topic_id,))
-        # Delete the topic
-        c.execute("DELETE FROM topics WHERE id = ?", (topic_id,))
-        conn.commit()
+    with transaction() as conn:
+        c = conn.cursor()
+        
+        # Check if user owns the topic
+        c.execute("SELECT created_by FROM topics WHERE id = ?", (topic_id,))
+        topic = c.fetchone()
+        
+        if topic and topic[0] == user_id:
+            # Removes its willingness, ratings and attachments with it
+            delete_topics(conn, [topic_id])
     
-    conn.close()
     return redirect(url_for('home'))
 
-@app.route('/willing_to_join/<int:topic_id>', methods=['POST'])
+@route('/willing_to_join/<int:topic_id>', methods=['POST'])
 def willing_to_join(topic_id):
-    if 'user' not in session:
+    user = current_user()
+    if user is None:
         return jsonify({'error': 'Not logged in'}), 401
 
-    user_id = session['user']['id']
+    user_id = user['id']
 
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_read_db()
     c = conn.cursor()
     
     try:
@@ -665,214 +1104,480 @@ def willing_to_join(topic_id):
         if topic and topic[0] == user_id:
             return jsonify({'error': 'Cannot join your own topic'}), 403
         
-        # Check if already willing
-        c.execute("SELECT id FROM willingness WHERE user_id = ? AND topic_id = ?", (user_id, topic_id))
-        existing = c.fetchone()
+        action, count = run_write(toggle_willingness, user_id, topic_id)
         
-        if existing:
-            # Remove willingness
-            c.execute("DELETE FROM willingness WHERE user_id = ? AND topic_id = ?", (user_id, topic_id))
-            action = 'removed'
-        else:
-            # Add willingness
-            c.execute("INSERT INTO willingness (user_id, topic_id) VALUES (?, ?)", (user_id, topic_id))
-            action = 'added'
-        
-        # Get updated count
-        c.execute("SELECT COUNT(*) FROM willingness WHERE topic_id = ?", (topic_id,))
-        count = c.fetchone()[0]
-        
-        conn.commit()
-        conn.close()
-        return jsonify({'action': action, 'count': count})
+        if action == 'added':
+            notifier.notify(JOIN, None, topic_id, user_id, actor_name())
     except Exception as e:
-        conn.close()
         return jsonify({'error': str(e)}), 500
+    recommender.mark_stale()
+    return jsonify({'action': action, 'count': count})
 
-@app.route('/logout')
+@route('/logout')
 def logout():
-    session.pop('user', None)
+    session.clear()
     return redirect(url_for('landing'))
 
 
-@app.route('/calendar')
+# --- Calendar ---
+CALENDAR_MAX_DAYS = 92
+
+# The grid shows each session on the day it starts, so "overlaps the
+# range" is a range seek on the scheduled_datetime index
+CALENDAR_SQL = """
+    SELECT t.id, t.title, t.description, t.duration, t.scheduled_datetime,
+           u.name, IFNULL(t.category, ''),
+           IFNULL(s.willingness_count, 0) as member_count,
+           w.user_id IS NOT NULL as opted_in
+    FROM topics t
+    LEFT JOIN users u ON t.created_by = u.id
+    LEFT JOIN topic_stats s ON t.id = s.topic_id
+    LEFT JOIN willingness w ON w.topic_id = t.id AND w.user_id = ?
+    WHERE t.scheduled_datetime >= ? AND t.scheduled_datetime < ?
+    ORDER BY t.scheduled_datetime ASC
+"""
+
+CALENDAR_FEED_SQL = """
+    SELECT t.id, t.title, t.description, t.duration, t.scheduled_datetime, IFNULL(t.category, '')
+    FROM willingness w
+    JOIN topics t ON t.id = w.topic_id
+    WHERE w.user_id = ? AND t.scheduled_datetime IS NOT NULL
+    ORDER BY t.scheduled_datetime ASC
+"""
+
+def _calendar_feed_serializer():
+    return URLSafeSerializer(current_app.secret_key, salt='calendar-feed')
+
+@route('/calendar')
 def calendar_view():
-    if 'user' not in session:
+    user = current_user()
+    if user is None:
         return redirect(url_for('landing'))
     
-    user_id = session['user']['id']
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
+    # Events are fetched per visible month from /api/calendar, so the page
+    # itself only depends on who is viewing it
+    etag, not_modified = check_etag('calendar', user['id'], request.host)
+    if not_modified:
+        return not_modified
     
-    # Get all scheduled topics organized by date/time
-    c.execute("""
-        SELECT t.id, t.title, t.description, t.duration, t.scheduled_datetime, 
-               u.name, IFNULL(t.category, ''),
-               COUNT(DISTINCT w.id) as member_count
-        FROM topics t
-        LEFT JOIN users u ON t.created_by = u.id
-        LEFT JOIN willingness w ON t.id = w.topic_id
-        WHERE t.scheduled_datetime IS NOT NULL 
-        GROUP BY t.id
-        ORDER BY t.scheduled_datetime ASC
-    """)
-    topics_raw = c.fetchall()
-    
-    # Get user's opted-in topics
-    c.execute("SELECT topic_id FROM willingness WHERE user_id = ?", (user_id,))
-    user_opted = [row[0] for row in c.fetchall()]
-    
-    # Format calendar data
-    import json
-    calendar_data = []
-    for topic in topics_raw:
-        if topic[4]:  # scheduled_datetime exists
-            # Format the datetime
-            scheduled_dt = str(topic[4])
-            try:
-                for fmt in ['%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d']:
-                    try:
-                        dt = datetime.strptime(scheduled_dt, fmt)
-                        formatted_dt = dt.strftime('%Y-%m-%d %H:%M')
-                        break
-                    except ValueError:
-                        continue
-                else:
-                    formatted_dt = scheduled_dt
-            except:
-                formatted_dt = scheduled_dt
-            
-            calendar_data.append({
-                'id': topic[0],
-                'title': topic[1],
-                'description': topic[2],
-                'duration': topic[3],
-                'scheduled_datetime': formatted_dt,
-                'instructor': topic[5] or 'Unknown',
-                'category': topic[6] if topic[6] else None,
-                'members': topic[7]
-            })
+    token = _calendar_feed_serializer().dumps(user['id'])
+    return with_etag(make_response(render_template('calendar_new.html',
+                         feed_url=url_for('calendar_feed', token=token, _external=True))), etag)
+
+@route('/api/calendar')
+def api_calendar():
+    user = current_user()
+    if user is None:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    # from/to are dates (or datetimes); the range is half-open [from, to)
+    start = normalize_ts(request.args.get('from', ''))
+    end = normalize_ts(request.args.get('to', ''))
+    if not start or not end or end <= start:
+        return jsonify({'error': 'from and to must be valid dates with from < to'}), 400
+    if parse_ts(end) - parse_ts(start) > timedelta(days=CALENDAR_MAX_DAYS):
+        return jsonify({'error': f'Range is limited to {CALENDAR_MAX_DAYS} days'}), 400
+    
+    c = get_read_db().cursor()
+    c.execute(CALENDAR_SQL, (user['id'], start, end))
     
-    # Convert to JSON
-    calendar_data_json = json.dumps(calendar_data, default=str)
-    user_opted_json = json.dumps(user_opted)
+    events = [{
+        'id': topic[0],
+        'title': topic[1],
+        'description': topic[2],
+        'duration': topic[3],
+        'scheduled_datetime': format_ts(topic[4], 'calendar'),
+        'instructor': topic[5] or 'Unknown',
+        'category': topic[6] if topic[6] else None,
+        'members': topic[7],
+        'opted_in': bool(topic[8])
+    } for topic in c.fetchall()]
+    
+    return jsonify({'from': start, 'to': end, 'events': events})
+
+@route('/calendar/<token>.ics')
+def calendar_feed(token):
+    """iCalendar feed of the sessions a user has opted in to.
+
+    Authenticated by the signed token in the URL, since calendar clients do
+    not carry the session cookie. The validators come from the user's
+    calendar_version, so an unchanged feed is answered with 304 before any
+    events are read.
+    """
+    try:
+        user_id = _calendar_feed_serializer().loads(token)
+    except BadSignature:
+        return jsonify({'error': 'Not found'}), 404
+    
+    conn = get_read_db()
+    c = conn.cursor()
+    c.execute("SELECT name, calendar_version, calendar_updated_at FROM users WHERE id = ?", (user_id,))
+    row = c.fetchone()
+    if not row:
+        return jsonify({'error': 'Not found'}), 404
+    name, version, updated_at = row
     
-    conn.close()
+    etag = f'cal-{user_id}-{version}'
+    updated_dt = parse_ts(updated_at)
+    last_modified = updated_dt.astimezone(timezone.utc) if updated_dt else None
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = Response(status=304)
+    else:
+        c.execute(CALENDAR_FEED_SQL, (user_id,))
+        events = []
+        for topic in c.fetchall():
+            start = parse_ts(topic[4])
+            if start:
+                events.append({
+                    'id': topic[0],
+                    'summary': topic[1],
+                    'description': topic[2],
+                    'start': start,
+                    'duration': parse_duration(topic[3]),
+                    'category': topic[5]
+                })
+        body = build_calendar(f'StudyMate - {name}', events, request.host.split(':')[0])
+        response = Response(body, mimetype='text/calendar')
     
-    return render_template('calendar_new.html', 
-                         calendar_data=calendar_data_json,
-                         user_opted=user_opted_json)
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
-@app.route('/messages')
+def conversation_key(user_a, user_b):
+    """Ordered (user_low, user_high) primary key of the conversations table."""
+    return (user_a, user_b) if user_a <= user_b else (user_b, user_a)
+
+# Conversation partners with their last message, newest first
+# (one summary row per user pair, maintained by a trigger on messages)
+INBOX_SQL = """
+    SELECT cv.other_id, u.username, u.name, cv.last_message_at,
+           cv.last_message_preview, cv.last_sender_id, cv.unread
+    FROM (
+        SELECT user_high AS other_id, last_message_id, last_message_at,
+               last_message_preview, last_sender_id, unread_low AS unread
+        FROM conversations WHERE user_low = ?
+        UNION ALL
+        SELECT user_low AS other_id, last_message_id, last_message_at,
+               last_message_preview, last_sender_id, unread_high AS unread
+        FROM conversations WHERE user_high = ?
+    ) cv
+    JOIN users u ON u.id = cv.other_id
+    ORDER BY cv.last_message_id DESC
+"""
+
+@route('/messages')
 def messages_view():
-    if 'user' not in session:
+    user = current_user()
+    if user is None:
         return redirect(url_for('landing'))
     
-    user_id = session['user']['id']
-    conn = sqlite3.connect(DB_NAME)
+    user_id = user['id']
+    conn = get_read_db()
     c = conn.cursor()
     
-    # Get unique conversation partners and last message
-    c.execute("""
-        SELECT DISTINCT 
-            CASE 
-                WHEN sender_id = ? THEN receiver_id 
-                ELSE sender_id 
-            END as other_user_id,
-            MAX(created_at) as last_msg_time
-        FROM messages
-        WHERE sender_id = ? OR receiver_id = ?
-        GROUP BY other_user_id
-        ORDER BY last_msg_time DESC
-    """, (user_id, user_id, user_id))
+    # 'inbox:<id>' is bumped by a trigger whenever one of the user's conversations changes
+    etag, not_modified = check_etag('messages', user_id, data_version(c, f'inbox:{user_id}'))
+    if not_modified:
+        return not_modified
+    
+    c.execute(INBOX_SQL, (user_id, user_id))
     
     conversations = []
-    for row in c.fetchall():
-        other_user_id = row[0]
-        c.execute("SELECT username, name FROM users WHERE id = ?", (other_user_id,))
-        user_info = c.fetchone()
-        if user_info:
-            conversations.append({
-                'user_id': other_user_id,
-                'username': user_info[0],
-                'name': user_info[1]
-            })
+    for other_user_id, username, name, last_at, preview, last_sender_id, unread in c.fetchall():
+        conversations.append({
+            'user_id': other_user_id,
+            'username': username,
+            'name': name,
+            'last_message_at': format_ts(last_at),
+            'last_message': preview,
+            'last_message_mine': last_sender_id == user_id,
+            'unread': unread
+        })
     
-    conn.close()
-    return render_template('messages.html', conversations=conversations)
+    return with_etag(make_response(render_template('messages.html', conversations=conversations)), etag)
+
+MESSAGE_PAGE_SIZE = 50
+STREAM_POLL_SECONDS = 15
+STREAM_MAX_SECONDS = 300
+MAX_ROWID = 2 ** 63 - 1
+
+def thread_query(user_id, other_user_id, before_id=None, since_id=None, limit=MESSAGE_PAGE_SIZE):
+    """SQL and parameters for one page of a thread; read the rows with thread_page().
+
+    since_id selects messages newer than that id (delta sync); otherwise the
+    newest messages older than before_id (or the newest overall). Each
+    direction of the conversation is read as its own bounded index range and
+    the two are merged, so a page costs the same at any depth.
+    """
+    if since_id is not None:
+        bound, order, bound_id = "id > ?", "ASC", since_id
+    else:
+        bound, order = "id < ?", "DESC"
+        bound_id = before_id if before_id is not None else MAX_ROWID
+    sql = f"""
+        SELECT id, sender_id, message, created_at FROM (
+            SELECT id, sender_id, message, created_at FROM messages
+            WHERE sender_id = ? AND receiver_id = ? AND {bound}
+            ORDER BY id {order} LIMIT ?
+        )
+        UNION ALL
+        SELECT id, sender_id, message, created_at FROM (
+            SELECT id, sender_id, message, created_at FROM messages
+            WHERE sender_id = ? AND receiver_id = ? AND {bound}
+            ORDER BY id {order} LIMIT ?
+        )
+        ORDER BY id {order}
+        LIMIT ?
+    """
+    params = (user_id, other_user_id, bound_id, limit + 1,
+              other_user_id, user_id, bound_id, limit + 1,
+              limit + 1)
+    return sql, params
+
+def thread_page(rows, since_id, limit):
+    """(messages oldest first, has_more) from the rows of thread_query()."""
+    has_more = len(rows) > limit
+    rows = list(rows[:limit])
+    if since_id is None:
+        rows.reverse()
+    messages = [{
+        'id': row[0],
+        'sender_id': row[1],
+        'text': row[2],
+        'sent_at': row[3]
+    } for row in rows]
+    return messages, has_more
+
+def fetch_thread(c, user_id, other_user_id, before_id=None, since_id=None, limit=MESSAGE_PAGE_SIZE):
+    """Fetch one page of the thread between two users, oldest first. Returns (messages, has_more)."""
+    c.execute(*thread_query(user_id, other_user_id, before_id, since_id, limit))
+    return thread_page(c.fetchall(), since_id, limit)
+
+def mark_read_statements(user_id, other_user_id):
+    """(unread check, its params, updates) for marking other_user_id's messages to user_id read.
+
+    Run the updates, in one transaction, only if the check returns a non-zero count.
+    """
+    user_low, user_high = conversation_key(user_id, other_user_id)
+    unread_column = 'unread_low' if user_id == user_low else 'unread_high'
+    check = f"SELECT {unread_column} FROM conversations WHERE user_low = ? AND user_high = ?"
+    updates = [
+        ("""
+            UPDATE messages 
+            SET is_read = 1 
+            WHERE receiver_id = ? AND sender_id = ? AND is_read = 0
+        """, (user_id, other_user_id)),
+        (f"UPDATE conversations SET {unread_column} = 0 WHERE user_low = ? AND user_high = ?",
+         (user_low, user_high)),
+    ]
+    return check, (user_low, user_high), updates
+
+def mark_conversation_read(conn, user_id, other_user_id):
+    """Mark other_user_id's messages to user_id as read; writes only if any are unread."""
+    c = conn.cursor()
+    check, params, updates = mark_read_statements(user_id, other_user_id)
+    c.execute(check, params)
+    row = c.fetchone()
+    if row and row[0]:
+        with transaction(conn):
+            for sql, update_params in updates:
+                c.execute(sql, update_params)
 
-@app.route('/messages/load/<int:other_user_id>', methods=['GET'])
+@route('/messages/load/<int:other_user_id>', methods=['GET'])
 def load_messages(other_user_id):
-    if 'user' not in session:
+    user = current_user()
+    if user is None:
         return jsonify({'error': 'Not logged in'}), 401
     
-    user_id = session['user']['id']
-    conn = sqlite3.connect(DB_NAME)
+    user_id = user['id']
+    before_id = request.args.get('before_id', type=int)
+    since_id = request.args.get('since_id', type=int)
+    limit = min(max(request.args.get('limit', MESSAGE_PAGE_SIZE, type=int), 1), 200)
+    conn = get_db()
     c = conn.cursor()
     
-    # Get all messages between these two users
-    c.execute("""
-        SELECT id, sender_id, message, created_at 
-        FROM messages
-        WHERE (sender_id = ? AND receiver_id = ?) 
-           OR (sender_id = ? AND receiver_id = ?)
-        ORDER BY created_at ASC
-    """, (user_id, other_user_id, other_user_id, user_id))
-    
-    messages = []
-    for row in c.fetchall():
-        messages.append({
-            'id': row[0],
-            'sender_id': row[1],
-            'text': row[2],
-            'sent_at': row[3]
-        })
+    # The thread only changes when a message is added, which moves last_message_id.
+    # (A client whose copy is current has already had this thread marked read.)
+    c.execute("SELECT last_message_id FROM conversations WHERE user_low = ? AND user_high = ?",
+              conversation_key(user_id, other_user_id))
+    row = c.fetchone()
+    etag, not_modified = check_etag('thread', user_id, other_user_id, row and row[0], before_id, since_id, limit)
+    if not_modified:
+        return not_modified
     
-    # Mark messages as read
-    c.execute("""
-        UPDATE messages 
-        SET is_read = 1 
-        WHERE receiver_id = ? AND sender_id = ? AND is_read = 0
-    """, (user_id, other_user_id))
-    conn.commit()
-    conn.close()
+    # Newest page by default; before_id pages back through history,
+    # since_id fetches only what arrived after the client's last message
+    messages, has_more = fetch_thread(c, user_id, other_user_id, before_id, since_id, limit)
+    
+    mark_conversation_read(conn, user_id, other_user_id)
     
-    return jsonify({'messages': messages})
+    return with_etag(jsonify({'messages': messages, 'has_more': has_more}), etag)
+
+@route('/messages/stream/<int:other_user_id>')
+def stream_messages(other_user_id):
+    """Server-Sent Events stream of new messages in one thread.
+
+    Resumes after since_id (or the Last-Event-ID header EventSource sends on
+    reconnect). The stream ends after STREAM_MAX_SECONDS; the browser then
+    reconnects on its own.
+    """
+    user = current_user()
+    if user is None:
+        return jsonify({'error': 'Not logged in'}), 401
+
+    user_id = user['id']
+    last_id = request.headers.get('Last-Event-ID', type=int) or request.args.get('since_id', 0, type=int)
+    key = conversation_key(user_id, other_user_id)
+    db_path = current_app.config['DATABASE']
+
+    def events():
+        # Own connection: the stream outlives the request's normal lifetime
+        conn = connect(db_path)
+        nonlocal last_id
+        try:
+            deadline = time.monotonic() + STREAM_MAX_SECONDS
+            while time.monotonic() < deadline:
+                messages, _ = fetch_thread(conn.cursor(), user_id, other_user_id, since_id=last_id)
+                if messages:
+                    for message in messages:
+                        yield f"id: {message['id']}\nevent: message\ndata: {json.dumps(message)}\n\n"
+                    last_id = messages[-1]['id']
+                    mark_conversation_read(conn, user_id, other_user_id)
+                    continue
+                if not broker.wait(key, last_id, STREAM_POLL_SECONDS):
+                    yield ": keepalive\n\n"
+        finally:
+            conn.close()
+
+    response = Response(stream_with_context(events()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+INSERT_MESSAGE_SQL = """
+    INSERT INTO messages (sender_id, receiver_id, message, created_at)
+    VALUES (?, ?, ?, ?)
+"""
+RECIPIENT_EXISTS_SQL = "SELECT 1 FROM users WHERE id = ?"
+
+def parse_user_id(value):
+    """A user id from JSON (an integer or a string of digits), or None."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value)
+    return None
 
-@app.route('/messages/send', methods=['POST'])
+@route('/messages/send', methods=['POST'])
 def send_message():
-    if 'user' not in session:
+    user = current_user()
+    if user is None:
         return jsonify({'error': 'Not logged in'}), 401
     
-    user_id = session['user']['id']
+    user_id = user['id']
     data = request.json
     recipient_id = data.get('recipient_id')
     message_text = data.get('message')
     
     if not recipient_id or not message_text:
         return jsonify({'error': 'Missing fields'}), 400
-    
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
+    recipient_id = parse_user_id(recipient_id)
+    if recipient_id is None:
+        return jsonify({'error': 'Invalid recipient'}), 400
     
     try:
-        c.execute("""
-            INSERT INTO messages (sender_id, receiver_id, message)
-            VALUES (?, ?, ?)
-        """, (user_id, recipient_id, message_text))
-        
-        conn.commit()
-        msg_id = c.lastrowid
-        conn.close()
+        with transaction() as conn:
+            # Checked under the write lock, so the recipient cannot go away before the insert
+            if conn.execute(RECIPIENT_EXISTS_SQL, (recipient_id,)).fetchone() is None:
+                return jsonify({'error': 'Unknown recipient'}), 400
+            msg_id = conn.execute(INSERT_MESSAGE_SQL, (user_id, recipient_id, message_text, now_ts())).lastrowid
         
+        # Wake any open stream on this conversation
+        broker.publish(conversation_key(user_id, recipient_id), msg_id)
+        notifier.notify(MESSAGE, recipient_id, user_id, user_id, actor_name())
         return jsonify({'ok': True, 'id': msg_id})
     except Exception as e:
-        conn.close()
         return jsonify({'error': str(e)}), 500
 
 
+# --- Notifications ---
+NOTIFICATION_PAGE_SIZE = 20
+
+def actor_name():
+    """How the logged-in user is named in other people's notifications."""
+    user = current_user()
+    return user.get('name') or user['username']
+
+@route('/api/notifications/unread_count')
+def notifications_unread_count():
+    user = current_user()
+    if user is None:
+        return jsonify({'error': 'Not logged in'}), 401
+
+    # Trigger-maintained counter: one primary-key read however many notifications exist
+    row = get_read_db().execute("SELECT unread FROM notification_counts WHERE user_id = ?",
+                           (user['id'],)).fetchone()
+    return jsonify({'unread': row[0] if row else 0})
+
+@route('/api/notifications')
+def api_notifications():
+    """Newest notifications first; ?before=<id> pages back."""
+    user = current_user()
+    if user is None:
+        return jsonify({'error': 'Not logged in'}), 401
+
+    before_id = request.args.get('before', MAX_ROWID, type=int)
+    c = get_read_db().cursor()
+    c.execute("""
+        SELECT id, type, title, message, related_id, is_read, created_at
+        FROM notifications
+        WHERE user_id = ? AND id < ?
+        ORDER BY id DESC
+        LIMIT ?
+    """, (user['id'], before_id, NOTIFICATION_PAGE_SIZE + 1))
+    rows = c.fetchall()
+    has_more = len(rows) > NOTIFICATION_PAGE_SIZE
+    rows = rows[:NOTIFICATION_PAGE_SIZE]
+    return jsonify({
+        'notifications': [{
+            'id': row[0],
+            'type': row[1],
+            'title': row[2],
+            'message': row[3],
+            'related_id': row[4],
+            'is_read': bool(row[5]),
+            'created_at': format_ts(row[6])
+        } for row in rows],
+        'next_before': rows[-1][0] if has_more else None
+    })
+
+@route('/api/notifications/read', methods=['POST'])
+def mark_notifications_read():
+    """Mark the given notification ids read, or all of them when no ids are sent."""
+    user = current_user()
+    if user is None:
+        return jsonify({'error': 'Not logged in'}), 401
+
+    ids = (request.get_json(silent=True) or {}).get('ids')
+    if ids is not None and (not isinstance(ids, list) or not all(isinstance(i, int) for i in ids)):
+        return jsonify({'error': 'ids must be a list of integers'}), 400
+
+    user_id = user['id']
+    with transaction() as conn:
+        if ids is None:
+            conn.execute("UPDATE notifications SET is_read = 1 WHERE user_id = ? AND is_read = 0", (user_id,))
+        else:
+            conn.execute("""
+                UPDATE notifications SET is_read = 1
+                WHERE id IN (SELECT value FROM json_each(?)) AND user_id = ? AND is_read = 0
+            """, (json.dumps(ids), user_id))
+        row = conn.execute("SELECT unread FROM notification_counts WHERE user_id = ?", (user_id,)).fetchone()
+    return jsonify({'unread': row[0] if row else 0})
 
 
 if __name__ == '__main__':
-    init_db()
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    create_app().run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
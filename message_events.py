@@ -0,0 +1,67 @@
+import asyncio
+import threading
+
+
+class MessageBroker:
+    """In-process wake-up signal for open message streams.
+
+    send_message publishes the new message id under the conversation key and
+    every stream waiting on that conversation wakes up and reads the new rows
+    from the database. Streams also wake on a timeout, so messages written by
+    another worker process are still picked up, just less promptly.
+
+    Threads wait with wait(); coroutines on an event loop (the async chat
+    endpoints) with wait_async(), which holds no thread while it waits.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._latest = {}
+        self._async_waiters = {}  # key -> [(loop, future)]
+
+    def publish(self, key, message_id):
+        with self._cond:
+            if message_id > self._latest.get(key, 0):
+                self._latest[key] = message_id
+            self._cond.notify_all()
+            waiters = self._async_waiters.pop(key, [])
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_wake, future)
+
+    def wait(self, key, after_id, timeout):
+        """Block until a message newer than after_id is published, or timeout.
+
+        Returns True if a newer message is known to exist.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self._latest.get(key, 0) > after_id, timeout)
+
+    async def wait_async(self, key, after_id, timeout):
+        """wait() for coroutines."""
+        future = asyncio.get_running_loop().create_future()
+        with self._cond:
+            if self._latest.get(key, 0) > after_id:
+                return True
+            waiter = (future.get_loop(), future)
+            self._async_waiters.setdefault(key, []).append(waiter)
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._cond:
+                waiters = self._async_waiters.get(key)
+                if waiters and waiter in waiters:
+                    waiters.remove(waiter)
+                    if not waiters:
+                        del self._async_waiters[key]
+        with self._cond:
+            return self._latest.get(key, 0) > after_id
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+broker = MessageBroker()
@@ -0,0 +1,789 @@
+"""Versioned schema migrations.
+
+Each entry in MIGRATIONS is one numbered step; the schema version of a
+database is stored in PRAGMA user_version and only steps above it run.
+Steps must be append-only: never edit or reorder one that has shipped.
+"""
+import logging
+import sys
+
+try:
+    import fcntl
+except ImportError:  # Windows: no lock file, migrate() alone keeps concurrent runs correct
+    fcntl = None
+
+from db import DB_NAME, connect
+from timeutils import normalize_ts
+
+log = logging.getLogger(__name__)
+
+
+# --- 1: base tables ---
+def _create_base_schema(c):
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            profession TEXT NOT NULL,
+            name TEXT NOT NULL
+        )
+    """)
+
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS topics (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            description TEXT NOT NULL,
+            duration TEXT NOT NULL,
+            created_by INTEGER NOT NULL,
+            created_at TIMESTAMP,
+            scheduled_datetime TEXT,
+            FOREIGN KEY (created_by) REFERENCES users(id)
+        )
+    """)
+
+    # Databases created before versioning may or may not have these columns
+    _add_column(c, 'topics', 'category', 'TEXT')
+
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS willingness (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            topic_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id),
+            FOREIGN KEY (topic_id) REFERENCES topics(id),
+            UNIQUE(user_id, topic_id)
+        )
+    """)
+
+    # Ratings are 0..5, 0.5 steps allowed
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS ratings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            topic_id INTEGER NOT NULL,
+            rating REAL NOT NULL CHECK (rating >= 0 AND rating <= 5),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id),
+            FOREIGN KEY (topic_id) REFERENCES topics(id),
+            UNIQUE(user_id, topic_id)
+        )
+    """)
+    _add_column(c, 'ratings', 'feedback', 'TEXT')
+
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender_id INTEGER NOT NULL,
+            receiver_id INTEGER NOT NULL,
+            topic_id INTEGER,
+            subject TEXT,
+            message TEXT NOT NULL,
+            is_read BOOLEAN DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (sender_id) REFERENCES users(id),
+            FOREIGN KEY (receiver_id) REFERENCES users(id)
+        )
+    """)
+
+
+# --- 2: topic_stats rollup ---
+def _create_topic_stats(c):
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'topic_stats'")
+    stats_exists = c.fetchone() is not None
+
+    # Per-topic rollup of willingness and rating aggregates, read by the feeds
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS topic_stats (
+            topic_id INTEGER PRIMARY KEY,
+            willingness_count INTEGER NOT NULL DEFAULT 0,
+            rating_sum REAL NOT NULL DEFAULT 0,
+            rating_count INTEGER NOT NULL DEFAULT 0,
+            avg_rating REAL NOT NULL DEFAULT 0,
+            FOREIGN KEY (topic_id) REFERENCES topics(id)
+        )
+    """)
+
+    # Triggers keep topic_stats in step with every write, inside the writer's transaction
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS topic_stats_topic_insert AFTER INSERT ON topics
+        BEGIN
+            INSERT OR IGNORE INTO topic_stats (topic_id) VALUES (NEW.id);
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS topic_stats_topic_delete AFTER DELETE ON topics
+        BEGIN
+            DELETE FROM topic_stats WHERE topic_id = OLD.id;
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS topic_stats_willingness_insert AFTER INSERT ON willingness
+        BEGIN
+            UPDATE topic_stats SET willingness_count = willingness_count + 1
+            WHERE topic_id = NEW.topic_id;
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS topic_stats_willingness_delete AFTER DELETE ON willingness
+        BEGIN
+            UPDATE topic_stats SET willingness_count = MAX(willingness_count - 1, 0)
+            WHERE topic_id = OLD.topic_id;
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS topic_stats_rating_insert AFTER INSERT ON ratings
+        BEGIN
+            UPDATE topic_stats
+            SET rating_sum = rating_sum + NEW.rating,
+                rating_count = rating_count + 1,
+                avg_rating = ROUND((rating_sum + NEW.rating) / (rating_count + 1), 2)
+            WHERE topic_id = NEW.topic_id;
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS topic_stats_rating_update AFTER UPDATE OF rating ON ratings
+        BEGIN
+            UPDATE topic_stats
+            SET rating_sum = rating_sum - OLD.rating + NEW.rating,
+                avg_rating = ROUND((rating_sum - OLD.rating + NEW.rating) / MAX(rating_count, 1), 2)
+            WHERE topic_id = NEW.topic_id;
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS topic_stats_rating_delete AFTER DELETE ON ratings
+        BEGIN
+            UPDATE topic_stats
+            SET rating_sum = rating_sum - OLD.rating,
+                rating_count = rating_count - 1,
+                avg_rating = CASE WHEN rating_count > 1
+                                  THEN ROUND((rating_sum - OLD.rating) / (rating_count - 1), 2)
+                                  ELSE 0 END
+            WHERE topic_id = OLD.topic_id;
+        END
+    """)
+
+    if not stats_exists:
+        # Backfill from existing rows the first time the table is created
+        c.execute("""
+            INSERT INTO topic_stats (topic_id, willingness_count, rating_sum, rating_count, avg_rating)
+            SELECT t.id,
+                   (SELECT COUNT(*) FROM willingness w WHERE w.topic_id = t.id),
+                   (SELECT IFNULL(SUM(r.rating), 0) FROM ratings r WHERE r.topic_id = t.id),
+                   (SELECT COUNT(*) FROM ratings r WHERE r.topic_id = t.id),
+                   (SELECT IFNULL(ROUND(AVG(r.rating), 2), 0) FROM ratings r WHERE r.topic_id = t.id)
+            FROM topics t
+        """)
+
+
+# --- 3: secondary indexes for the hot queries ---
+def _create_indexes(c):
+    # Feed ordering and the owner's "my topics" list / profile counts
+    c.execute("CREATE INDEX IF NOT EXISTS idx_topics_created_at ON topics (created_at, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_topics_created_by ON topics (created_by, created_at)")
+    # Calendar only ever reads scheduled topics
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_topics_scheduled ON topics (scheduled_datetime)
+        WHERE scheduled_datetime IS NOT NULL
+    """)
+    # willingness(user_id, topic_id) is already covered by its UNIQUE constraint
+    c.execute("CREATE INDEX IF NOT EXISTS idx_willingness_topic ON willingness (topic_id, user_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_willingness_user_created ON willingness (user_id, created_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_ratings_topic_created ON ratings (topic_id, created_at)")
+    # Thread loads and mark-as-read use (sender, receiver); the inbox also needs receiver first
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_pair ON messages (sender_id, receiver_id, created_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_receiver ON messages (receiver_id, sender_id, is_read)")
+
+
+# --- 4: keyset pagination of the feed ---
+def _create_feed_indexes(c):
+    # Category-filtered feed pages; the unfiltered feed uses idx_topics_created_at
+    c.execute("CREATE INDEX IF NOT EXISTS idx_topics_category_created ON topics (category, created_at, id)")
+
+
+# --- 5: canonical timestamps ---
+TIMESTAMP_COLUMNS = (
+    ('topics', 'created_at'),
+    ('topics', 'scheduled_datetime'),
+    ('willingness', 'created_at'),
+    ('ratings', 'created_at'),
+    ('ratings', 'updated_at'),
+    ('messages', 'created_at'),
+)
+LEGACY_UTC_TABLES = ('willingness', 'messages')
+CANONICAL_GLOB = '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9] [0-9][0-9]:[0-9][0-9]:[0-9][0-9]'
+
+
+def _normalize_timestamps(c):
+    # Rewrite mixed-format values (e.g. '2025-11-02T20:56') to CANONICAL_FORMAT;
+    # anything unparseable is left alone rather than lost
+    for table, column in TIMESTAMP_COLUMNS:
+        c.execute(f"SELECT id, {column} FROM {table} WHERE {column} IS NOT NULL AND {column} NOT GLOB ?",
+                  (CANONICAL_GLOB,))
+        updates = []
+        for row_id, value in c.fetchall():
+            canonical = normalize_ts(value)
+            if canonical and canonical != value:
+                updates.append((canonical, row_id))
+        c.executemany(f"UPDATE {table} SET {column} = ? WHERE id = ?", updates)
+    # Before this migration, willingness and messages rows took their
+    # created_at from the column default, CURRENT_TIMESTAMP, which is UTC;
+    # every other column was written in local time by the app
+    for table in LEGACY_UTC_TABLES:
+        c.execute(f"UPDATE {table} SET created_at = datetime(created_at, 'localtime') WHERE created_at GLOB ?",
+                  (CANONICAL_GLOB,))
+
+
+# --- 6: conversation summaries for the inbox ---
+def _create_conversations(c):
+    # One row per ordered user pair (user_low < user_high), with unread counts for each side
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS conversations (
+            user_low INTEGER NOT NULL,
+            user_high INTEGER NOT NULL,
+            last_message_id INTEGER NOT NULL,
+            last_message_at TIMESTAMP,
+            last_message_preview TEXT,
+            last_sender_id INTEGER,
+            unread_low INTEGER NOT NULL DEFAULT 0,
+            unread_high INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_low, user_high)
+        ) WITHOUT ROWID
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_conversations_high ON conversations (user_high, last_message_id)")
+
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS conversations_message_insert AFTER INSERT ON messages
+        BEGIN
+            INSERT INTO conversations (user_low, user_high, last_message_id, last_message_at,
+                                       last_message_preview, last_sender_id, unread_low, unread_high)
+            VALUES (MIN(NEW.sender_id, NEW.receiver_id), MAX(NEW.sender_id, NEW.receiver_id),
+                    NEW.id, NEW.created_at, SUBSTR(NEW.message, 1, 120), NEW.sender_id,
+                    NEW.receiver_id < NEW.sender_id, NEW.receiver_id > NEW.sender_id)
+            ON CONFLICT (user_low, user_high) DO UPDATE SET
+                last_message_id = excluded.last_message_id,
+                last_message_at = excluded.last_message_at,
+                last_message_preview = excluded.last_message_preview,
+                last_sender_id = excluded.last_sender_id,
+                unread_low = unread_low + excluded.unread_low,
+                unread_high = unread_high + excluded.unread_high;
+        END
+    """)
+
+    c.execute("""
+        INSERT OR IGNORE INTO conversations (user_low, user_high, last_message_id, last_message_at,
+                                             last_message_preview, last_sender_id, unread_low, unread_high)
+        SELECT p.user_low, p.user_high, m.id, m.created_at, SUBSTR(m.message, 1, 120), m.sender_id,
+               p.unread_low, p.unread_high
+        FROM (
+            SELECT MIN(sender_id, receiver_id) AS user_low, MAX(sender_id, receiver_id) AS user_high,
+                   MAX(id) AS last_id,
+                   SUM(is_read = 0 AND receiver_id < sender_id) AS unread_low,
+                   SUM(is_read = 0 AND receiver_id > sender_id) AS unread_high
+            FROM messages
+            GROUP BY user_low, user_high
+        ) p
+        JOIN messages m ON m.id = p.last_id
+    """)
+
+
+# --- 7: id-ordered thread paging ---
+def _create_thread_index(c):
+    # Threads are paged by message id; an index on the pair alone ends in the
+    # rowid, so "id < ?" / "id > ?" becomes a range seek within each direction
+    c.execute("DROP INDEX IF EXISTS idx_messages_pair")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_thread ON messages (sender_id, receiver_id)")
+
+
+# --- 8: full-text search over topics ---
+def _create_topics_fts(c):
+    # External-content index: the text lives only in topics, the FTS table holds
+    # the inverted index. Prefix indexes keep search-as-you-type queries cheap.
+    c.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS topics_fts USING fts5(
+            title, description, category,
+            content='topics', content_rowid='id',
+            tokenize='porter unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+    """)
+    # Default ORDER BY rank: a title hit outweighs a category hit outweighs the description
+    c.execute("INSERT INTO topics_fts (topics_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0, 5.0)')")
+
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS topics_fts_insert AFTER INSERT ON topics
+        BEGIN
+            INSERT INTO topics_fts (rowid, title, description, category)
+            VALUES (NEW.id, NEW.title, NEW.description, NEW.category);
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS topics_fts_delete AFTER DELETE ON topics
+        BEGIN
+            INSERT INTO topics_fts (topics_fts, rowid, title, description, category)
+            VALUES ('delete', OLD.id, OLD.title, OLD.description, OLD.category);
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS topics_fts_update AFTER UPDATE OF title, description, category ON topics
+        BEGIN
+            INSERT INTO topics_fts (topics_fts, rowid, title, description, category)
+            VALUES ('delete', OLD.id, OLD.title, OLD.description, OLD.category);
+            INSERT INTO topics_fts (rowid, title, description, category)
+            VALUES (NEW.id, NEW.title, NEW.description, NEW.category);
+        END
+    """)
+
+    c.execute("INSERT INTO topics_fts (topics_fts) VALUES ('rebuild')")
+
+
+# --- 9: per-user calendar feed versions ---
+def _create_calendar_versions(c):
+    # Bumped whenever anything in a user's .ics feed may have changed, so a
+    # poll can be answered with 304 from one primary-key lookup
+    _add_column(c, 'users', 'calendar_version', 'INTEGER NOT NULL DEFAULT 0')
+    _add_column(c, 'users', 'calendar_updated_at', 'TIMESTAMP')
+
+    bump = """
+        UPDATE users
+        SET calendar_version = calendar_version + 1,
+            calendar_updated_at = datetime('now', 'localtime')
+    """
+    c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS calendar_willingness_insert AFTER INSERT ON willingness
+        BEGIN
+            {bump} WHERE id = NEW.user_id;
+        END
+    """)
+    c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS calendar_willingness_delete AFTER DELETE ON willingness
+        BEGIN
+            {bump} WHERE id = OLD.user_id;
+        END
+    """)
+    c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS calendar_topic_update
+        AFTER UPDATE OF title, description, duration, scheduled_datetime, category ON topics
+        BEGIN
+            {bump} WHERE id IN (SELECT user_id FROM willingness WHERE topic_id = NEW.id);
+        END
+    """)
+
+
+# --- 10: cache versions ---
+def _create_data_versions(c):
+    # Counters bumped by the write paths; cache keys include them so a bump
+    # makes every cached copy of the old data unreachable
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    """)
+    c.execute("INSERT OR IGNORE INTO data_versions (name, version) VALUES ('feed', 0)")
+    _add_column(c, 'topic_stats', 'version', 'INTEGER NOT NULL DEFAULT 0')
+
+
+# --- 11: inbox versions ---
+def _create_inbox_versions(c):
+    # 'inbox:<user id>' changes whenever one of the user's conversation rows does
+    # (new message either way, or a side marked read)
+    for event in ('INSERT', 'UPDATE'):
+        c.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS inbox_version_{event.lower()} AFTER {event} ON conversations
+            BEGIN
+                INSERT INTO data_versions (name, version) VALUES ('inbox:' || NEW.user_low, 1)
+                ON CONFLICT (name) DO UPDATE SET version = version + 1;
+                INSERT INTO data_versions (name, version) VALUES ('inbox:' || NEW.user_high, 1)
+                ON CONFLICT (name) DO UPDATE SET version = version + 1;
+            END
+        """)
+
+
+# --- 12: content-addressed avatars ---
+def _create_avatar_keys(c):
+    # users.avatar holds the key of the processed thumbnails (see avatars.py).
+    # Old <username>.jpg uploads are converted by migrate_once() after the
+    # schema steps, outside of any migration transaction
+    _add_column(c, 'users', 'avatar', 'TEXT')
+
+
+# --- 13: user_stats rollup and profile activity indexes ---
+def _create_user_stats(c):
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_stats'")
+    stats_exists = c.fetchone() is not None
+
+    # Per-user counters shown on profiles; ratings_received_* cover ratings on
+    # the user's current topics
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id INTEGER PRIMARY KEY,
+            topics_created INTEGER NOT NULL DEFAULT 0,
+            topics_joined INTEGER NOT NULL DEFAULT 0,
+            ratings_received_count INTEGER NOT NULL DEFAULT 0,
+            ratings_received_sum REAL NOT NULL DEFAULT 0,
+            ratings_given INTEGER NOT NULL DEFAULT 0,
+            messages_sent INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    """)
+
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS user_stats_user_insert AFTER INSERT ON users
+        BEGIN
+            INSERT OR IGNORE INTO user_stats (user_id) VALUES (NEW.id);
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS user_stats_user_delete AFTER DELETE ON users
+        BEGIN
+            DELETE FROM user_stats WHERE user_id = OLD.id;
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS user_stats_topic_insert AFTER INSERT ON topics
+        BEGIN
+            UPDATE user_stats SET topics_created = topics_created + 1 WHERE user_id = NEW.created_by;
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS user_stats_topic_delete AFTER DELETE ON topics
+        BEGIN
+            UPDATE user_stats
+            SET topics_created = MAX(topics_created - 1, 0),
+                ratings_received_count = ratings_received_count
+                    - (SELECT COUNT(*) FROM ratings WHERE topic_id = OLD.id),
+                ratings_received_sum = ratings_received_sum
+                    - (SELECT IFNULL(SUM(rating), 0) FROM ratings WHERE topic_id = OLD.id)
+            WHERE user_id = OLD.created_by;
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS user_stats_willingness_insert AFTER INSERT ON willingness
+        BEGIN
+            UPDATE user_stats SET topics_joined = topics_joined + 1 WHERE user_id = NEW.user_id;
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS user_stats_willingness_delete AFTER DELETE ON willingness
+        BEGIN
+            UPDATE user_stats SET topics_joined = MAX(topics_joined - 1, 0) WHERE user_id = OLD.user_id;
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS user_stats_rating_insert AFTER INSERT ON ratings
+        BEGIN
+            UPDATE user_stats SET ratings_given = ratings_given + 1 WHERE user_id = NEW.user_id;
+            UPDATE user_stats
+            SET ratings_received_count = ratings_received_count + 1,
+                ratings_received_sum = ratings_received_sum + NEW.rating
+            WHERE user_id = (SELECT created_by FROM topics WHERE id = NEW.topic_id);
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS user_stats_rating_update AFTER UPDATE OF rating ON ratings
+        BEGIN
+            UPDATE user_stats SET ratings_received_sum = ratings_received_sum - OLD.rating + NEW.rating
+            WHERE user_id = (SELECT created_by FROM topics WHERE id = NEW.topic_id);
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS user_stats_rating_delete AFTER DELETE ON ratings
+        BEGIN
+            UPDATE user_stats SET ratings_given = MAX(ratings_given - 1, 0) WHERE user_id = OLD.user_id;
+            UPDATE user_stats
+            SET ratings_received_count = MAX(ratings_received_count - 1, 0),
+                ratings_received_sum = ratings_received_sum - OLD.rating
+            WHERE user_id = (SELECT created_by FROM topics WHERE id = OLD.topic_id);
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS user_stats_message_insert AFTER INSERT ON messages
+        BEGIN
+            UPDATE user_stats SET messages_sent = messages_sent + 1 WHERE user_id = NEW.sender_id;
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS user_stats_message_delete AFTER DELETE ON messages
+        BEGIN
+            UPDATE user_stats SET messages_sent = MAX(messages_sent - 1, 0) WHERE user_id = OLD.sender_id;
+        END
+    """)
+
+    if not stats_exists:
+        c.execute("""
+            INSERT INTO user_stats (user_id, topics_created, topics_joined, ratings_received_count,
+                                    ratings_received_sum, ratings_given, messages_sent)
+            SELECT u.id,
+                   (SELECT COUNT(*) FROM topics t WHERE t.created_by = u.id),
+                   (SELECT COUNT(*) FROM willingness w WHERE w.user_id = u.id),
+                   (SELECT COUNT(*) FROM ratings r JOIN topics t ON t.id = r.topic_id WHERE t.created_by = u.id),
+                   (SELECT IFNULL(SUM(r.rating), 0) FROM ratings r JOIN topics t ON t.id = r.topic_id
+                    WHERE t.created_by = u.id),
+                   (SELECT COUNT(*) FROM ratings r WHERE r.user_id = u.id),
+                   (SELECT COUNT(*) FROM messages m WHERE m.sender_id = u.id)
+            FROM users u
+        """)
+
+    # Each branch of the profile activity query reads its own (user, time) range
+    c.execute("CREATE INDEX IF NOT EXISTS idx_ratings_user_created ON ratings (user_id, created_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_sender_created ON messages (sender_id, created_at)")
+
+
+# --- 14: account suspension and indexes for set-based deletes ---
+def _create_moderation(c):
+    _add_column(c, 'users', 'suspended_at', 'TIMESTAMP')
+
+    # Tables created by older releases outside this file; when present, the
+    # admin cascade deletes from them by user and by topic
+    optional_indexes = {
+        'comments': [('idx_comments_user', 'user_id'), ('idx_comments_topic', 'topic_id')],
+        'notifications': [('idx_notifications_user', 'user_id')],
+        'attachments': [('idx_attachments_topic', 'topic_id'), ('idx_attachments_uploader', 'uploaded_by')],
+        'session_history': [('idx_session_history_topic', 'topic_id')],
+        'password_resets': [('idx_password_resets_user', 'user_id')],
+    }
+    for table, indexes in optional_indexes.items():
+        c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+        if c.fetchone():
+            for name, column in indexes:
+                c.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({column})")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_topic ON messages (topic_id) WHERE topic_id IS NOT NULL")
+
+    # Rows orphaned by the old per-topic admin delete; triggers settle the rollups
+    for table, column, parent in [('willingness', 'topic_id', 'topics'), ('willingness', 'user_id', 'users'),
+                                  ('ratings', 'topic_id', 'topics'), ('ratings', 'user_id', 'users'),
+                                  ('messages', 'sender_id', 'users'), ('messages', 'receiver_id', 'users'),
+                                  ('conversations', 'user_low', 'users'), ('conversations', 'user_high', 'users')]:
+        c.execute(f"DELETE FROM {table} WHERE {column} NOT IN (SELECT id FROM {parent})")
+    for table, indexes in optional_indexes.items():
+        c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+        if c.fetchone():
+            for _, column in indexes:
+                parent = 'topics' if column == 'topic_id' else 'users'
+                c.execute(f"DELETE FROM {table} WHERE {column} NOT IN (SELECT id FROM {parent})")
+
+
+# --- 15: admin user directory indexes ---
+def _create_directory_indexes(c):
+    # One index per directory sort, each ending in user_id for keyset paging
+    c.execute("CREATE INDEX IF NOT EXISTS idx_user_stats_created ON user_stats (topics_created, user_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_user_stats_joined ON user_stats (topics_joined, user_id)")
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_user_stats_rating
+        ON user_stats (IFNULL(ratings_received_sum / ratings_received_count, 0), user_id)
+    """)
+    # NOCASE indexes let LIKE 'prefix%' (case-insensitive) run as a range read
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_username_nocase ON users (username COLLATE NOCASE)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_name_nocase ON users (name COLLATE NOCASE, id)")
+
+
+# --- 16: notifications and their unread counters ---
+def _create_notifications(c):
+    # Older releases created this table outside the migrations; same shape
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS notifications (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            type TEXT NOT NULL,
+            title TEXT NOT NULL,
+            message TEXT NOT NULL,
+            related_id INTEGER,
+            is_read INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+    """)
+    c.execute("DROP INDEX IF EXISTS idx_notifications_user")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_notifications_user_id ON notifications (user_id, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_notifications_unread ON notifications (user_id) WHERE is_read = 0")
+
+    # Unread count per user, kept by triggers so the badge is one primary-key read
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS notification_counts (
+            user_id INTEGER PRIMARY KEY,
+            unread INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS notification_counts_insert AFTER INSERT ON notifications
+        WHEN NEW.is_read = 0
+        BEGIN
+            INSERT INTO notification_counts (user_id, unread) VALUES (NEW.user_id, 1)
+            ON CONFLICT (user_id) DO UPDATE SET unread = unread + 1;
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS notification_counts_read AFTER UPDATE OF is_read ON notifications
+        WHEN OLD.is_read = 0 AND NEW.is_read != 0
+        BEGIN
+            UPDATE notification_counts SET unread = MAX(unread - 1, 0) WHERE user_id = NEW.user_id;
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS notification_counts_delete AFTER DELETE ON notifications
+        WHEN OLD.is_read = 0
+        BEGIN
+            UPDATE notification_counts SET unread = MAX(unread - 1, 0) WHERE user_id = OLD.user_id;
+        END
+    """)
+    c.execute("DELETE FROM notification_counts")
+    c.execute("""
+        INSERT INTO notification_counts (user_id, unread)
+        SELECT user_id, COUNT(*) FROM notifications WHERE is_read = 0 GROUP BY user_id
+    """)
+
+
+# --- 17: server-side sessions ---
+def _create_sessions(c):
+    # data is the session dict as JSON; expires_at is unix time
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires_at)")
+
+
+# --- 18: change log for the topic recommendations ---
+def _create_recommendation_changes(c):
+    # One row per willingness or rating change, read by every process's
+    # recommender past its own watermark (recommendations.py). AUTOINCREMENT
+    # keeps ids from being reused once old rows are pruned; created_at is unix time
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS recommendation_changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            topic_id INTEGER NOT NULL,
+            created_at INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+        )
+    """)
+    for table, event, row in [('willingness', 'INSERT', 'NEW'), ('willingness', 'DELETE', 'OLD'),
+                              ('ratings', 'INSERT', 'NEW'), ('ratings', 'UPDATE OF rating', 'NEW'),
+                              ('ratings', 'DELETE', 'OLD')]:
+        c.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS recommendation_{table}_{event.split()[0].lower()} AFTER {event} ON {table}
+            BEGIN
+                INSERT INTO recommendation_changes (user_id, topic_id) VALUES ({row}.user_id, {row}.topic_id);
+            END
+        """)
+
+
+MIGRATIONS = [
+    _create_base_schema,
+    _create_topic_stats,
+    _create_indexes,
+    _create_feed_indexes,
+    _normalize_timestamps,
+    _create_conversations,
+    _create_thread_index,
+    _create_topics_fts,
+    _create_calendar_versions,
+    _create_data_versions,
+    _create_inbox_versions,
+    _create_avatar_keys,
+    _create_user_stats,
+    _create_moderation,
+    _create_directory_indexes,
+    _create_notifications,
+    _create_sessions,
+    _create_recommendation_changes,
+]
+
+
+def _add_column(c, table, column, decl):
+    c.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in c.fetchall()]:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn):
+    """Apply every migration above the database's user_version.
+
+    Each step runs in its own IMMEDIATE transaction together with the
+    user_version bump, and the version is re-read under the write lock so
+    two processes starting at once never apply the same step twice.
+    Returns the list of versions that were applied.
+    """
+    applied = []
+    for version, step in enumerate(MIGRATIONS, start=1):
+        if schema_version(conn) >= version:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if schema_version(conn) < version:
+                step(conn.cursor())
+                conn.execute(f"PRAGMA user_version = {version}")
+                applied.append(version)
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    if applied:
+        # Refresh planner statistics so the new indexes get picked up
+        conn.execute("ANALYZE")
+        conn.commit()
+    return applied
+
+
+
+def migrate_once(path=DB_NAME):
+    """Bring the database at path up to date, one process at a time.
+
+    Prefork workers starting together queue on a lock file next to the
+    database; the first applies the pending steps and the rest only read
+    user_version. An up-to-date database costs one PRAGMA read. Returns the
+    versions applied by this call.
+
+    A call that applied steps also converts legacy avatar uploads, still
+    under the lock, so a deploy leaves every profile rendering from its
+    stored key.
+    """
+    lock = None
+    if fcntl is not None and path != ':memory:':
+        lock = open(f"{path}.migrate-lock", 'w')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+        conn = connect(path)
+        try:
+            if schema_version(conn) >= len(MIGRATIONS):
+                return []
+            applied = migrate(conn)
+            _import_legacy_avatars(conn)
+            return applied
+        finally:
+            conn.close()
+    finally:
+        if lock is not None:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+def _import_legacy_avatars(conn):
+    from avatars import import_legacy_avatars
+    imported, failed = import_legacy_avatars(conn)
+    if imported:
+        log.info("Converted %d legacy avatar(s)", imported)
+    for username, reason in failed:
+        log.warning("Legacy avatar of %s not converted (%s); retry with python avatars.py --import-legacy",
+                    username, reason)
+
+def explain(conn, sql, params=()):
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+
+
+if __name__ == '__main__':
+    # python migrations.py [db_path]   -- apply pending migrations
+    # (query plans of the hot queries are checked by python query_plans.py)
+    conn = connect(sys.argv[1] if len(sys.argv) > 1 else DB_NAME)
+    print(f"Applied: {migrate(conn) or 'nothing'} (schema version {schema_version(conn)})")
+    conn.close()
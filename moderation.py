@@ -0,0 +1,113 @@
+"""Set-based admin deletes and suspensions.
+
+Every operation takes a whole batch of ids and runs a fixed number of
+statements however large the batch is: ids are passed as one JSON array
+and expanded with json_each(?), so cleaning up a spam wave is one short
+transaction. Call these inside transaction(); the rollup triggers
+(topic_stats, user_stats, calendar versions, topics_fts) adjust themselves
+row by row as the child rows go.
+"""
+import json
+
+from db import bump_data_version
+from timeutils import now_ts
+
+MAX_BATCH = 5000
+
+# Child tables that older databases may carry; (table, column) pairs
+# deleted by user id and by topic id when the table exists
+OPTIONAL_USER_CHILDREN = [('comments', 'user_id'), ('notifications', 'user_id'),
+                          ('attachments', 'uploaded_by'), ('password_resets', 'user_id')]
+OPTIONAL_TOPIC_CHILDREN = [('comments', 'topic_id'), ('attachments', 'topic_id'),
+                           ('session_history', 'topic_id')]
+
+_IDS = "(SELECT value FROM json_each(?))"
+
+
+def _existing_tables(c, names):
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name IN (SELECT value FROM json_each(?))",
+              (json.dumps(sorted(set(names))),))
+    return {row[0] for row in c.fetchall()}
+
+
+def _delete_topic_rows(c, topic_ids):
+    """Delete topics and everything hanging off them; returns the number of topics deleted."""
+    ids = json.dumps(topic_ids)
+    # Children first: their delete triggers read the topic row to find its owner
+    c.execute(f"DELETE FROM willingness WHERE topic_id IN {_IDS}", (ids,))
+    c.execute(f"DELETE FROM ratings WHERE topic_id IN {_IDS}", (ids,))
+    present = _existing_tables(c, [table for table, _ in OPTIONAL_TOPIC_CHILDREN])
+    for table, column in OPTIONAL_TOPIC_CHILDREN:
+        if table in present:
+            c.execute(f"DELETE FROM {table} WHERE {column} IN {_IDS}", (ids,))
+    # Messages stay with their conversation; they just lose the topic reference
+    c.execute(f"UPDATE messages SET topic_id = NULL WHERE topic_id IN {_IDS}", (ids,))
+    c.execute(f"DELETE FROM topics WHERE id IN {_IDS}", (ids,))
+    return c.rowcount
+
+
+def delete_topics(conn, topic_ids):
+    """Delete a batch of topics with their willingness, ratings and attachments."""
+    c = conn.cursor()
+    deleted = _delete_topic_rows(c, list(topic_ids))
+    if deleted:
+        bump_data_version(c, 'feed')
+    return deleted
+
+
+def delete_users(conn, user_ids):
+    """Delete a batch of users and everything they own or took part in.
+
+    Returns (users deleted, topics deleted).
+    """
+    c = conn.cursor()
+    ids = json.dumps(list(user_ids))
+
+    c.execute(f"SELECT id FROM topics WHERE created_by IN {_IDS}", (ids,))
+    topics_deleted = _delete_topic_rows(c, [row[0] for row in c.fetchall()])
+
+    # Their marks on other people's topics
+    c.execute(f"DELETE FROM willingness WHERE user_id IN {_IDS}", (ids,))
+    c.execute(f"DELETE FROM ratings WHERE user_id IN {_IDS}", (ids,))
+
+    # Conversations vanish from the other side's inbox too
+    c.execute(f"""
+        INSERT INTO data_versions (name, version)
+        SELECT 'inbox:' || CASE WHEN user_low IN {_IDS} THEN user_high ELSE user_low END, 1
+        FROM conversations
+        WHERE user_low IN {_IDS} OR user_high IN {_IDS}
+        ON CONFLICT (name) DO UPDATE SET version = version + 1
+    """, (ids, ids, ids))
+    c.execute(f"DELETE FROM conversations WHERE user_low IN {_IDS}", (ids,))
+    c.execute(f"DELETE FROM conversations WHERE user_high IN {_IDS}", (ids,))
+    c.execute(f"DELETE FROM messages WHERE sender_id IN {_IDS}", (ids,))
+    c.execute(f"DELETE FROM messages WHERE receiver_id IN {_IDS}", (ids,))
+
+    present = _existing_tables(c, [table for table, _ in OPTIONAL_USER_CHILDREN])
+    for table, column in OPTIONAL_USER_CHILDREN:
+        if table in present:
+            c.execute(f"DELETE FROM {table} WHERE {column} IN {_IDS}", (ids,))
+
+    c.execute(f"DELETE FROM notification_counts WHERE user_id IN {_IDS}", (ids,))
+    c.execute(f"DELETE FROM users WHERE id IN {_IDS}", (ids,))
+    users_deleted = c.rowcount
+    c.execute(f"""
+        DELETE FROM data_versions
+        WHERE name IN (SELECT 'user:' || value FROM json_each(?) UNION ALL SELECT 'inbox:' || value FROM json_each(?))
+    """, (ids, ids))
+    if users_deleted or topics_deleted:
+        bump_data_version(c, 'feed')
+    return users_deleted, topics_deleted
+
+
+def set_suspended(conn, user_ids, suspended):
+    """Suspend (suspended_at = now) or reinstate a batch of users; returns rows changed."""
+    c = conn.cursor()
+    ids = json.dumps(list(user_ids))
+    if suspended:
+        c.execute(f"UPDATE users SET suspended_at = ? WHERE id IN {_IDS} AND suspended_at IS NULL",
+                  (now_ts(), ids))
+    else:
+        c.execute(f"UPDATE users SET suspended_at = NULL WHERE id IN {_IDS} AND suspended_at IS NOT NULL",
+                  (ids,))
+    return c.rowcount
@@ -0,0 +1,183 @@
+"""Notification fan-out off the request thread.
+
+Write endpoints call notifier.notify(...) after their transaction commits;
+that only appends to an in-memory queue. A background thread drains the
+queue in short windows, coalesces events that share a recipient, kind and
+subject ("5 people joined your topic"), looks up what it needs (topic
+titles, the people to tell about a session) in a few batched queries and
+writes all rows of the window with one executemany in one transaction.
+
+Unread counts live in notification_counts, kept by triggers (migration 16).
+Events still queued when the process dies are lost; notifications are a
+courtesy, the underlying writes are already committed.
+"""
+import atexit
+import json
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+from db import connect, transaction
+from timeutils import format_ts, now_ts
+
+log = logging.getLogger(__name__)
+
+FLUSH_SECONDS = 2.0
+MAX_BATCH_EVENTS = 5000
+
+# Event kinds: who the subject is and how it reads once coalesced
+JOIN, RATING, MESSAGE, SESSION = 'join', 'rating', 'message', 'session'
+
+
+def _people(actors, count):
+    """'Ann', 'Ann and Bob', 'Ann, Bob and 3 others'."""
+    if count == 1:
+        return actors[0]
+    if count == 2:
+        return f"{actors[0]} and {actors[1]}"
+    others = count - 2
+    return f"{actors[0]}, {actors[1]} and {others} other{'s' if others != 1 else ''}"
+
+
+def _render(kind, actors, count, title):
+    """(title, message) for one coalesced notification."""
+    if kind == JOIN:
+        return "New participants", f"{_people(actors, count)} joined your topic \"{title}\""
+    if kind == RATING:
+        return "New feedback", f"{_people(actors, count)} rated your topic \"{title}\""
+    if kind == MESSAGE:
+        noun = 'a message' if count == 1 else f"{count} messages"
+        return "New message", f"{actors[0]} sent you {noun}"
+    return "Session scheduled", f"\"{title}\" is scheduled for {actors[-1]}"
+
+
+class NotificationWorker:
+    def __init__(self, db_path, flush_seconds=FLUSH_SECONDS):
+        self.db_path = db_path
+        self.flush_seconds = flush_seconds
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopping = False
+        atexit.register(self.stop)
+
+    # --- producers (request threads) ---
+
+    def notify(self, kind, recipient_id, subject_id, actor_id, actor_name):
+        """Queue one event. Topic events pass recipient_id=None: the worker
+        resolves the topic's owner (join, rating) or participants (session)."""
+        self._ensure_started()
+        self._queue.put((kind, recipient_id, subject_id, actor_id, actor_name))
+
+    def _ensure_started(self):
+        # Started on first use, so each (forked) worker process gets its own thread
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='notifications', daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=5.0):
+        """Flush what is queued and stop the thread."""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self._stopping = True
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    # --- consumer (background thread) ---
+
+    def _drain(self):
+        """Block for one event, then collect whatever arrives within the flush window."""
+        event = self._queue.get()
+        events = []
+        deadline = time.monotonic() + self.flush_seconds
+        while event is not None:
+            events.append(event)
+            if len(events) >= MAX_BATCH_EVENTS:
+                break
+            remaining = deadline - time.monotonic()
+            try:
+                event = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+        return events
+
+    def _run(self):
+        conn = connect(self.db_path)
+        try:
+            while True:
+                events = self._drain()
+                if events:
+                    try:
+                        self.write(conn, events)
+                    except Exception:
+                        log.exception("Dropped %d notification event(s)", len(events))
+                if self._stopping and self._queue.empty():
+                    break
+        finally:
+            conn.close()
+
+    def write(self, conn, events):
+        """Coalesce a batch of events and insert the resulting notifications."""
+        c = conn.cursor()
+        topic_ids = sorted({subject for kind, _, subject, _, _ in events if kind != MESSAGE})
+        titles, owners, scheduled, participants = {}, {}, {}, {}
+        if topic_ids:
+            ids = json.dumps(topic_ids)
+            c.execute("""
+                SELECT id, title, created_by, scheduled_datetime FROM topics
+                WHERE id IN (SELECT value FROM json_each(?))
+            """, (ids,))
+            for topic_id, title, owner, when in c.fetchall():
+                titles[topic_id], owners[topic_id], scheduled[topic_id] = title, owner, when
+            session_topics = sorted({subject for kind, _, subject, _, _ in events if kind == SESSION})
+            if session_topics:
+                c.execute("""
+                    SELECT topic_id, user_id FROM willingness
+                    WHERE topic_id IN (SELECT value FROM json_each(?))
+                """, (json.dumps(session_topics),))
+                for topic_id, user_id in c.fetchall():
+                    participants.setdefault(topic_id, []).append(user_id)
+
+        # (recipient, kind, subject) -> (distinct actor names, event count)
+        groups = OrderedDict()
+        for kind, recipient_id, subject_id, actor_id, actor_name in events:
+            if kind == MESSAGE:
+                recipients = [recipient_id]
+            elif subject_id not in titles:
+                continue  # topic deleted since
+            elif kind == SESSION:
+                recipients = participants.get(subject_id, [])
+                actor_name = format_ts(scheduled[subject_id], 'long')
+            else:
+                recipients = [owners[subject_id]]
+            for user_id in recipients:
+                if user_id == actor_id:
+                    continue
+                key = (user_id, kind, subject_id)
+                actors, count = groups.get(key, ([], 0))
+                if kind == SESSION:
+                    # Only the latest schedule matters
+                    actors, count = [actor_name], 1
+                elif actor_name not in actors:
+                    actors, count = actors + [actor_name], count + 1
+                elif kind == MESSAGE:
+                    count += 1
+                groups[key] = (actors, count)
+
+        created_at = now_ts()
+        rows = []
+        for (user_id, kind, subject_id), (actors, count) in groups.items():
+            title, message = _render(kind, actors, count, titles.get(subject_id))
+            rows.append((user_id, kind, title, message, subject_id, created_at))
+        if rows:
+            with transaction(conn):
+                c.executemany("""
+                    INSERT INTO notifications (user_id, type, title, message, related_id, is_read, created_at)
+                    VALUES (?, ?, ?, ?, ?, 0, ?)
+                """, rows)
+        return len(rows)
@@ -0,0 +1,262 @@
+"""Per-request timing, SQL tracing and Prometheus metrics.
+
+Every request's wall time is recorded per endpoint, which costs two clock
+reads and a lock. A sampled fraction of requests (the PROFILE_SAMPLE
+setting, off by default) also gets traced read-write and read-only
+connections that time each statement; those requests additionally report
+statements and SQL time per request, flag N+1 patterns (one statement run
+many times in a request) and log slow statements with their query plan,
+once per statement text.
+
+Statement times cover execute(), i.e. preparing the statement and producing
+its first row; the cost of fetching the remaining rows is in the request's
+wall time only.
+"""
+import logging
+import random
+import re
+import sqlite3
+import threading
+import time
+
+from flask import current_app, g, request
+
+from db import connect
+from migrations import explain
+
+log = logging.getLogger(__name__)
+
+SLOW_QUERY_SECONDS = 0.1
+N_PLUS_ONE_THRESHOLD = 10
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Histogram:
+    def __init__(self, name, help, buckets, labels=('endpoint',)):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.labels = labels
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # Per-bucket counts, then sum and count
+                series = self._series[label_values] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((k, list(v)) for k, v in self._series.items())
+        for label_values, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(self.labels, label_values, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_labels(self.labels, label_values, [('le', '+Inf')])} {values[-1]}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, label_values)} {values[-2]}")
+            lines.append(f"{self.name}_count{_labels(self.labels, label_values)} {values[-1]}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, labels=('endpoint',)):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        lines.extend(f"{self.name}{_labels(self.labels, k)} {v}" for k, v in values)
+        return lines
+
+
+request_seconds = Histogram('studymate_request_seconds', 'Request wall time by endpoint.', LATENCY_BUCKETS)
+request_errors = Counter('studymate_request_errors_total', 'Requests that raised an unhandled exception.')
+sql_statements = Histogram('studymate_sql_statements_per_request', 'SQL statements per sampled request.',
+                           STATEMENT_BUCKETS)
+sql_seconds = Histogram('studymate_sql_seconds_per_request', 'Time spent in SQL per sampled request.',
+                        LATENCY_BUCKETS)
+slow_queries = Counter('studymate_slow_queries_total', f'Statements slower than {SLOW_QUERY_SECONDS}s.')
+n_plus_one = Counter('studymate_n_plus_one_total',
+                     f'Sampled requests running one statement {N_PLUS_ONE_THRESHOLD}+ times.')
+METRICS = [request_seconds, request_errors, sql_statements, sql_seconds, slow_queries, n_plus_one]
+_gauges = []
+
+
+def register_gauge(name, help, read):
+    """Export read() (a number) as a gauge, evaluated at scrape time."""
+    _gauges.append((name, help, read))
+
+
+# --- Traced connections (sampled requests only) ---
+
+class RequestTrace:
+    def __init__(self):
+        self.statements = {}  # sql -> [executions, total seconds, slowest seconds, its params]
+
+    def record(self, sql, params, elapsed):
+        entry = self.statements.get(sql)
+        if entry is None:
+            self.statements[sql] = [1, elapsed, elapsed, params]
+            return
+        entry[0] += 1
+        entry[1] += elapsed
+        if elapsed > entry[2]:
+            entry[2], entry[3] = elapsed, params
+
+
+class TracedCursor(sqlite3.Cursor):
+    def execute(self, sql, params=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            self.connection.trace.record(sql, params, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_params):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_params)
+        finally:
+            self.connection.trace.record(sql, (), time.perf_counter() - started)
+
+
+class TracedConnection(sqlite3.Connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.trace = RequestTrace()
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            self.trace.record('COMMIT', (), time.perf_counter() - started)
+
+
+_explained = set()
+_explained_lock = threading.Lock()
+
+
+def _is_query(sql):
+    return re.match(r'\s*(SELECT|WITH|INSERT|UPDATE|DELETE)\b', sql, re.IGNORECASE) is not None
+
+
+def _merge(conns):
+    """sql -> [executions, total, slowest, its params, its connection] across the request's connections."""
+    merged = {}
+    for conn in conns:
+        for sql, (executions, total, slowest, params) in list(conn.trace.statements.items()):
+            entry = merged.get(sql)
+            if entry is None:
+                merged[sql] = [executions, total, slowest, params, conn]
+                continue
+            entry[0] += executions
+            entry[1] += total
+            if slowest > entry[2]:
+                entry[2:] = [slowest, params, conn]
+    return merged
+
+
+def _report(conns, endpoint):
+    statements = _merge(conns)
+    sql_statements.observe(sum(entry[0] for entry in statements.values()), endpoint)
+    sql_seconds.observe(sum(entry[1] for entry in statements.values()), endpoint)
+    for sql, (executions, total, slowest, params, conn) in statements.items():
+        if executions >= N_PLUS_ONE_THRESHOLD and _is_query(sql):
+            n_plus_one.inc(endpoint)
+            log.warning("N+1 in %s: %d executions (%.1f ms) of %s", endpoint, executions, total * 1000, ' '.join(sql.split()))
+        if slowest >= SLOW_QUERY_SECONDS:
+            slow_queries.inc(endpoint)
+            with _explained_lock:
+                first = sql not in _explained
+                _explained.add(sql)
+            if first and _is_query(sql):
+                try:
+                    plan = explain(conn, sql, params)
+                except sqlite3.Error as e:
+                    plan = [f"(no plan: {e})"]
+                log.warning("Slow query in %s (%.1f ms): %s\n    %s", endpoint, slowest * 1000,
+                            ' '.join(sql.split()), '\n    '.join(plan))
+
+
+# --- Flask hooks ---
+
+def init_app(app):
+    app.before_request(_start)
+    app.teardown_request(_finish)
+
+
+def _start():
+    g.request_started = time.perf_counter()
+    sample_rate = current_app.config['PROFILE_SAMPLE']
+    if sample_rate and random.random() < sample_rate:
+        # get_db() and get_read_db() hand these connections to the rest of the request
+        g.db = connect(current_app.config['DATABASE'], factory=TracedConnection)
+        g.read_db = current_app.extensions['reader_pool'].connect(factory=TracedConnection)
+
+
+def _finish(exc=None):
+    started = g.pop('request_started', None)
+    if started is None:
+        return
+    endpoint = request.endpoint or 'unmatched'
+    request_seconds.observe(time.perf_counter() - started, endpoint)
+    if exc is not None:
+        request_errors.inc(endpoint)
+    conns = [conn for conn in (g.get('db'), g.get('read_db')) if isinstance(conn, TracedConnection)]
+    if conns:
+        try:
+            _report(conns, endpoint)
+        except Exception:
+            log.exception("Could not report the SQL trace for %s", endpoint)
+
+
+def render_metrics():
+    """All metrics in Prometheus text exposition format."""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for name, help, read in _gauges:
+        lines.extend([f"# HELP {name} {help}", f"# TYPE {name} gauge", f"{name} {read()}"])
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,76 @@
+"""Query plan checks for the hot queries.
+
+The SQL comes from the same constants and query builders the routes run,
+with sample parameters, so a check can never drift from what is served.
+Plans are checked on a freshly migrated in-memory schema, so they reflect
+the index set rather than the statistics of one particular database.
+
+    python query_plans.py     -- fail if a hot query scans a whole table
+"""
+import sys
+
+from db import connect
+from migrations import explain, migrate
+
+
+def hot_queries():
+    """{name: (sql, params)} for the statements on the busiest paths."""
+    import main
+    import recommendations
+    from routes import profile
+
+    cursor = ('2025-01-01 00:00:00', 10)
+    check, check_params, updates = main.mark_read_statements(1, 2)
+    return {
+        'home feed': main.feed_range_query("t.created_at IS NOT NULL", []),
+        'feed page': main.feed_range_query("(t.created_at, t.id) < (?, ?)", cursor),
+        'feed page by category': main.feed_range_query("(t.created_at, t.id) < (?, ?)", cursor, 'python', True),
+        'my topics': (main.MY_TOPICS_SQL, (1,)),
+        'joined topics': (main.JOINED_TOPICS_SQL, (1,)),
+        'willing users': (main.WILLING_USERS_SQL, ('[1]',)),
+        'topic ratings': (main.TOPIC_RATINGS_SQL, ('[1]',)),
+        'calendar': (main.CALENDAR_SQL, (1, '2026-01-01 00:00:00', '2026-02-01 00:00:00')),
+        'calendar feed': (main.CALENDAR_FEED_SQL, (1,)),
+        'inbox': (main.INBOX_SQL, (1, 1)),
+        'thread': main.thread_query(1, 2, before_id=1000),
+        'thread since': main.thread_query(1, 2, since_id=1000),
+        'unread check': (check, check_params),
+        'mark read': updates[0],
+        'search': main.search_query('"python"*', 'python'),
+        'profile': (profile.PROFILE_SQL, ('someone',)),
+        'profile activity': profile.activity_query(1, include_messages=True,
+                                                   cursor=('2030-01-01 00:00:00', profile.ACTIVITY_JOINED, 1)),
+        'admin directory': main.directory_query('posts', cursor=(3, 100)),
+        'admin directory by rating': main.directory_query('rating'),
+        'admin directory search': main.directory_query('joins', prefix='ak'),
+        'recommendation changes': (recommendations.CHANGED_WEIGHTS_SQL, (1000, 1100)),
+        'recommended topics': (main.RECOMMENDED_TOPICS_SQL, ('[1, 2, 3]', 1, '2026-01-01 00:00:00', 1)),
+    }
+
+
+def full_scans(conn, queries=None):
+    """Return {query name: plan lines} for hot queries that scan a whole table."""
+    problems = {}
+    for name, (sql, params) in (queries or hot_queries()).items():
+        plan = explain(conn, sql, params)
+        # Scanning a materialized subquery is fine; scanning a table is not
+        subqueries = {line.split()[1] for line in plan if line.startswith(('MATERIALIZE ', 'CO-ROUTINE '))}
+        bad = [line for line in plan
+               if line.startswith('SCAN ') and 'USING' not in line and 'VIRTUAL TABLE' not in line
+               and line.split()[1] not in subqueries]
+        if bad:
+            problems[name] = plan
+    return problems
+
+
+if __name__ == '__main__':
+    conn = connect(':memory:')
+    migrate(conn)
+    queries = hot_queries()
+    problems = full_scans(conn, queries)
+    for name, plan in problems.items():
+        print(f"FULL SCAN in {name}:")
+        for line in plan:
+            print(f"    {line}")
+    print(f"{len(queries) - len(problems)}/{len(queries)} hot queries use an index")
+    sys.exit(1 if problems else 0)
@@ -0,0 +1,301 @@
+"""'Recommended for you': topics that co-occur with the ones a user engaged with.
+
+Every user is a sparse row of topic weights: 1 for being willing to join,
+plus rating / 5 for a rating. Two topics are similar when the same users
+engage with both (cosine similarity of their columns), and a user's
+recommendations are the topics most similar to their own, weighted by how
+strongly they engaged.
+
+The model keeps the co-occurrence matrix C = X^T X. A full build is one
+sparse product. After that, a weight for (user, topic t) changing from w to
+w' only moves row and column t at the user's other topics,
+
+    C[t, j] += (w' - w) * x[j]        C[t, t] += w'^2 - w^2
+
+so these deltas go into a small overlay that is folded into the sparse
+matrix once it passes COMPACT_AT entries. Applying a change costs the size
+of that user's row, not the size of the catalog.
+
+Changes reach the model through the recommendation_changes log, which
+triggers on willingness and ratings fill (migration 18). Each process reads
+the log past its own watermark, so writes made by other workers or the
+group-commit thread are picked up as well. The log is only read from
+recommend(); write routes just call mark_stale(), so the model never
+costs a write request anything. Per-user candidate lists are cached for
+CACHE_SECONDS and a user's own list is dropped when they change something.
+
+NumPy and SciPy are only needed for this feature; they are imported when
+the model is first built.
+"""
+import os
+import threading
+import time
+
+from cache import LRUCache
+from db import DB_NAME, connect, transaction
+
+CANDIDATES = 60
+CACHE_SECONDS = 60
+# Changes from other processes are read at most this often per process
+REFRESH_SECONDS = 1.0
+COMPACT_AT = 50000
+# A backlog larger than this is cheaper to rebuild than to replay
+REBUILD_AT = 100000
+LOG_RETENTION_SECONDS = 24 * 3600
+PRUNE_SECONDS = 3600
+
+WEIGHTS_SQL = """
+    SELECT user_id, topic_id, SUM(weight) FROM (
+        SELECT user_id, topic_id, 1.0 AS weight FROM willingness
+        UNION ALL
+        SELECT user_id, topic_id, rating / 5.0 FROM ratings
+    )
+    GROUP BY user_id, topic_id
+"""
+
+# Current weight of every (user, topic) changed in (watermark, max id]
+CHANGED_WEIGHTS_SQL = """
+    SELECT l.user_id, l.topic_id,
+           EXISTS (SELECT 1 FROM willingness w WHERE w.user_id = l.user_id AND w.topic_id = l.topic_id)
+           + IFNULL((SELECT r.rating FROM ratings r WHERE r.user_id = l.user_id AND r.topic_id = l.topic_id), 0) / 5.0
+    FROM (SELECT DISTINCT user_id, topic_id FROM recommendation_changes WHERE id > ? AND id <= ?) l
+"""
+
+
+class Recommender:
+    """Item-item recommendations over willingness and ratings, kept current from the change log."""
+
+    def __init__(self, db_path=DB_NAME, cache_size=10000):
+        self.db_path = db_path
+        self.cache = LRUCache(cache_size)
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._built = False
+        self._users = {}  # user_id -> {topic_id: weight}
+        self._versions = {}  # user_id -> bumped on each change, part of the cache key
+        self._cooc = None
+        self._diag = None
+        self._overlay = {}  # topic_id -> {topic_id: delta not yet in _cooc}
+        self._overlay_size = 0
+        self._watermark = 0
+        self._next_refresh = 0.0
+        self._next_prune = 0.0
+        self.builds = 0
+        self.changes_applied = 0
+
+    def build(self, conn):
+        """(Re)build the model from every willingness and rating row."""
+        import numpy as np
+        from scipy import sparse
+
+        with self._lock:
+            # Read first: changes committed during the build are replayed from
+            # the log, and replaying one that is already counted is a no-op
+            watermark = conn.execute("SELECT IFNULL(MAX(id), 0) FROM recommendation_changes").fetchone()[0]
+            rows = conn.execute(WEIGHTS_SQL).fetchall()
+            max_topic = conn.execute("SELECT IFNULL(MAX(id), 0) FROM topics").fetchone()[0]
+
+            users = {}
+            for user_id, topic_id, weight in rows:
+                if weight:
+                    users.setdefault(user_id, {})[topic_id] = weight
+            entries = [(row, topic_id, weight)
+                       for row, weight_row in enumerate(users.values())
+                       for topic_id, weight in weight_row.items()]
+            n = max([max_topic] + [topic_id for _, topic_id, _ in entries]) + 1
+            if entries:
+                user_index, topic_index, weights = map(np.asarray, zip(*entries))
+            else:
+                user_index = topic_index = np.zeros(0, dtype=np.int64)
+                weights = np.zeros(0)
+            matrix = sparse.csr_matrix((weights, (user_index, topic_index)), shape=(len(users), n))
+
+            self._cooc = (matrix.T @ matrix).tocsr()
+            self._diag = self._cooc.diagonal().astype(float)
+            self._users = users
+            self._versions = {}
+            self._overlay, self._overlay_size = {}, 0
+            self._watermark = watermark
+            self._built = True
+            self.builds += 1
+            self.cache.clear()
+
+    def refresh(self, conn, force=False):
+        """Apply the changes logged since the last refresh.
+
+        Throttled to one log read per REFRESH_SECONDS unless force is set; a
+        model that was never built is left for recommend() to build.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            if not self._built:
+                return
+            now = time.monotonic()
+            if not force and now < self._next_refresh:
+                return
+            self._next_refresh = now + REFRESH_SECONDS
+
+            low, high = conn.execute("""
+                SELECT (SELECT MIN(id) FROM recommendation_changes), (SELECT MAX(id) FROM recommendation_changes)
+            """).fetchone()
+            if high is None or high <= self._watermark:
+                return
+            if low > self._watermark + 1 or high - self._watermark > REBUILD_AT:
+                # Rows past the watermark were pruned, or the backlog is huge
+                self.build(conn)
+            else:
+                for user_id, topic_id, weight in conn.execute(CHANGED_WEIGHTS_SQL, (self._watermark, high)):
+                    self._apply(user_id, topic_id, weight)
+                self._watermark = high
+                if self._overlay_size > COMPACT_AT:
+                    self._compact()
+        self._maybe_prune()
+
+    def mark_stale(self):
+        """Have the next refresh() read the log even within REFRESH_SECONDS.
+
+        Called after a local write so the writer's next recommendations
+        include it; no I/O happens here, so it cannot fail a request.
+        """
+        self._next_refresh = 0.0
+
+    def _apply(self, user_id, topic_id, weight):
+        row = self._users.setdefault(user_id, {})
+        old = row.get(topic_id, 0.0)
+        delta = weight - old
+        if delta:
+            for other, x in row.items():
+                if other != topic_id:
+                    self._add(topic_id, other, delta * x)
+                    self._add(other, topic_id, delta * x)
+            self._add(topic_id, topic_id, weight * weight - old * old)
+            if weight:
+                row[topic_id] = weight
+            else:
+                del row[topic_id]
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            self.changes_applied += 1
+        if not row:
+            del self._users[user_id]
+
+    def _add(self, i, j, value):
+        if i == j:
+            if i >= len(self._diag):
+                import numpy as np
+                self._diag = np.concatenate([self._diag, np.zeros(max(i + 1 - len(self._diag), len(self._diag)))])
+            self._diag[i] += value
+        row = self._overlay.setdefault(i, {})
+        if j not in row:
+            self._overlay_size += 1
+        row[j] = row.get(j, 0.0) + value
+
+    def _compact(self):
+        """Fold the overlay into the sparse matrix."""
+        import numpy as np
+        from scipy import sparse
+
+        entries = [(i, j, value) for i, row in self._overlay.items() for j, value in row.items()]
+        rows, cols, values = map(np.asarray, zip(*entries))
+        n = max(self._cooc.shape[0], len(self._diag))
+        cooc = self._cooc.copy()
+        cooc.resize((n, n))
+        cooc = (cooc + sparse.csr_matrix((values, (rows, cols)), shape=(n, n))).tocsr()
+        # Joins and leaves cancel out up to rounding; drop what is left of them
+        cooc.data[np.abs(cooc.data) < 1e-9] = 0
+        cooc.eliminate_zeros()
+        self._cooc = cooc
+        if len(self._diag) < n:
+            self._diag = np.concatenate([self._diag, np.zeros(n - len(self._diag))])
+        self._overlay, self._overlay_size = {}, 0
+
+    def _maybe_prune(self):
+        # At most one prune per PRUNE_SECONDS per process; the newest row is
+        # always kept so a watermark can be checked against MIN(id)
+        now = time.time()
+        if now < self._next_prune:
+            return
+        self._next_prune = now + PRUNE_SECONDS
+        conn = connect(self.db_path)
+        try:
+            with transaction(conn):
+                conn.execute("""
+                    DELETE FROM recommendation_changes WHERE id < IFNULL(
+                        (SELECT id FROM recommendation_changes WHERE created_at >= ? ORDER BY id LIMIT 1),
+                        (SELECT MAX(id) FROM recommendation_changes))
+                """, (int(now - LOG_RETENTION_SECONDS),))
+        finally:
+            conn.close()
+
+    def recommend(self, conn, user_id):
+        """[(topic_id, score)] for user_id, best first: up to CANDIDATES topics they have not engaged with.
+
+        Users without any willingness or rating get the most engaged-with
+        topics instead. Callers filter out topics that are no longer offered.
+        """
+        self.refresh(conn)
+        with self._lock:
+            if not self._built:
+                self.build(conn)
+            key = (user_id, self._versions.get(user_id, 0))
+            cached = self.cache.get(key)
+            if cached is not None and cached[1] > time.monotonic():
+                return cached[0]
+            row = self._users.get(user_id)
+            ranked = self._score(row) if row else self._popular()
+            self.cache.set(key, (ranked, time.monotonic() + CACHE_SECONDS))
+            return ranked
+
+    def _score(self, row):
+        import numpy as np
+        from scipy import sparse
+
+        topics = np.fromiter(row.keys(), dtype=np.int64, count=len(row))
+        weights = np.fromiter(row.values(), dtype=float, count=len(row))
+        norms = np.sqrt(np.maximum(self._diag[topics], 0))
+        weights = np.divide(weights, norms, out=np.zeros_like(weights), where=norms > 0)
+
+        # Sum of the user's (normalized) topic rows of C, from the matrix and the overlay
+        cols, values = [], []
+        in_matrix = topics < self._cooc.shape[0]
+        if in_matrix.any():
+            product = sparse.csr_matrix(weights[in_matrix]) @ self._cooc[topics[in_matrix]]
+            cols.append(product.indices)
+            values.append(product.data)
+        for topic_id, weight in zip(topics.tolist(), weights.tolist()):
+            extra = self._overlay.get(topic_id)
+            if extra and weight:
+                cols.append(np.fromiter(extra.keys(), dtype=np.int64, count=len(extra)))
+                values.append(weight * np.fromiter(extra.values(), dtype=float, count=len(extra)))
+        if not cols:
+            return []
+        cols, inverse = np.unique(np.concatenate(cols), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(values))
+        norms = np.sqrt(np.maximum(self._diag[cols], 0))
+        scores = np.divide(scores, norms, out=np.zeros_like(scores), where=norms > 0)
+        scores[np.isin(cols, topics)] = 0
+        return self._top(cols, scores)
+
+    def _popular(self):
+        import numpy as np
+        return self._top(np.arange(len(self._diag)), self._diag)
+
+    def _top(self, topic_ids, scores):
+        import numpy as np
+        keep = scores > 1e-9
+        topic_ids, scores = topic_ids[keep], scores[keep]
+        if len(scores) > CANDIDATES:
+            best = np.argpartition(-scores, CANDIDATES)[:CANDIDATES]
+            topic_ids, scores = topic_ids[best], scores[best]
+        order = np.argsort(-scores, kind='stable')
+        return [(int(t), round(float(s), 6)) for t, s in zip(topic_ids[order], scores[order])]
+
+    def stats(self):
+        with self._lock:
+            return {'built': self._built, 'builds': self.builds, 'users': len(self._users),
+                    'topics': len(self._diag) if self._diag is not None else 0,
+                    'overlay': self._overlay_size, 'changes_applied': self.changes_applied,
+                    'watermark': self._watermark, 'cache': self.cache.stats()}
@@ -1,169 +1,259 @@
-from flask import Blueprint, render_template, request, redirect, url_for, session, flash
-from werkzeug.utils import secure_filename
-import sqlite3
-import os
-from datetime import datetime
+import base64
+import binascii
+import json
+
+from flask import Blueprint, render_template, request, redirect, url_for, flash, make_response, send_from_directory, jsonify
+
+from db import get_read_db, transaction, data_version, bump_data_version
+from etags import check_etag, with_etag
+from sessions import current_user
+from avatars import AVATAR_DIR, AvatarError, accepted_extension, avatar_filename, save_avatar
 
 profile_bp = Blueprint('profile', __name__)
 
-DB_NAME = "studymate.db"
-UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static', 'avatars')
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+AVATAR_MAX_AGE = 365 * 24 * 3600
+ACTIVITY_PAGE_SIZE = 5
+MAX_ACTIVITY_PAGE_SIZE = 50
+
+# Activity kinds in tie-break order: rows with the same timestamp are listed
+# by kind, then id, both descending, which makes (created_at, kind, id) a
+# total order to page on
+ACTIVITY_CREATED, ACTIVITY_JOINED, ACTIVITY_RATED, ACTIVITY_MESSAGED = 1, 2, 3, 4
+
+def encode_activity_cursor(created_at, kind, row_id):
+    raw = json.dumps([created_at, kind, row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_activity_cursor(cursor):
+    """Decode an opaque activity cursor into (created_at, kind, id); raises ValueError."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, kind, row_id = json.loads(raw)
+    except (TypeError, ValueError, binascii.Error):
+        raise ValueError('Invalid cursor')
+    if not isinstance(created_at, str) or not isinstance(kind, int) or not isinstance(row_id, int):
+        raise ValueError('Invalid cursor')
+    return created_at, kind, row_id
+
+def _activity_position(alias, kind, cursor):
+    """WHERE fragment selecting rows of one kind that sort after the cursor."""
+    if cursor is None:
+        return f"{alias}.created_at IS NOT NULL", []
+    created_at, cursor_kind, row_id = cursor
+    if kind < cursor_kind:
+        return f"{alias}.created_at <= ?", [created_at]
+    if kind > cursor_kind:
+        return f"{alias}.created_at < ?", [created_at]
+    return f"({alias}.created_at, {alias}.id) < (?, ?)", [created_at, row_id]
+
+def activity_query(user_id, include_messages=False, cursor=None, limit=ACTIVITY_PAGE_SIZE + 1):
+    """SQL and parameters for up to limit activity rows after cursor (see fetch_activity).
+
+    A single UNION ALL query: each branch reads at most limit rows from its
+    own (user, created_at) index, and the outer ORDER BY merges them.
+    """
+    branches = [
+        (ACTIVITY_CREATED, 't', """
+            SELECT t.created_at, 1, t.id, t.title, NULL
+            FROM topics t
+            WHERE t.created_by = ? AND ({position})
+            ORDER BY t.created_at DESC, t.id DESC LIMIT ?"""),
+        (ACTIVITY_JOINED, 'w', """
+            SELECT w.created_at, 2, w.id, t.title, NULL
+            FROM willingness w JOIN topics t ON t.id = w.topic_id
+            WHERE w.user_id = ? AND ({position})
+            ORDER BY w.created_at DESC, w.id DESC LIMIT ?"""),
+        (ACTIVITY_RATED, 'r', """
+            SELECT r.created_at, 3, r.id, t.title, r.rating
+            FROM ratings r JOIN topics t ON t.id = r.topic_id
+            WHERE r.user_id = ? AND ({position})
+            ORDER BY r.created_at DESC, r.id DESC LIMIT ?"""),
+    ]
+    if include_messages:
+        branches.append((ACTIVITY_MESSAGED, 'm', """
+            SELECT m.created_at, 4, m.id, IFNULL(u.name, u.username), NULL
+            FROM messages m JOIN users u ON u.id = m.receiver_id
+            WHERE m.sender_id = ? AND ({position})
+            ORDER BY m.created_at DESC, m.id DESC LIMIT ?"""))
+
+    parts, params = [], []
+    for kind, alias, branch in branches:
+        position, position_params = _activity_position(alias, kind, cursor)
+        parts.append(f"SELECT * FROM ({branch.format(position=position)})")
+        params += [user_id] + position_params + [limit]
+    return " UNION ALL ".join(parts) + " ORDER BY 1 DESC, 2 DESC, 3 DESC LIMIT ?", params + [limit]
+
+def fetch_activity(c, user_id, include_messages=False, cursor=None, limit=ACTIVITY_PAGE_SIZE):
+    """One page of a user's activity, newest first; returns (activities, next_cursor).
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    Messages sent are private and only listed on the user's own profile.
+    """
+    c.execute(*activity_query(user_id, include_messages, cursor, limit + 1))
+    rows = c.fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_activity_cursor(*rows[-1][:3])
+
+    activities = []
+    for created_at, kind, row_id, subject, rating in rows:
+        if kind == ACTIVITY_CREATED:
+            title, description = 'Created topic', subject
+        elif kind == ACTIVITY_JOINED:
+            title, description = 'Joined topic', subject
+        elif kind == ACTIVITY_RATED:
+            title, description = 'Rated topic', f"{subject} ({rating:g}/5)"
+        else:
+            title, description = 'Sent a message', f"to {subject}"
+        activities.append({'date': created_at, 'title': title, 'description': description})
+    return activities, next_cursor
+
+# User details and their user_stats counters in one read
+PROFILE_SQL = """
+    SELECT u.id, u.username, u.profession, u.name, u.avatar,
+           IFNULL(s.topics_created, 0), IFNULL(s.topics_joined, 0),
+           IFNULL(s.ratings_received_count, 0), IFNULL(s.ratings_received_sum, 0)
+    FROM users u
+    LEFT JOIN user_stats s ON s.user_id = u.id
+    WHERE u.username = ?
+"""
 
 @profile_bp.route('/profile/<username>')
 def view_profile(username):
-    if 'user' not in session:
+    user = current_user()
+    if user is None:
         return redirect(url_for('landing'))
 
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_read_db()
     c = conn.cursor()
     
-    # Get user details
-    c.execute("SELECT * FROM users WHERE username = ?", (username,))
+    c.execute(PROFILE_SQL, (username,))
     user_data = c.fetchone()
     
     if not user_data:
-        conn.close()
         return "User not found", 404
     
+    # Check if this is the profile of the logged-in user
+    is_own_profile = user['username'] == username
+    
+    # Stats and activity come from topic data ('feed' version), messages sent
+    # from 'inbox:<id>'; the profile itself (name, profession, avatar) from 'user:<id>'
+    etag, not_modified = check_etag('profile', user_data[0], is_own_profile,
+                                    data_version(c, 'feed'), data_version(c, f'user:{user_data[0]}'),
+                                    data_version(c, f'inbox:{user_data[0]}') if is_own_profile else None)
+    if not_modified:
+        return not_modified
+    
     user = {
         'id': user_data[0],
         'username': user_data[1],
-        'profession': user_data[3],
-        'name': user_data[4]
+        'profession': user_data[2],
+        'name': user_data[3]
     }
     
-    # Get user statistics
-    stats = {}
-    
-    # Topics created
-    c.execute("SELECT COUNT(*) FROM topics WHERE created_by = ?", (user['id'],))
-    stats['topics_created'] = c.fetchone()[0]
-    
-    # Topics joined (through willingness)
-    c.execute("SELECT COUNT(*) FROM willingness WHERE user_id = ?", (user['id'],))
-    stats['topics_joined'] = c.fetchone()[0]
-    
-    # Average rating of their topics
-    c.execute("""
-        SELECT ROUND(AVG(r.rating), 2), COUNT(r.id)
-        FROM topics t
-        LEFT JOIN ratings r ON t.id = r.topic_id
-        WHERE t.created_by = ?
-    """, (user['id'],))
-    avg_rating, total_ratings = c.fetchone()
-    stats['avg_rating'] = avg_rating or 0.0
-    stats['total_ratings'] = total_ratings or 0
-    
-    # Get recent activities
-    activities = []
-    
-    # Topics created
-    c.execute("""
-        SELECT 'Created topic', title, created_at, id
-        FROM topics
-        WHERE created_by = ?
-        ORDER BY created_at DESC
-        LIMIT 5
-    """, (user['id'],))
-    for action, title, date, topic_id in c.fetchall():
-        try:
-            dt = datetime.strptime(str(date), '%Y-%m-%d %H:%M:%S')
-            friendly_date = dt.strftime('%b %d, %Y at %I:%M %p')
-        except:
-            friendly_date = str(date)
-            
-        activities.append({
-            'date': friendly_date,
-            'title': action,
-            'description': title
-        })
-    
-    # Topics joined
-    c.execute("""
-        SELECT 'Joined topic', t.title, w.created_at, t.id
-        FROM willingness w
-        JOIN topics t ON w.topic_id = t.id
-        WHERE w.user_id = ?
-        ORDER BY w.created_at DESC
-        LIMIT 5
-    """, (user['id'],))
-    for action, title, date, topic_id in c.fetchall():
-        try:
-            dt = datetime.strptime(str(date), '%Y-%m-%d %H:%M:%S')
-            friendly_date = dt.strftime('%b %d, %Y at %I:%M %p')
-        except:
-            friendly_date = str(date)
-            
-        activities.append({
-            'date': friendly_date,
-            'title': action,
-            'description': title
-        })
-    
-    # Sort activities by date
-    activities.sort(key=lambda x: datetime.strptime(x['date'], '%b %d, %Y at %I:%M %p'), reverse=True)
-    activities = activities[:5]  # Keep only 5 most recent
-    
-    conn.close()
+    total_ratings, rating_sum = user_data[7], user_data[8]
+    stats = {
+        'topics_created': user_data[5],
+        'topics_joined': user_data[6],
+        'avg_rating': round(rating_sum / total_ratings, 2) if total_ratings else 0.0,
+        'total_ratings': total_ratings
+    }
     
-    # Check if this is the profile of the logged-in user
-    is_own_profile = session['user']['username'] == username
+    activities, next_cursor = fetch_activity(c, user['id'], include_messages=is_own_profile)
     
-    # Check for avatar
-    avatar_path = os.path.join(UPLOAD_FOLDER, f"{username}.jpg")
-    avatar_url = f"/static/avatars/{username}.jpg" if os.path.exists(avatar_path) else None
+    # Avatar thumbnails are addressed by the key stored on the user row
+    avatar_key = user_data[4]
+    avatar_url = avatar_url_2x = None
+    if avatar_key:
+        avatar_url = url_for('profile.avatar_file', filename=avatar_filename(avatar_key, 128))
+        avatar_url_2x = url_for('profile.avatar_file', filename=avatar_filename(avatar_key, 256))
     
-    return render_template('profile.html',
+    return with_etag(make_response(render_template('profile.html',
                          user=user,
                          stats=stats,
                          activities=activities,
+                         next_cursor=next_cursor,
                          is_own_profile=is_own_profile,
-                         avatar_url=avatar_url)
+                         avatar_url=avatar_url,
+                         avatar_url_2x=avatar_url_2x)), etag)
+
+@profile_bp.route('/profile/<username>/activity')
+def profile_activity(username):
+    """Older activity for the profile page, one cursor page at a time."""
+    user = current_user()
+    if user is None:
+        return jsonify({'error': 'Not logged in'}), 401
+
+    try:
+        cursor = decode_activity_cursor(request.args['cursor']) if request.args.get('cursor') else None
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    limit = min(max(request.args.get('limit', ACTIVITY_PAGE_SIZE, type=int) or ACTIVITY_PAGE_SIZE, 1),
+                MAX_ACTIVITY_PAGE_SIZE)
+
+    c = get_read_db().cursor()
+    c.execute("SELECT id FROM users WHERE username = ?", (username,))
+    row = c.fetchone()
+    if not row:
+        return jsonify({'error': 'User not found'}), 404
+
+    is_own_profile = user['username'] == username
+    activities, next_cursor = fetch_activity(c, row[0], include_messages=is_own_profile,
+                                             cursor=cursor, limit=limit)
+    return jsonify({
+        'activities': activities,
+        'next_cursor': next_cursor,
+        'html': render_template('_activity_items.html', activities=activities)
+    })
 
 @profile_bp.route('/update_profile', methods=['POST'])
 def update_profile():
-    if 'user' not in session:
+    user = current_user()
+    if user is None:
         return redirect(url_for('landing'))
     
-    user_id = session['user']['id']
+    user_id = user['id']
     name = request.form.get('name')
     profession = request.form.get('profession')
     
     if not name or not profession:
         flash("Name and profession are required", "error")
-        return redirect(url_for('profile.view_profile', username=session['user']['username']))
+        return redirect(url_for('profile.view_profile', username=user['username']))
     
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    
-    # Update user details
-    c.execute("UPDATE users SET name = ?, profession = ? WHERE id = ?",
-              (name, profession, user_id))
-    
-    # Handle avatar upload
+    # Handle avatar upload: resized thumbnails stored under a content-hash key.
+    # A rejected picture leaves the current one; the other fields still save.
+    avatar_key = avatar_error = None
     if 'avatar' in request.files:
         file = request.files['avatar']
-        if file and file.filename and allowed_file(file.filename):
-            # Save with username as filename
-            filename = f"{session['user']['username']}.jpg"
-            if not os.path.exists(UPLOAD_FOLDER):
-                os.makedirs(UPLOAD_FOLDER)
-            filepath = os.path.join(UPLOAD_FOLDER, filename)
-            file.save(filepath)
+        if file and file.filename and accepted_extension(file.filename):
+            try:
+                avatar_key = save_avatar(file.stream)
+            except AvatarError as e:
+                avatar_error = str(e)
     
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        # Update user details
+        conn.execute("UPDATE users SET name = ?, profession = ?, avatar = IFNULL(?, avatar) WHERE id = ?",
+                     (name, profession, avatar_key, user_id))
+        bump_data_version(conn, f'user:{user_id}')
+        # The author name is shown on every feed card of this user's topics
+        if name != user.get('name'):
+            bump_data_version(conn, 'feed')
     
-    # Update session data
-    session['user']['name'] = name
-    session['user']['profession'] = profession
-    
-    flash("Profile updated successfully!", "success")
-    return redirect(url_for('profile.view_profile', username=session['user']['username']))
+    if avatar_error:
+        flash(f"Profile updated, but the picture was not changed: {avatar_error}", "error")
+    else:
+        flash("Profile updated successfully!", "success")
+    return redirect(url_for('profile.view_profile', username=user['username']))
+
+@profile_bp.route('/avatars/<filename>')
+def avatar_file(filename):
+    # Names are content hashes, so a file at a given URL never changes
+    response = send_from_directory(AVATAR_DIR, filename, max_age=AVATAR_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
 
 # Change route to '/<username>' so url_for('profile.profile', username=...) works
 @profile_bp.route('/<username>')
@@ -0,0 +1,169 @@
+"""Synthetic data for benchmarks.
+
+Fills a scratch database with users, topics, willingness, ratings and
+messages. Activity is skewed the way real usage is: a few users post most
+topics, a few topics attract most joins, and most messages are exchanged
+by a small number of pairs. The same seed always produces the same data.
+
+    python seed_data.py scratch.db --scale medium
+    python seed_data.py scratch.db --users 500 --topics 2000 --messages 50000
+"""
+import argparse
+import os
+import random
+from datetime import datetime, timedelta
+
+from db import connect
+from migrations import migrate
+from timeutils import CANONICAL_FORMAT
+
+SCALES = {
+    'small': dict(users=200, topics=500, willingness=4000, ratings=1500, messages=5000),
+    'medium': dict(users=2000, topics=5000, willingness=40000, ratings=15000, messages=50000),
+    'large': dict(users=10000, topics=25000, willingness=200000, ratings=75000, messages=250000),
+}
+
+PASSWORD = 'password'
+CATEGORIES = ['Mathematics', 'Physics', 'Chemistry', 'Biology', 'Programming',
+              'History', 'Languages', 'Economics', 'Design', '']
+PROFESSIONS = ['Student', 'Teacher', 'Engineer', 'Researcher']
+WORDS = ('algebra calculus vectors proofs graphs recursion sorting networks cells genetics '
+         'optics thermodynamics kinetics grammar essays markets statistics probability '
+         'revision exam practice intro advanced workshop review session').split()
+HISTORY_DAYS = 180
+
+
+def _zipf_weights(n, s=1.1):
+    """Weight of the k-th most popular of n items; a few items dominate."""
+    return [1.0 / (k ** s) for k in range(1, n + 1)]
+
+
+def _ts(base, rng, days=HISTORY_DAYS):
+    return (base - timedelta(seconds=rng.randrange(days * 86400))).strftime(CANONICAL_FORMAT)
+
+
+def _text(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def _distinct_pairs(rng, count, draw):
+    """Up to count distinct (a, b) pairs from draw(); gives up on saturation."""
+    pairs, attempts = set(), 0
+    while len(pairs) < count and attempts < count * 10:
+        pairs.add(draw())
+        attempts += 1
+    return pairs
+
+
+def seed(path, users, topics, willingness, ratings, messages, seed=0):
+    """Create path (migrated) and fill it; returns the row counts written."""
+    rng = random.Random(seed)
+    base = datetime.now().replace(microsecond=0)
+    conn = connect(path)
+    migrate(conn)
+
+    with conn:
+        conn.executemany("INSERT INTO users (username, password, profession, name) VALUES (?, ?, ?, ?)", [
+            (f"user{i}@example.com", PASSWORD, rng.choice(PROFESSIONS), f"User {i}")
+            for i in range(1, users + 1)
+        ])
+    user_ids = [row[0] for row in conn.execute("SELECT id FROM users ORDER BY id")]
+    # Popularity ranks are shuffled so activity is not correlated with id
+    user_weights = _zipf_weights(len(user_ids))
+    rng.shuffle(user_weights)
+
+    topic_rows = []
+    for _ in range(topics):
+        roll = rng.random()
+        if roll < 0.5:
+            scheduled = None
+        elif roll < 0.8:
+            scheduled = _ts(base, rng)  # past session: open for ratings
+        else:
+            scheduled = (base + timedelta(minutes=rng.randrange(60, 60 * 24 * 60))).strftime(CANONICAL_FORMAT)
+        topic_rows.append((_text(rng, 4).title(), _text(rng, 30), f"{rng.choice([30, 45, 60, 90, 120])} minutes",
+                           rng.choices(user_ids, user_weights)[0], _ts(base, rng), scheduled,
+                           rng.choice(CATEGORIES)))
+    with conn:
+        conn.executemany("""
+            INSERT INTO topics (title, description, duration, created_by, created_at, scheduled_datetime, category)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, topic_rows)
+    owners = dict(conn.execute("SELECT id, created_by FROM topics"))
+    topic_ids = sorted(owners)
+    topic_weights = _zipf_weights(len(topic_ids))
+    rng.shuffle(topic_weights)
+
+    def draw_join():
+        return (rng.choices(user_ids, user_weights)[0], rng.choices(topic_ids, topic_weights)[0])
+
+    joins = [(u, t) for u, t in _distinct_pairs(rng, willingness, draw_join) if owners[t] != u]
+    with conn:
+        conn.executemany("INSERT INTO willingness (user_id, topic_id, created_at) VALUES (?, ?, ?)",
+                         [(u, t, _ts(base, rng)) for u, t in joins])
+
+    # Raters are participants of topics that already took place or were never scheduled
+    rateable = {row[0] for row in conn.execute(
+        "SELECT id FROM topics WHERE scheduled_datetime IS NULL OR scheduled_datetime <= ?",
+        (base.strftime(CANONICAL_FORMAT),))}
+    candidates = [(u, t) for u, t in joins if t in rateable]
+    rated = rng.sample(candidates, min(ratings, len(candidates)))
+    with conn:
+        conn.executemany("""
+            INSERT INTO ratings (user_id, topic_id, rating, feedback, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, [(u, t, rng.choice([3.0, 3.5, 4.0, 4.5, 5.0, 5.0, 2.0, 1.0]),
+               _text(rng, 8) if rng.random() < 0.4 else '', ts, ts)
+              for u, t in rated for ts in [_ts(base, rng)]])
+
+    # Messages concentrate on a small set of pairs, sent in time order
+    def draw_pair():
+        a, b = rng.choices(user_ids, user_weights, k=2)
+        return (a, b) if a != b else (a, user_ids[(user_ids.index(b) + 1) % len(user_ids)])
+
+    pairs = list(_distinct_pairs(rng, max(1, messages // 20), draw_pair))
+    pair_weights = _zipf_weights(len(pairs))
+    times = sorted(_ts(base, rng) for _ in range(messages))
+    message_rows = []
+    for created_at in times:
+        a, b = rng.choices(pairs, pair_weights)[0]
+        sender, receiver = (a, b) if rng.random() < 0.5 else (b, a)
+        message_rows.append((sender, receiver, _text(rng, rng.randrange(3, 25)), int(rng.random() < 0.8), created_at))
+    with conn:
+        conn.executemany("""
+            INSERT INTO messages (sender_id, receiver_id, message, is_read, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, message_rows)
+        # The conversations trigger counts every inserted message as unread
+        conn.execute("""
+            UPDATE conversations SET
+                unread_low = (SELECT COUNT(*) FROM messages
+                              WHERE receiver_id = user_low AND sender_id = user_high AND is_read = 0),
+                unread_high = (SELECT COUNT(*) FROM messages
+                               WHERE receiver_id = user_high AND sender_id = user_low AND is_read = 0)
+        """)
+    conn.execute("ANALYZE")
+    conn.close()
+    return {'users': len(user_ids), 'topics': len(topic_ids), 'willingness': len(joins),
+            'ratings': len(rated), 'messages': len(message_rows)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path')
+    parser.add_argument('--scale', choices=SCALES, default='small')
+    parser.add_argument('--seed', type=int, default=0)
+    for name in SCALES['small']:
+        parser.add_argument(f'--{name}', type=int, help=f"override the scale's {name} count")
+    args = parser.parse_args(argv)
+
+    if os.path.exists(args.path):
+        parser.error(f"{args.path} already exists; seed into a fresh file")
+    counts = dict(SCALES[args.scale])
+    counts.update({name: getattr(args, name) for name in counts if getattr(args, name) is not None})
+    written = seed(args.path, seed=args.seed, **counts)
+    print(', '.join(f"{n} {name}" for name, n in written.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""Server-side sessions.
+
+The session cookie carries only a random session id. The session data (the
+logged-in user's id, flashed messages) lives in the sessions table, with an
+in-process LRU in front of it so most requests never read the table.
+User attributes are not stored in the session at all: current_user() loads
+them from users on first use in a request, so profile edits show up
+immediately and a suspended or deleted account is logged out.
+
+SessionInterface takes any store with get/save/delete/sweep; SqliteStore is
+the one the app uses. Cached entries are trusted for CACHE_SECONDS, so a
+session deleted by another worker process stays usable in this one for at
+most that long.
+"""
+import json
+import os
+import secrets
+import threading
+import time
+
+from flask import g, session
+from flask.sessions import SessionInterface as FlaskSessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+from cache import LRUCache
+from db import DB_NAME, connect, get_read_db, transaction
+
+CACHE_SECONDS = 30
+# A session's expiry is pushed forward at most this often, not on every request
+REFRESH_SECONDS = 24 * 3600
+SWEEP_SECONDS = 3600
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, sid, data=None, new=False):
+        def on_update(self):
+            self.modified = True
+        super().__init__(data, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.expires_at = 0
+        self.rotated_from = None
+
+    def rotate(self):
+        """Move the session to a fresh id (call on login, against session fixation)."""
+        if self.rotated_from is None and not self.new:
+            self.rotated_from = self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.modified = True
+
+
+class SqliteStore:
+    """Session rows in the sessions table, fronted by an LRU of recent reads."""
+
+    def __init__(self, db_path=DB_NAME, cache_size=10000):
+        self.db_path = db_path
+        self.cache = LRUCache(cache_size)
+        self._local = threading.local()
+        self._next_sweep = 0.0
+
+    def _conn(self):
+        # One connection per thread, reopened in a forked child
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._local.conn = connect(self.db_path)
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, sid):
+        """(data, expires_at) for a live session, else None."""
+        now = time.time()
+        cached = self.cache.get(sid)
+        if cached is not None and cached[2] > now:
+            data, expires_at, _ = cached
+        else:
+            row = self._conn().execute("SELECT data, expires_at FROM sessions WHERE id = ?", (sid,)).fetchone()
+            if row is None:
+                return None
+            data, expires_at = json.loads(row[0]), row[1]
+            self.cache.set(sid, (data, expires_at, now + CACHE_SECONDS))
+        if expires_at <= now:
+            return None
+        return data, expires_at
+
+    def save(self, sid, data, expires_at):
+        with transaction(self._conn()) as conn:
+            conn.execute("""
+                INSERT INTO sessions (id, data, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at
+            """, (sid, json.dumps(data), expires_at))
+        self.cache.set(sid, (data, expires_at, time.time() + CACHE_SECONDS))
+        self._maybe_sweep()
+
+    def delete(self, sid):
+        with transaction(self._conn()) as conn:
+            conn.execute("DELETE FROM sessions WHERE id = ?", (sid,))
+        self.cache.set(sid, ({}, 0, time.time() + CACHE_SECONDS))
+
+    def sweep(self):
+        """Delete expired sessions; returns how many."""
+        with transaction(self._conn()) as conn:
+            return conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (time.time(),)).rowcount
+
+    def _maybe_sweep(self):
+        # Piggybacks on session writes: at most one sweep per SWEEP_SECONDS per process
+        now = time.time()
+        if now >= self._next_sweep:
+            self._next_sweep = now + SWEEP_SECONDS
+            self.sweep()
+
+
+class SessionInterface(FlaskSessionInterface):
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            found = self.store.get(sid)
+            if found is not None:
+                data, expires_at = found
+                session = ServerSession(sid, data)
+                session.expires_at = expires_at
+                return session
+        return ServerSession(secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.rotated_from is not None:
+            self.store.delete(session.rotated_from)
+            session.rotated_from = None
+
+        if not session:
+            # Emptied (logout): drop the row and the cookie; never stored: nothing to do
+            if not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        now = time.time()
+        stale = session.expires_at - now < lifetime - REFRESH_SECONDS
+        if not (session.modified or session.new or stale):
+            return
+        expires_at = now + lifetime
+        self.store.save(session.sid, dict(session), expires_at)
+        response.set_cookie(
+            name, session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain, path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+        response.vary.add('Cookie')
+
+
+def current_user():
+    """The logged-in user as a dict, or None; read from users once per request."""
+    if 'current_user' not in g:
+        g.current_user = _load_user()
+    return g.current_user
+
+
+def _load_user():
+    if session.get('is_admin'):
+        return {'is_admin': True, 'username': 'Admin'}
+    user_id = session.get('user_id')
+    if user_id is None:
+        return None
+    row = get_read_db().execute("SELECT id, username, profession, name, suspended_at FROM users WHERE id = ?",
+                                (user_id,)).fetchone()
+    if row is None or row[4]:
+        return None
+    return {'id': row[0], 'username': row[1], 'profession': row[2], 'name': row[3]}
@@ -0,0 +1,43 @@
+import os
+import sys
+
+import pytest
+
+# The app is a set of top-level modules in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import connect  # noqa: E402
+from migrations import migrate  # noqa: E402
+
+
+@pytest.fixture
+def conn(tmp_path):
+    """A freshly migrated database in a temporary directory."""
+    conn = connect(str(tmp_path / 'studymate.db'))
+    migrate(conn)
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def app(tmp_path):
+    """The app on a fresh database, with users 'alice' (id 1) and 'bob' (id 2)."""
+    import main
+    app = main.create_app({'DATABASE': str(tmp_path / 'studymate.db'), 'TESTING': True})
+    conn = connect(app.config['DATABASE'])
+    conn.execute("""
+        INSERT INTO users (id, username, password, profession, name)
+        VALUES (1, 'alice', 'pw', 'Student', 'Alice'), (2, 'bob', 'pw', 'Teacher', 'Bob')
+    """)
+    conn.commit()
+    conn.close()
+    yield app
+    main.notifier.stop()
+
+
+@pytest.fixture
+def client(app):
+    """A test client logged in as alice."""
+    client = app.test_client()
+    client.post('/login', data={'username': 'alice', 'password': 'pw'})
+    return client
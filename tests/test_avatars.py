@@ -0,0 +1,91 @@
+import io
+
+import pytest
+
+import avatars
+import migrations
+from avatars import AvatarError
+from db import connect
+
+
+@pytest.fixture
+def legacy_db(tmp_path, monkeypatch):
+    """A database from before migration 12 with users 'alice' and 'bob', both with a <username>.jpg."""
+    avatar_dir = tmp_path / 'avatars'
+    avatar_dir.mkdir()
+    monkeypatch.setattr(avatars, 'AVATAR_DIR', str(avatar_dir))
+    for username in ('alice', 'bob'):
+        (avatar_dir / f"{username}.jpg").write_bytes(username.encode())
+
+    path = str(tmp_path / 'studymate.db')
+    conn = connect(path)
+    with monkeypatch.context() as m:
+        m.setattr(migrations, 'MIGRATIONS', migrations.MIGRATIONS[:11])
+        migrations.migrate(conn)
+    conn.execute("""
+        INSERT INTO users (id, username, password, profession, name)
+        VALUES (1, 'alice', '', '', ''), (2, 'bob', '', '', ''), (3, 'carol', '', '', '')
+    """)
+    conn.commit()
+    conn.close()
+    return path
+
+
+def fake_save_avatar(stream):
+    content = stream.read()
+    if content == b'bob':
+        raise AvatarError("The uploaded file is not a valid image")
+    return content.decode().ljust(32, '0')
+
+
+def test_deploy_converts_legacy_avatars(legacy_db, monkeypatch):
+    monkeypatch.setattr(avatars, 'save_avatar', fake_save_avatar)
+
+    assert migrations.migrate_once(legacy_db)
+    conn = connect(legacy_db)
+    assert dict(conn.execute("SELECT username, avatar FROM users")) == {
+        'alice': 'alice'.ljust(32, '0'), 'bob': None, 'carol': None}
+    conn.close()
+
+    # Nothing to apply, nothing to convert: a restart does not touch the files
+    monkeypatch.setattr(avatars, 'save_avatar', pytest.fail)
+    assert migrations.migrate_once(legacy_db) == []
+
+
+def test_profile_renders_from_the_stored_key_only(app, client, monkeypatch):
+    conn = connect(app.config['DATABASE'])
+    conn.execute("UPDATE users SET avatar = ? WHERE id = 1", ('a' * 32,))
+    conn.commit()
+    conn.close()
+
+    for name in ('isfile', 'exists'):
+        original = getattr(avatars.os.path, name)
+
+        def guarded(path, original=original):
+            assert not str(path).startswith(avatars.AVATAR_DIR), 'profile rendering looked for avatar files'
+            return original(path)
+        monkeypatch.setattr(avatars.os.path, name, guarded)
+
+    html = client.get('/profile/alice').get_data(as_text=True)
+    assert f"/avatars/{'a' * 32}-128.jpg" in html
+    assert f"/avatars/{'a' * 32}-256.jpg 2x" in html
+    assert 'avatars/default.png' in client.get('/profile/bob').get_data(as_text=True)
+
+
+def test_rejected_picture_keeps_the_other_edits(app, client, monkeypatch):
+    def reject(stream):
+        raise AvatarError("Profile pictures must be smaller than 5 MB")
+    monkeypatch.setattr('routes.profile.save_avatar', reject)
+
+    response = client.post('/update_profile', data={
+        'name': 'Alice Smith', 'profession': 'Engineer', 'avatar': (io.BytesIO(b'x' * 10), 'huge.png'),
+    }, content_type='multipart/form-data')
+    assert response.status_code == 302
+
+    conn = connect(app.config['DATABASE'])
+    assert conn.execute("SELECT name, profession, avatar FROM users WHERE id = 1").fetchone() == \
+        ('Alice Smith', 'Engineer', None)
+    conn.close()
+    with client.session_transaction() as session:
+        assert session['_flashes'] == [
+            ('error', "Profile updated, but the picture was not changed: Profile pictures must be smaller than 5 MB")]
@@ -0,0 +1,43 @@
+import time
+
+import pytest
+
+import migrations
+from db import connect
+
+
+@pytest.fixture
+def india_time(monkeypatch):
+    """Run with local time at UTC+05:30."""
+    monkeypatch.setenv('TZ', 'Asia/Kolkata')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_legacy_utc_timestamps_are_stored_as_local_time(tmp_path, monkeypatch, india_time):
+    conn = connect(str(tmp_path / 'studymate.db'))
+    with monkeypatch.context() as m:
+        m.setattr(migrations, 'MIGRATIONS', migrations.MIGRATIONS[:4])
+        migrations.migrate(conn)
+    conn.execute("INSERT INTO users (id, username, password, profession, name) VALUES (1, 'a', '', '', ''), (2, 'b', '', '', '')")
+    conn.execute("INSERT INTO topics (id, title, description, duration, created_by, created_at) VALUES (1, 't', '', '1h', 1, '2025-11-02T20:56')")
+    # Written by the column defaults, i.e. in UTC
+    conn.execute("INSERT INTO willingness (user_id, topic_id, created_at) VALUES (2, 1, '2025-11-02 20:00:00')")
+    conn.execute("INSERT INTO messages (sender_id, receiver_id, message, created_at) VALUES (1, 2, 'hi', '2025-11-02 20:00:00')")
+    conn.execute("INSERT INTO ratings (user_id, topic_id, rating, created_at) VALUES (2, 1, 4, '2025-11-02 21:00:00')")
+    conn.commit()
+
+    migrations.migrate(conn)
+
+    assert conn.execute("SELECT created_at FROM topics").fetchone()[0] == '2025-11-02 20:56:00'
+    assert conn.execute("SELECT created_at FROM willingness").fetchone()[0] == '2025-11-03 01:30:00'
+    assert conn.execute("SELECT created_at FROM messages").fetchone()[0] == '2025-11-03 01:30:00'
+    assert conn.execute("SELECT created_at FROM ratings").fetchone()[0] == '2025-11-02 21:00:00'
+    conn.close()
+
+
+def test_migrate_is_idempotent(conn):
+    assert migrations.schema_version(conn) == len(migrations.MIGRATIONS)
+    assert migrations.migrate(conn) == []
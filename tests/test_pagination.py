@@ -0,0 +1,168 @@
+"""Keyset cursors: round-trips, and paging that visits every row exactly once."""
+import random
+
+import pytest
+
+import main
+from routes import profile
+
+
+def collect_pages(fetch, limit):
+    """Follow next cursors from the first page; returns the pages' rows."""
+    pages, cursor = [], None
+    while True:
+        rows, next_cursor = fetch(cursor, limit)
+        pages.append(rows)
+        if next_cursor is None:
+            return pages
+        cursor = next_cursor
+        assert len(pages) < 1000
+
+
+# --- Topic feed ---
+
+@pytest.mark.parametrize('position', [('2026-01-01 10:00:00', 7), (None, 3), ('', 0)])
+def test_feed_cursor_round_trip(position):
+    cursor = main.encode_feed_cursor(*position)
+    assert '=' not in cursor
+    assert main.decode_feed_cursor(cursor) == position
+
+
+@pytest.mark.parametrize('cursor', ['', 'not base64!', main.encode_feed_cursor('x', 1)[:-2],
+                                    'WzEsIDJd',  # [1, 2]
+                                    'WyJ4IiwgIjEiXQ'])  # ["x", "1"]
+def test_feed_cursor_rejects_garbage(cursor):
+    with pytest.raises(ValueError):
+        main.decode_feed_cursor(cursor)
+
+
+@pytest.fixture
+def feed(conn):
+    """25 topics: runs of equal created_at, a few without one, alternating categories."""
+    conn.execute("INSERT INTO users (id, username, password, profession, name) VALUES (1, 'a', '', '', '')")
+    for topic_id in range(1, 26):
+        created_at = None if topic_id % 8 == 0 else f"2026-01-{topic_id // 3 + 1:02d} 10:00:00"
+        conn.execute("""
+            INSERT INTO topics (id, title, description, duration, created_by, created_at, category)
+            VALUES (?, ?, '', '1h', 1, ?, ?)
+        """, (topic_id, f"Topic {topic_id}", created_at, 'python' if topic_id % 2 else 'math'))
+    conn.commit()
+    return conn
+
+
+@pytest.mark.parametrize('category', [None, 'python'])
+@pytest.mark.parametrize('limit', [1, 4, 7, 100])
+def test_feed_pages_visit_every_topic_once_in_order(feed, category, limit):
+    def fetch(cursor, limit):
+        decoded = main.decode_feed_cursor(cursor) if cursor else None
+        topics, next_cursor, _ = main.fetch_feed_page(feed.cursor(), decoded, category, limit=limit)
+        return [topic[0] for topic in topics], next_cursor
+
+    pages = collect_pages(fetch, limit)
+    assert all(len(page) == limit for page in pages[:-1])
+    expected = [row[0] for row in feed.execute("""
+        SELECT id FROM topics WHERE ? IS NULL OR category = ?
+        ORDER BY created_at IS NULL, created_at DESC, id DESC
+    """, (category, category))]
+    assert [topic_id for page in pages for topic_id in page] == expected
+
+
+# --- Profile activity ---
+
+@pytest.mark.parametrize('position', [('2026-01-01 10:00:00', profile.ACTIVITY_RATED, 12), ('', 1, 0)])
+def test_activity_cursor_round_trip(position):
+    assert profile.decode_activity_cursor(profile.encode_activity_cursor(*position)) == position
+
+
+@pytest.mark.parametrize('cursor', ['', '!!', main.encode_feed_cursor('x', 1), 'WyJ4IiwgIjEiLCAyXQ'])  # ["x", "1", 2]
+def test_activity_cursor_rejects_garbage(cursor):
+    with pytest.raises(ValueError):
+        profile.decode_activity_cursor(cursor)
+
+
+@pytest.fixture
+def activity(conn):
+    """User 1 creates, joins, rates and messages, with many timestamps shared across kinds."""
+    conn.execute("INSERT INTO users (id, username, password, profession, name) VALUES (1, 'a', '', '', ''), (2, 'b', '', '', 'B')")
+    stamps = [f"2026-01-{day:02d} 10:00:00" for day in (1, 1, 2, 2, 2, 3)]
+    for i in range(12):
+        created_at = stamps[i % len(stamps)]
+        conn.execute("INSERT INTO topics (id, title, description, duration, created_by, created_at) VALUES (?, ?, '', '1h', ?, ?)",
+                     (i + 1, f"Topic {i + 1}", 1 if i % 2 else 2, created_at))
+    for i in range(12):
+        created_at = stamps[(i * 5) % len(stamps)]
+        conn.execute("INSERT INTO willingness (user_id, topic_id, created_at) VALUES (1, ?, ?)", (i + 1, created_at))
+        conn.execute("INSERT INTO ratings (user_id, topic_id, rating, created_at) VALUES (1, ?, 4, ?)", (i + 1, created_at))
+        conn.execute(main.INSERT_MESSAGE_SQL, (1, 2, f"message {i}", created_at))
+    conn.commit()
+    return conn
+
+
+@pytest.mark.parametrize('include_messages', [False, True])
+@pytest.mark.parametrize('limit', [1, 5, 13])
+def test_activity_pages_visit_every_item_once_in_order(activity, include_messages, limit):
+    def fetch(cursor, limit):
+        decoded = profile.decode_activity_cursor(cursor) if cursor else None
+        items, next_cursor = profile.fetch_activity(activity.cursor(), 1, include_messages, decoded, limit)
+        return [(item['date'], item['title'], item['description']) for item in items], next_cursor
+
+    pages = collect_pages(fetch, limit)
+    assert all(len(page) == limit for page in pages[:-1])
+    items = [item for page in pages for item in page]
+    everything, _ = fetch(None, 1000)
+    assert items == everything
+    assert len(items) == 6 + 12 + 12 + (12 if include_messages else 0)
+    assert [date for date, _, _ in items] == sorted((date for date, _, _ in items), reverse=True)
+
+
+# --- Admin user directory ---
+
+@pytest.mark.parametrize('position', [(3, 10), (2.3333333333333335, 4), ('alice', 1)])
+def test_directory_cursor_round_trip(position):
+    assert main.decode_directory_cursor(main.encode_directory_cursor(*position)) == position
+
+
+@pytest.mark.parametrize('cursor', ['', '!!', 'WzEsICIyIl0',  # [1, "2"]
+                                    'W3RydWUsIDJd'])  # [true, 2]
+def test_directory_cursor_rejects_garbage(cursor):
+    with pytest.raises(ValueError):
+        main.decode_directory_cursor(cursor)
+
+
+@pytest.fixture
+def directory(conn):
+    """30 users with few distinct names, topic counts and ratings, so every sort has ties."""
+    rng = random.Random(5)
+    for user_id in range(1, 31):
+        name = rng.choice(['Ann', 'ann', 'Bob', 'Cara', 'Dev'])
+        conn.execute("INSERT INTO users (id, username, password, profession, name) VALUES (?, ?, '', '', ?)",
+                     (user_id, f"{name.lower()}{user_id}", name))
+    for topic_id in range(1, 41):
+        conn.execute("INSERT INTO topics (id, title, description, duration, created_by, created_at) "
+                     "VALUES (?, ?, '', '1h', ?, '2026-01-01 10:00:00')", (topic_id, f"Topic {topic_id}", rng.randint(1, 12)))
+    for _ in range(60):
+        user_id, topic_id = rng.randint(1, 30), rng.randint(1, 40)
+        conn.execute("INSERT OR IGNORE INTO willingness (user_id, topic_id, created_at) VALUES (?, ?, '2026-01-02 10:00:00')",
+                     (user_id, topic_id))
+        conn.execute("INSERT OR IGNORE INTO ratings (user_id, topic_id, rating, created_at) VALUES (?, ?, ?, '2026-01-02 10:00:00')",
+                     (user_id, topic_id, rng.choice([1, 3, 4, 5])))
+    conn.commit()
+    return conn
+
+
+@pytest.mark.parametrize('sort', list(main.DIRECTORY_SORTS))
+@pytest.mark.parametrize('order', [None, 'asc', 'desc'])
+@pytest.mark.parametrize('prefix', [None, 'an'])
+def test_directory_pages_visit_every_user_once_in_order(directory, sort, order, prefix):
+    def fetch(cursor, limit):
+        decoded = main.decode_directory_cursor(cursor) if cursor else None
+        users, next_cursor = main.fetch_user_directory(directory.cursor(), sort, order, prefix, decoded, limit)
+        return [user[0] for user in users], next_cursor
+
+    everything, _ = fetch(None, 1000)
+    assert len(everything) == (30 if prefix is None else
+                               directory.execute("SELECT COUNT(*) FROM users WHERE name LIKE 'an%'").fetchone()[0])
+    for limit in (1, 4, 7):
+        pages = collect_pages(fetch, limit)
+        assert all(len(page) == limit for page in pages[:-1])
+        assert [user_id for page in pages for user_id in page] == everything
@@ -0,0 +1,23 @@
+from db import connect
+from migrations import migrate
+from query_plans import full_scans, hot_queries
+
+
+def test_hot_queries_use_an_index():
+    conn = connect(':memory:')
+    migrate(conn)
+    assert full_scans(conn) == {}
+
+
+def test_full_scans_reports_a_table_scan():
+    conn = connect(':memory:')
+    migrate(conn)
+    queries = {'unindexed': ("SELECT id FROM topics WHERE description = ?", ('x',))}
+    assert list(full_scans(conn, queries)) == ['unindexed']
+
+
+def test_hot_queries_come_from_the_routes():
+    import main
+    queries = hot_queries()
+    assert queries['my topics'][0] is main.MY_TOPICS_SQL
+    assert queries['thread'] == main.thread_query(1, 2, before_id=1000)
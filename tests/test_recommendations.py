@@ -0,0 +1,134 @@
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('scipy')
+
+import main  # noqa: E402
+from db import connect  # noqa: E402
+
+
+@pytest.fixture
+def topics(app):
+    """Topics 1-3 by bob; carol (id 3) is willing to join 1 and 2."""
+    conn = connect(app.config['DATABASE'])
+    conn.execute("INSERT INTO users (id, username, password, profession, name) VALUES (3, 'carol', 'pw', '', 'Carol')")
+    for topic_id in (1, 2, 3):
+        conn.execute("""
+            INSERT INTO topics (id, title, description, duration, created_by, created_at)
+            VALUES (?, ?, '', '1h', 2, '2026-01-01 10:00:00')
+        """, (topic_id, f"Topic {topic_id}"))
+    conn.execute("INSERT INTO willingness (user_id, topic_id, created_at) VALUES (3, 1, '2026-01-01 11:00:00'), "
+                 "(3, 2, '2026-01-01 11:00:00')")
+    conn.commit()
+    conn.close()
+
+
+def test_own_write_shows_up_in_the_next_recommendations(app, client, topics):
+    assert client.get('/api/recommendations').status_code == 200
+    assert main.recommender.stats()['users'] == 1
+
+    assert client.post('/willing_to_join/1').status_code == 200
+    topics = client.get('/api/recommendations').get_json()['topics']
+    assert [topic['id'] for topic in topics] == [2]
+    assert main.recommender.stats()['users'] == 2
+
+
+def test_write_does_not_depend_on_the_model(app, client, topics, monkeypatch):
+    def broken(*args, **kwargs):
+        raise RuntimeError('model unavailable')
+    monkeypatch.setattr(main.recommender, 'refresh', broken)
+    monkeypatch.setattr(main.recommender, 'build', broken)
+
+    response = client.post('/willing_to_join/1')
+    assert response.status_code == 200
+    assert response.get_json() == {'action': 'added', 'count': 2}
+
+
+def seed_engagement(conn, rng, users=30, topics=25):
+    conn.executemany("INSERT INTO users (id, username, password, profession, name) VALUES (?, ?, '', '', '')",
+                     [(i, f"user{i}") for i in range(1, users + 1)])
+    conn.executemany("""
+        INSERT INTO topics (id, title, description, duration, created_by, created_at)
+        VALUES (?, ?, '', '1h', 1, '2026-01-01 10:00:00')
+    """, [(i, f"Topic {i}") for i in range(1, topics + 1)])
+    conn.commit()
+
+
+def random_change(conn, rng, users=30, topics=25):
+    """Join, leave, rate, re-rate or unrate one random (user, topic)."""
+    user_id, topic_id = rng.randint(1, users), rng.randint(1, topics)
+    if rng.random() < 0.5:
+        if conn.execute("DELETE FROM willingness WHERE user_id = ? AND topic_id = ?", (user_id, topic_id)).rowcount == 0:
+            conn.execute("INSERT INTO willingness (user_id, topic_id, created_at) VALUES (?, ?, '2026-01-02 10:00:00')",
+                         (user_id, topic_id))
+    elif rng.random() < 0.2:
+        conn.execute("DELETE FROM ratings WHERE user_id = ? AND topic_id = ?", (user_id, topic_id))
+    else:
+        conn.execute("""
+            INSERT INTO ratings (user_id, topic_id, rating, created_at, updated_at)
+            VALUES (?, ?, ?, '2026-01-02 10:00:00', '2026-01-02 10:00:00')
+            ON CONFLICT (user_id, topic_id) DO UPDATE SET rating = excluded.rating
+        """, (user_id, topic_id, rng.choice([0, 1, 2.5, 4, 5])))
+    conn.commit()
+
+
+def all_recommendations(recommender, conn, users=30):
+    return {user_id: dict(recommender.recommend(conn, user_id)) for user_id in range(1, users + 2)}
+
+
+def assert_same_scores(actual, expected):
+    for user_id, scores in expected.items():
+        assert actual[user_id].keys() == scores.keys(), user_id
+        for topic_id, score in scores.items():
+            assert actual[user_id][topic_id] == pytest.approx(score, abs=1e-6)
+
+
+@pytest.mark.parametrize('compact_at', [10 ** 9, 40])
+def test_incremental_updates_match_a_full_rebuild(conn, monkeypatch, compact_at):
+    import random
+
+    import recommendations
+    monkeypatch.setattr(recommendations, 'COMPACT_AT', compact_at)
+    path = conn.execute("PRAGMA database_list").fetchone()[2]
+    rng = random.Random(7)
+    seed_engagement(conn, rng)
+    for _ in range(150):
+        random_change(conn, rng)
+
+    incremental = recommendations.Recommender(path)
+    incremental.build(conn)
+    for _ in range(5):
+        for _ in range(60):
+            random_change(conn, rng)
+        incremental.refresh(conn, force=True)
+        # Other users' lists are cached for CACHE_SECONDS; compare the model itself
+        incremental.cache.clear()
+
+        rebuilt = recommendations.Recommender(path)
+        rebuilt.build(conn)
+        assert incremental.stats()['users'] == rebuilt.stats()['users']
+        assert_same_scores(all_recommendations(incremental, conn), all_recommendations(rebuilt, conn))
+    assert incremental.builds == 1
+    assert incremental.changes_applied > 0
+
+
+def test_refresh_rebuilds_when_the_log_was_pruned(conn):
+    import random
+
+    import recommendations
+    path = conn.execute("PRAGMA database_list").fetchone()[2]
+    rng = random.Random(3)
+    seed_engagement(conn, rng)
+    recommender = recommendations.Recommender(path)
+    recommender.build(conn)
+    for _ in range(20):
+        random_change(conn, rng)
+    # Everything past the watermark but the newest row is gone
+    conn.execute("DELETE FROM recommendation_changes WHERE id < (SELECT MAX(id) FROM recommendation_changes)")
+    conn.commit()
+
+    recommender.refresh(conn, force=True)
+    assert recommender.builds == 2
+    rebuilt = recommendations.Recommender(path)
+    rebuilt.build(conn)
+    assert_same_scores(all_recommendations(recommender, conn), all_recommendations(rebuilt, conn))
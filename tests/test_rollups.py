@@ -0,0 +1,308 @@
+"""Trigger-maintained rollups against the same numbers computed from the base tables."""
+import random
+
+import pytest
+
+import main
+from db import connect, transaction
+from moderation import delete_topics, delete_users
+from notifications import JOIN, MESSAGE, RATING, NotificationWorker
+
+USERS = 8
+TOPICS = 6
+
+
+@pytest.fixture
+def seeded(conn):
+    conn.executemany("INSERT INTO users (id, username, password, profession, name) VALUES (?, ?, '', '', '')",
+                     [(i, f"user{i}") for i in range(1, USERS + 1)])
+    conn.executemany("""
+        INSERT INTO topics (id, title, description, duration, created_by, created_at, scheduled_datetime)
+        VALUES (?, ?, '', '1h', ?, '2026-01-01 10:00:00', '2026-02-01 10:00:00')
+    """, [(i, f"Topic {i}", (i % USERS) + 1) for i in range(1, TOPICS + 1)])
+    conn.commit()
+    return conn
+
+
+def toggle_willingness(conn, user_id, topic_id):
+    if conn.execute("DELETE FROM willingness WHERE user_id = ? AND topic_id = ?", (user_id, topic_id)).rowcount == 0:
+        conn.execute("INSERT INTO willingness (user_id, topic_id, created_at) VALUES (?, ?, '2026-01-02 10:00:00')",
+                     (user_id, topic_id))
+
+
+def rate(conn, user_id, topic_id, rating):
+    """Insert, update or (rating None) delete a rating."""
+    if rating is None:
+        conn.execute("DELETE FROM ratings WHERE user_id = ? AND topic_id = ?", (user_id, topic_id))
+    else:
+        conn.execute("""
+            INSERT INTO ratings (user_id, topic_id, rating, created_at, updated_at)
+            VALUES (?, ?, ?, '2026-01-02 10:00:00', '2026-01-02 10:00:00')
+            ON CONFLICT (user_id, topic_id) DO UPDATE SET rating = excluded.rating
+        """, (user_id, topic_id, rating))
+
+
+def random_writes(conn, seed, count=300):
+    rng = random.Random(seed)
+    for _ in range(count):
+        user_id, topic_id = rng.randint(1, USERS), rng.randint(1, TOPICS)
+        if rng.random() < 0.5:
+            toggle_willingness(conn, user_id, topic_id)
+        else:
+            rate(conn, user_id, topic_id, rng.choice([None, 0, 1.5, 3, 4.5, 5]))
+    conn.commit()
+
+
+def rows(conn, sql):
+    return {row[0]: tuple(row[1:]) for row in conn.execute(sql)}
+
+
+# --- topic_stats ---
+
+TOPIC_STATS_SQL = """
+    SELECT topic_id, willingness_count, ROUND(rating_sum, 6), rating_count, avg_rating
+    FROM topic_stats
+"""
+TOPIC_STATS_RECOMPUTED_SQL = """
+    SELECT t.id,
+           (SELECT COUNT(*) FROM willingness w WHERE w.topic_id = t.id),
+           (SELECT ROUND(IFNULL(SUM(r.rating), 0), 6) FROM ratings r WHERE r.topic_id = t.id),
+           (SELECT COUNT(*) FROM ratings r WHERE r.topic_id = t.id),
+           (SELECT IFNULL(ROUND(AVG(r.rating), 2), 0) FROM ratings r WHERE r.topic_id = t.id)
+    FROM topics t
+"""
+
+
+def test_topic_stats_follow_inserts_updates_and_deletes(seeded):
+    toggle_willingness(seeded, 2, 1)
+    toggle_willingness(seeded, 3, 1)
+    rate(seeded, 2, 1, 4)
+    rate(seeded, 3, 1, 3)
+    assert rows(seeded, TOPIC_STATS_SQL)[1] == (2, 7.0, 2, 3.5)
+
+    rate(seeded, 3, 1, 5)
+    toggle_willingness(seeded, 2, 1)
+    assert rows(seeded, TOPIC_STATS_SQL)[1] == (1, 9.0, 2, 4.5)
+
+    rate(seeded, 2, 1, None)
+    rate(seeded, 3, 1, None)
+    assert rows(seeded, TOPIC_STATS_SQL)[1] == (1, 0.0, 0, 0)
+
+
+def test_topic_stats_match_the_base_tables(seeded):
+    random_writes(seeded, seed=1)
+    assert rows(seeded, TOPIC_STATS_SQL) == rows(seeded, TOPIC_STATS_RECOMPUTED_SQL)
+
+    seeded.execute("DELETE FROM topics WHERE id = 1")
+    assert 1 not in rows(seeded, TOPIC_STATS_SQL)
+
+
+# --- conversations ---
+
+CONVERSATIONS_SQL = """
+    SELECT user_low || '-' || user_high, last_message_id, last_message_at, last_message_preview,
+           last_sender_id, unread_low, unread_high
+    FROM conversations
+"""
+CONVERSATIONS_RECOMPUTED_SQL = """
+    SELECT p.user_low || '-' || p.user_high, m.id, m.created_at, SUBSTR(m.message, 1, 120), m.sender_id,
+           p.unread_low, p.unread_high
+    FROM (
+        SELECT MIN(sender_id, receiver_id) AS user_low, MAX(sender_id, receiver_id) AS user_high,
+               MAX(id) AS last_id,
+               SUM(is_read = 0 AND receiver_id < sender_id) AS unread_low,
+               SUM(is_read = 0 AND receiver_id > sender_id) AS unread_high
+        FROM messages
+        GROUP BY user_low, user_high
+    ) p
+    JOIN messages m ON m.id = p.last_id
+"""
+
+
+def send(conn, sender_id, receiver_id, text, created_at='2026-01-03 10:00:00'):
+    conn.execute(main.INSERT_MESSAGE_SQL, (sender_id, receiver_id, text, created_at))
+    conn.commit()
+
+
+def test_conversations_follow_messages_and_reads(seeded):
+    send(seeded, 3, 1, 'hello')
+    send(seeded, 3, 1, 'x' * 200)
+    send(seeded, 1, 3, 'hi')
+    assert rows(seeded, CONVERSATIONS_SQL)['1-3'] == (3, '2026-01-03 10:00:00', 'hi', 1, 2, 1)
+
+    main.mark_conversation_read(seeded, 1, 3)
+    assert rows(seeded, CONVERSATIONS_SQL)['1-3'][4:] == (0, 1)
+    assert rows(seeded, CONVERSATIONS_SQL) == rows(seeded, CONVERSATIONS_RECOMPUTED_SQL)
+
+
+def test_conversations_match_the_messages(seeded):
+    rng = random.Random(2)
+    for i in range(200):
+        sender_id, receiver_id = rng.sample(range(1, USERS + 1), 2)
+        send(seeded, sender_id, receiver_id, f"message {i}", f"2026-01-03 10:{i // 60:02d}:{i % 60:02d}")
+        if rng.random() < 0.2:
+            main.mark_conversation_read(seeded, receiver_id, sender_id)
+    assert rows(seeded, CONVERSATIONS_SQL) == rows(seeded, CONVERSATIONS_RECOMPUTED_SQL)
+
+    with transaction(seeded):
+        delete_users(seeded, [2])
+    assert rows(seeded, CONVERSATIONS_SQL) == rows(seeded, CONVERSATIONS_RECOMPUTED_SQL)
+    assert not [key for key in rows(seeded, CONVERSATIONS_SQL) if '2' in key.split('-')]
+
+
+# --- calendar versions ---
+
+def calendar_versions(conn):
+    return dict(conn.execute("SELECT id, calendar_version FROM users"))
+
+
+def bumped(before, after):
+    """{user id: bumps} for the users whose calendar version moved."""
+    return {user_id: after[user_id] - version for user_id, version in before.items()
+            if after.get(user_id, version) != version}
+
+
+def test_calendar_versions_follow_joins_and_topic_changes(seeded):
+    before = calendar_versions(seeded)
+    toggle_willingness(seeded, 3, 1)
+    toggle_willingness(seeded, 4, 1)
+    toggle_willingness(seeded, 5, 2)
+    assert bumped(before, calendar_versions(seeded)) == {3: 1, 4: 1, 5: 1}
+
+    before = calendar_versions(seeded)
+    seeded.execute("UPDATE topics SET scheduled_datetime = '2026-03-01 09:00:00' WHERE id = 1")
+    seeded.execute("UPDATE topics SET title = 'Renamed' WHERE id = 3")
+    assert bumped(before, calendar_versions(seeded)) == {3: 1, 4: 1}
+
+    before = calendar_versions(seeded)
+    seeded.execute("UPDATE topics SET created_at = '2026-01-05 10:00:00' WHERE id = 1")
+    rate(seeded, 3, 1, 4)
+    assert bumped(before, calendar_versions(seeded)) == {}
+
+    before = calendar_versions(seeded)
+    toggle_willingness(seeded, 3, 1)
+    assert bumped(before, calendar_versions(seeded)) == {3: 1}
+
+    # User 3 owns topic 2; deleting them takes topic 2 off user 5's calendar
+    before = calendar_versions(seeded)
+    with transaction(seeded):
+        delete_users(seeded, [3])
+    assert bumped(before, calendar_versions(seeded)) == {5: 1}
+
+
+# --- user_stats ---
+
+USER_STATS_SQL = """
+    SELECT user_id, topics_created, topics_joined, ratings_received_count,
+           ROUND(ratings_received_sum, 6), ratings_given, messages_sent
+    FROM user_stats
+"""
+USER_STATS_RECOMPUTED_SQL = """
+    SELECT u.id,
+           (SELECT COUNT(*) FROM topics t WHERE t.created_by = u.id),
+           (SELECT COUNT(*) FROM willingness w WHERE w.user_id = u.id),
+           (SELECT COUNT(*) FROM ratings r JOIN topics t ON t.id = r.topic_id WHERE t.created_by = u.id),
+           (SELECT ROUND(IFNULL(SUM(r.rating), 0), 6) FROM ratings r JOIN topics t ON t.id = r.topic_id
+            WHERE t.created_by = u.id),
+           (SELECT COUNT(*) FROM ratings r WHERE r.user_id = u.id),
+           (SELECT COUNT(*) FROM messages m WHERE m.sender_id = u.id)
+    FROM users u
+"""
+
+
+def test_user_stats_follow_inserts_updates_and_deletes(seeded):
+    # User 2 owns topic 1, user 3 topic 2
+    toggle_willingness(seeded, 3, 1)
+    rate(seeded, 3, 1, 4)
+    rate(seeded, 4, 1, 2)
+    send(seeded, 3, 2, 'hi')
+    assert rows(seeded, USER_STATS_SQL)[2] == (1, 0, 2, 6.0, 0, 0)
+    assert rows(seeded, USER_STATS_SQL)[3] == (1, 1, 0, 0.0, 1, 1)
+
+    rate(seeded, 3, 1, 5)
+    rate(seeded, 4, 1, None)
+    toggle_willingness(seeded, 3, 1)
+    assert rows(seeded, USER_STATS_SQL)[2] == (1, 0, 1, 5.0, 0, 0)
+    assert rows(seeded, USER_STATS_SQL)[3] == (1, 0, 0, 0.0, 1, 1)
+    assert rows(seeded, USER_STATS_SQL)[4][4] == 0
+
+
+def test_user_stats_match_the_base_tables(seeded):
+    random_writes(seeded, seed=3)
+    rng = random.Random(3)
+    for i in range(50):
+        sender_id, receiver_id = rng.sample(range(1, USERS + 1), 2)
+        send(seeded, sender_id, receiver_id, f"message {i}")
+    assert rows(seeded, USER_STATS_SQL) == rows(seeded, USER_STATS_RECOMPUTED_SQL)
+
+    with transaction(seeded):
+        delete_topics(seeded, [1, 4])
+    assert rows(seeded, USER_STATS_SQL) == rows(seeded, USER_STATS_RECOMPUTED_SQL)
+
+    with transaction(seeded):
+        delete_users(seeded, [5, 6])
+    assert rows(seeded, USER_STATS_SQL) == rows(seeded, USER_STATS_RECOMPUTED_SQL)
+
+
+# --- notification_counts ---
+
+NOTIFICATION_COUNTS_SQL = "SELECT user_id, unread FROM notification_counts WHERE unread > 0"
+NOTIFICATION_COUNTS_RECOMPUTED_SQL = """
+    SELECT user_id, COUNT(*) FROM notifications WHERE is_read = 0 GROUP BY user_id
+"""
+
+
+def notify(conn, user_id, count=1, is_read=0):
+    conn.executemany("""
+        INSERT INTO notifications (user_id, type, title, message, is_read, created_at)
+        VALUES (?, 'message', 'New message', 'hi', ?, '2026-01-03 10:00:00')
+    """, [(user_id, is_read)] * count)
+    conn.commit()
+
+
+def test_notification_counts_follow_inserts_reads_and_deletes(seeded):
+    notify(seeded, 2, 3)
+    notify(seeded, 2, 2, is_read=1)
+    notify(seeded, 3)
+    assert rows(seeded, NOTIFICATION_COUNTS_SQL) == {2: (3,), 3: (1,)}
+
+    first = seeded.execute("SELECT MIN(id) FROM notifications WHERE user_id = 2").fetchone()[0]
+    seeded.execute("UPDATE notifications SET is_read = 1 WHERE id = ?", (first,))
+    seeded.execute("UPDATE notifications SET is_read = 1 WHERE id = ?", (first,))
+    assert rows(seeded, NOTIFICATION_COUNTS_SQL) == {2: (2,), 3: (1,)}
+
+    seeded.execute("DELETE FROM notifications WHERE user_id = 2 AND is_read = 1")
+    assert rows(seeded, NOTIFICATION_COUNTS_SQL) == {2: (2,), 3: (1,)}
+    seeded.execute("DELETE FROM notifications WHERE user_id = 2")
+    assert rows(seeded, NOTIFICATION_COUNTS_SQL) == {3: (1,)}
+
+
+def test_notification_counts_match_the_notifications(seeded):
+    rng = random.Random(4)
+    worker = NotificationWorker(':memory:')
+    for _ in range(10):
+        events = [(rng.choice([JOIN, RATING, MESSAGE]), rng.randint(1, USERS), rng.randint(1, TOPICS),
+                   actor_id, f"user{actor_id}")
+                  for actor_id in [rng.randint(1, USERS) for _ in range(30)]]
+        worker.write(seeded, events)
+        for user_id in rng.sample(range(1, USERS + 1), 3):
+            seeded.execute("UPDATE notifications SET is_read = 1 WHERE user_id = ? AND id % 3 = 0", (user_id,))
+        seeded.commit()
+    assert rows(seeded, NOTIFICATION_COUNTS_SQL) == rows(seeded, NOTIFICATION_COUNTS_RECOMPUTED_SQL)
+
+    with transaction(seeded):
+        delete_users(seeded, [1, 2])
+    assert rows(seeded, NOTIFICATION_COUNTS_SQL) == rows(seeded, NOTIFICATION_COUNTS_RECOMPUTED_SQL)
+
+
+def test_unread_count_endpoint_follows_mark_read(app, client):
+    conn = connect(app.config['DATABASE'])
+    notify(conn, 1, 4)
+    ids = [row[0] for row in conn.execute("SELECT id FROM notifications ORDER BY id")]
+    conn.close()
+
+    assert client.get('/api/notifications/unread_count').get_json() == {'unread': 4}
+    assert client.post('/api/notifications/read', json={'ids': ids[:2]}).get_json() == {'unread': 2}
+    assert client.post('/api/notifications/read', json={'ids': ids[:2]}).get_json() == {'unread': 2}
+    assert client.post('/api/notifications/read').get_json() == {'unread': 0}
+    assert client.get('/api/notifications/unread_count').get_json() == {'unread': 0}
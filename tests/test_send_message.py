@@ -0,0 +1,24 @@
+import pytest
+
+
+def message_count(app):
+    from db import connect
+    conn = connect(app.config['DATABASE'])
+    try:
+        return conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_send_message(app, client):
+    response = client.post('/messages/send', json={'recipient_id': '2', 'message': 'hi'})
+    assert response.status_code == 200
+    assert response.get_json()['ok']
+    assert message_count(app) == 1
+
+
+@pytest.mark.parametrize('recipient_id', ['bob', '2x', 1.5, True, [2], 99])
+def test_send_message_rejects_bad_recipient_before_insert(app, client, recipient_id):
+    response = client.post('/messages/send', json={'recipient_id': recipient_id, 'message': 'hi'})
+    assert response.status_code == 400
+    assert message_count(app) == 0
@@ -0,0 +1,68 @@
+"""Timestamp storage and display helpers.
+
+Every timestamp is stored as local time in CANONICAL_FORMAT, which sorts
+lexicographically in chronological order. Older rows may still hold one of
+the LEGACY_FORMATS, or for willingness and messages UTC from the column
+default, until migration 5 has rewritten them.
+"""
+from datetime import datetime
+from functools import lru_cache
+
+CANONICAL_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Formats written by earlier versions (the datetime-local input sends '%Y-%m-%dT%H:%M')
+LEGACY_FORMATS = ('%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d')
+
+DISPLAY_FORMATS = {
+    'short': '%b %d at %I:%M %p',         # feed cards, ratings
+    'long': '%b %d, %Y at %I:%M %p',      # scheduled sessions, profile activity
+    'calendar': '%Y-%m-%d %H:%M',         # calendar page data
+}
+
+
+def now_ts():
+    """Current local time in canonical form, for writes."""
+    return datetime.now().strftime(CANONICAL_FORMAT)
+
+
+@lru_cache(maxsize=4096)
+def _parse(value):
+    try:
+        return datetime.strptime(value, CANONICAL_FORMAT)
+    except ValueError:
+        pass
+    for fmt in LEGACY_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def parse_ts(value):
+    """Parse a stored timestamp; returns None if it is empty or unrecognised."""
+    if not value:
+        return None
+    return _parse(str(value))
+
+
+def normalize_ts(value):
+    """Return value in canonical form, or None if it cannot be parsed."""
+    dt = parse_ts(value)
+    return dt.strftime(CANONICAL_FORMAT) if dt else None
+
+
+@lru_cache(maxsize=8192)
+def _format(value, style):
+    dt = _parse(value)
+    return dt.strftime(DISPLAY_FORMATS[style]) if dt else value
+
+
+def format_ts(value, style='short'):
+    """Display form of a stored timestamp; unparseable values are shown as-is.
+
+    Also registered as the 'timestamp' Jinja filter.
+    """
+    if not value:
+        return ''
+    return _format(str(value), style)
@@ -0,0 +1,146 @@
+"""Single-writer group commit for hot write endpoints.
+
+Request threads hand a write (a function taking a connection) to
+writer.submit(...) and wait on the returned future. One background thread
+owns a connection, collects whatever writes arrive within a short window and
+runs them all in one BEGIN IMMEDIATE transaction, so a burst of N requests
+costs one lock acquisition and one commit instead of N. Each write runs in
+its own savepoint: one that raises is rolled back and its future gets the
+exception, the rest of the batch still commits.
+
+Results are handed back only after the commit, so a request never reports a
+write that could still be lost.
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from db import connect
+
+log = logging.getLogger(__name__)
+
+WINDOW_SECONDS = 0.005
+MAX_BATCH_WRITES = 256
+SUBMIT_TIMEOUT = 10.0
+
+
+class GroupCommitWriter:
+    def __init__(self, db_path, window_seconds=WINDOW_SECONDS, max_batch=MAX_BATCH_WRITES):
+        self.db_path = db_path
+        self.window_seconds = window_seconds
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopping = False
+        self.batches = 0
+        self.writes = 0
+        atexit.register(self.stop)
+
+    # --- producers (request threads) ---
+
+    def submit(self, fn, *args):
+        """Queue fn(conn, *args) for the next group commit; returns a Future
+        resolved with its return value once the batch has committed."""
+        self._ensure_started()
+        future = Future()
+        self._queue.put((future, fn, args))
+        return future
+
+    def run(self, fn, *args, timeout=SUBMIT_TIMEOUT):
+        """submit() and wait for the result (re-raises the write's exception)."""
+        return self.submit(fn, *args).result(timeout)
+
+    def _ensure_started(self):
+        # Started on first use, so each (forked) worker process gets its own thread
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='group-commit', daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=5.0):
+        """Commit what is queued and stop the thread."""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self._stopping = True
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def stats(self):
+        return {'batches': self.batches, 'writes': self.writes,
+                'avg_batch': round(self.writes / self.batches, 2) if self.batches else 0.0}
+
+    # --- consumer (background thread) ---
+
+    def _drain(self):
+        """Block for one write, then collect whatever arrives within the window."""
+        item = self._queue.get()
+        items = []
+        deadline = time.monotonic() + self.window_seconds
+        while item is not None:
+            items.append(item)
+            if len(items) >= self.max_batch:
+                break
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+        return items
+
+    def _run(self):
+        conn = connect(self.db_path)
+        # Transactions are managed here, explicitly
+        conn.isolation_level = None
+        try:
+            while True:
+                items = self._drain()
+                if items:
+                    self.commit(conn, items)
+                if self._stopping and self._queue.empty():
+                    break
+        finally:
+            conn.close()
+
+    def commit(self, conn, items):
+        """Run one batch of writes in a single transaction and resolve their futures."""
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for future, fn, args in items:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                conn.execute("SAVEPOINT write")
+                try:
+                    result = fn(conn, *args)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write")
+                    conn.execute("RELEASE write")
+                    results.append((future, None, e))
+                else:
+                    conn.execute("RELEASE write")
+                    results.append((future, result, None))
+            conn.execute("COMMIT")
+        except Exception as e:
+            # The commit itself failed: nothing in the batch was written
+            log.exception("Group commit of %d write(s) failed", len(items))
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for future, _, _ in items:
+                if future.done():
+                    continue
+                if future.running() or future.set_running_or_notify_cancel():
+                    future.set_exception(e)
+            return
+        self.batches += 1
+        self.writes += len(results)
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
@@ -0,0 +1,12 @@
+"""WSGI entry point for prefork servers.
+
+    gunicorn -w 4 wsgi:app
+
+Each worker (or the master, with --preload) builds the app once. Schema
+migrations run under a lock file, so only the first process to start
+applies them; database connections and background threads are opened on
+first use, after the fork.
+"""
+from main import create_app
+
+app = create_app()